@@ -0,0 +1,143 @@
+"""Fixtures and helpers shared by the benchmarks
+
+The benchmarks are run against repositories on the local filesystem
+and on S3 (backed by moto), seeded with SIZES artifacts (or
+packages). The largest size is included only if PP_BENCH_LARGE is
+set. Besides the timings, the requests made to the storage are
+counted per operation and asserted, so that a change that makes more
+requests (eg. a listing on publish) fails even if it's not slower
+against the local stand-ins.
+"""
+
+import os
+from collections import Counter
+from contextlib import contextmanager
+
+import pytest
+
+import pypiprivate.publish as pp
+import pypiprivate.storage as ps
+from pypiprivate.stats import InstrumentedStorage, StatsCollector
+
+
+SIZES = [10, 1000]
+if os.environ.get('PP_BENCH_LARGE'):
+    SIZES += [100000]
+
+BACKENDS = ['local', 's3']
+
+BUCKET = 'pypiprivate-bench'
+
+
+class CountingStorage(InstrumentedStorage):
+    """Instrumented local `storage` whose calls to the storage
+    operations are counted (as the local filesystem has no API calls
+    to count)
+    """
+
+    def __init__(self, storage):
+        super(CountingStorage, self).__init__(storage, StatsCollector())
+
+    def reset(self):
+        self.collector = StatsCollector()
+
+    def calls(self):
+        operations = self.collector.snapshot()['operations']
+        return Counter(dict((op, s['count']) for op, s in operations.items()))
+
+
+# Operations of a multipart upload other than the one completing it.
+# The number of parts depends on the size of the object, so a
+# multipart upload is counted as a single PutObject.
+MULTIPART_OPERATIONS = ('CreateMultipartUpload', 'UploadPart')
+
+
+@contextmanager
+def s3_api_calls(storage):
+    calls = Counter()
+
+    def count(model, **kwargs):
+        if model.name in MULTIPART_OPERATIONS:
+            return
+        if model.name == 'CompleteMultipartUpload':
+            calls['PutObject'] += 1
+        else:
+            calls[model.name] += 1
+
+    events = storage.client.meta.events
+    events.register('before-call.s3', count)
+    try:
+        yield calls
+    finally:
+        events.unregister('before-call.s3', count)
+
+
+@contextmanager
+def count_calls(storage):
+    """Counts the requests made to the storage within the block
+
+    Yields a Counter of the S3 API operations for S3 and of the
+    storage methods called for the local filesystem.
+    """
+    if isinstance(storage, CountingStorage):
+        storage.reset()
+        calls = Counter()
+        try:
+            yield calls
+        finally:
+            calls.update(storage.calls())
+    else:
+        with s3_api_calls(storage) as calls:
+            yield calls
+
+
+@pytest.fixture
+def local_storage(tmp_path):
+    return CountingStorage(ps.LocalFileSystemStorage(str(tmp_path / 'simple')))
+
+
+@pytest.fixture
+def s3_storage(monkeypatch):
+    moto = pytest.importorskip('moto')
+    import boto3
+    import pypiprivate.s3 as s3
+    for var in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+        monkeypatch.setenv(var, 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with moto.mock_aws():
+        boto3.client('s3').create_bucket(Bucket=BUCKET)
+        yield s3.AWSS3Storage(BUCKET, 'private', prefix='simple',
+                              sync_strategy='none')
+
+
+@pytest.fixture(params=BACKENDS)
+def storage(request):
+    return request.getfixturevalue('{0}_storage'.format(request.param))
+
+
+def dist_filename(pkg_name, i):
+    return '{0}-0.{1}.0.tar.gz'.format(pkg_name, i)
+
+
+def seed_package(storage, pkg_name, size, with_files=False):
+    """Publishes the manifest and the indexes of a package with `size`
+    artifacts
+
+    The artifacts themselves are uploaded only if `with_files` is
+    passed, as publishing to a package with a manifest doesn't read
+    them.
+    """
+    files = [pp.manifest_entry(dist_filename(pkg_name, i), '0' * 64)
+             for i in range(size)]
+    if with_files:
+        for f in files:
+            storage.put_contents('', storage.join_path(pkg_name, f['filename']))
+    pp.write_pkg_index(storage, pkg_name, {'files': files})
+
+
+def seed_repository(storage, size):
+    """Publishes the manifest and the index of a repository with
+    `size` packages (without the packages themselves)
+    """
+    pkgs = ['pkg{0}'.format(i) for i in range(size)]
+    pp.write_root_index(storage, {'packages': sorted(pkgs)})
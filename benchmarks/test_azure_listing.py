@@ -0,0 +1,135 @@
+"""Benchmarks of listing a large Azure container
+
+The container is emulated in memory by `FakeContainerClient`, which
+pages the listings the same way as the service (and Azurite) and
+counts the list requests.
+
+Set PP_BENCH_LARGE=1 to include the larger containers.
+"""
+
+import os
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+pytest.importorskip('azure.storage.blob')
+
+import pypiprivate.azure as pa
+
+
+# (number of packages, number of dists per package)
+SIZES = [(100, 10)]
+if os.environ.get('PP_BENCH_LARGE'):
+    SIZES += [(2000, 100)]
+
+# Max number of items in a page of a listing
+PAGE_SIZE = 5000
+
+
+class FakeItem(object):
+
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeBlobClient(object):
+
+    def __init__(self, container_client, name):
+        self.container_client = container_client
+        self.name = name
+
+    def exists(self):
+        self.container_client.requests += 1
+        return self.name in self.container_client.names
+
+
+class FakeContainerClient(object):
+
+    def __init__(self, names):
+        self.names = set(names)
+        self.sorted_names = sorted(names)
+        self.requests = 0
+
+    def paged(self, items):
+        for i, item in enumerate(items):
+            if i % PAGE_SIZE == 0:
+                self.requests += 1
+            yield item
+
+    def _list(self, name_starts_with, delimiter=None):
+        last_prefix = None
+        for name in self.sorted_names:
+            if not name.startswith(name_starts_with):
+                continue
+            rest = name[len(name_starts_with):]
+            if delimiter and delimiter in rest:
+                prefix = name_starts_with + rest.split(delimiter)[0] + delimiter
+                if prefix != last_prefix:
+                    last_prefix = prefix
+                    yield FakeItem(prefix)
+            else:
+                yield FakeItem(name)
+
+    def list_blobs(self, name_starts_with=None):
+        return self.paged(self._list(name_starts_with or ''))
+
+    def walk_blobs(self, name_starts_with=None, delimiter='/'):
+        return self.paged(self._list(name_starts_with or '', delimiter))
+
+    def get_blob_client(self, name):
+        return FakeBlobClient(self, name)
+
+
+def legacy_listdir(storage, path):
+    """The listdir implementation prior to the hierarchical listing, for
+    comparison
+    """
+    prefix = storage.dir_prefix(path)
+    blobs = storage.container_client.list_blobs(name_starts_with=prefix)
+    files = [b.name[len(prefix):] for b in blobs]
+    dirs = list({os.path.dirname(f) for f in files})
+    return files + dirs
+
+
+@pytest.fixture(scope='module', params=SIZES,
+                ids=lambda size: '{0}x{1}'.format(*size))
+def storage(request):
+    num_pkgs, num_dists = request.param
+    names = ['simple/index.html']
+    for i in range(num_pkgs):
+        pkg = 'pkg{0}'.format(i)
+        names.append('simple/{0}/index.html'.format(pkg))
+        names.extend('simple/{0}/{0}-0.{1}.0.tar.gz'.format(pkg, j)
+                     for j in range(num_dists))
+    storage = pa.AzureBlobStorage('conn-str', 'bench', prefix='simple')
+    storage._container_client = FakeContainerClient(names)
+    storage.num_pkgs = num_pkgs
+    return storage
+
+
+def count_requests(storage, fn, *args):
+    container_client = storage.container_client
+    container_client.requests = 0
+    fn(*args)
+    return container_client.requests
+
+
+def test_listdir_root(benchmark, storage):
+    # Only the package dirs are listed, in a single page
+    assert count_requests(storage, storage.listdir, '.') == 1
+    names = benchmark(storage.listdir, '.')
+    assert len(names) == storage.num_pkgs + 1
+
+
+def test_legacy_listdir_root(benchmark, storage):
+    # Every blob in the container is listed
+    num_blobs = len(storage.container_client.names)
+    assert count_requests(storage, legacy_listdir, storage, '.') == \
+        -(-num_blobs // PAGE_SIZE)
+    benchmark(legacy_listdir, storage, '.')
+
+
+def test_path_exists(benchmark, storage):
+    path = 'pkg0/pkg0-0.0.0.tar.gz'
+    assert count_requests(storage, storage.path_exists, path) == 1
+    assert benchmark(storage.path_exists, path)
@@ -0,0 +1,156 @@
+"""Benchmarks of publishing and of updating the indexes
+
+Run with,
+
+    $ make bench
+
+The number of requests made to the storage by every operation is
+recorded in the extra_info of the benchmark and asserted against the
+budgets below, independent of the size of the repository.
+"""
+
+import zipfile
+import itertools
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+from pypiprivate.publish import (publish_package, update_pkg_index,
+                                 update_root_index, build_index,
+                                 manifest_entry)
+
+from conftest import (SIZES, CountingStorage, count_calls, dist_filename,
+                      seed_package, seed_repository)
+
+
+# Requests made by the operations with a manifest already present. For
+# S3, these are API calls and for the local filesystem, calls to the
+# storage.
+UPDATE_PKG_INDEX_CALLS = {
+    's3': {'GetObject': 1, 'PutObject': 3, 'HeadObject': 1},
+    'local': {'get_versioned_contents': 1, 'put_contents_if_match': 1,
+              'put_stream': 1, 'put_contents': 1, 'path_token': 1},
+}
+
+UPDATE_ROOT_INDEX_CALLS = UPDATE_PKG_INDEX_CALLS
+
+PUBLISH_PACKAGE_CALLS = {
+    # The existence of a single dist is checked with a HEAD, of
+    # multiple dists with a single listing. The package has a manifest,
+    # so the repository manifest isn't read.
+    's3': lambda n: {'HeadObject': 1 + (1 if n == 1 else 0),
+                     'ListObjectsV2': 0 if n == 1 else 1,
+                     'PutObject': n + 3,
+                     'GetObject': 1},
+    'local': lambda n: {'path_exists': n,
+                        'put_file': n,
+                        'get_versioned_contents': 1,
+                        'put_contents_if_match': 1,
+                        'put_stream': 1,
+                        'put_contents': 1,
+                        'path_token': 1},
+}
+
+
+def backend(storage):
+    return 'local' if isinstance(storage, CountingStorage) else 's3'
+
+
+def record(benchmark, calls):
+    calls = dict((k, v) for k, v in calls.items() if v)
+    benchmark.extra_info['calls'] = calls
+    return calls
+
+
+def new_dists(pkg_name, start):
+    """Returns a function that returns (args, kwargs) to call
+    update_pkg_index with a new dist every time
+    """
+    counter = itertools.count(start)
+
+    def setup():
+        artifact = dist_filename(pkg_name, next(counter))
+        dist = {'pkg': pkg_name,
+                'normalized_name': pkg_name,
+                'artifact': artifact,
+                'sha256': '0' * 64}
+        return (pkg_name, [dist]), {}
+    return setup
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_update_pkg_index(benchmark, storage, size):
+    seed_package(storage, 'abc', size)
+    setup = new_dists('abc', size)
+    with count_calls(storage) as calls:
+        args, _ = setup()
+        update_pkg_index(storage, *args)
+    expected = UPDATE_PKG_INDEX_CALLS[backend(storage)]
+    assert record(benchmark, calls) == expected
+
+    benchmark.pedantic(lambda name, dists: update_pkg_index(storage, name, dists),
+                       setup=setup, rounds=10, warmup_rounds=1)
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_update_root_index(benchmark, storage, size):
+    seed_repository(storage, size)
+    counter = itertools.count(size)
+
+    def setup():
+        return (['pkg{0}'.format(next(counter))],), {}
+
+    with count_calls(storage) as calls:
+        args, _ = setup()
+        update_root_index(storage, *args)
+    assert record(benchmark, calls) == UPDATE_ROOT_INDEX_CALLS[backend(storage)]
+
+    benchmark.pedantic(lambda pkgs: update_root_index(storage, pkgs),
+                       setup=setup, rounds=10, warmup_rounds=1)
+
+    # Already registered packages don't result in any writes
+    with count_calls(storage) as calls:
+        update_root_index(storage, ['pkg0'])
+    assert not any(k.startswith('Put') or k.startswith('put')
+                   for k, v in calls.items() if v)
+
+
+@pytest.mark.parametrize('num_dists', [1, 10])
+def test_publish_package(benchmark, storage, tmp_path, num_dists):
+    # The release is published to a package with the (smallest) seeded
+    # number of existing artifacts
+    seed_package(storage, 'abc', SIZES[0], with_files=True)
+    versions = itertools.count(SIZES[0])
+
+    def setup():
+        # Every round publishes a new release
+        version = '0.{0}.0'.format(next(versions))
+        dist_dir = tmp_path / version / 'dist'
+        dist_dir.mkdir(parents=True)
+        for i in range(num_dists):
+            build = '' if i == 0 else '-{0}'.format(i)
+            path = dist_dir / 'abc-{0}{1}-py3-none-any.whl'.format(version, build)
+            with zipfile.ZipFile(str(path), 'w') as zf:
+                zf.writestr('abc-{0}.dist-info/METADATA'.format(version),
+                            'Metadata-Version: 2.1\nName: abc\nVersion: {0}\n'.format(version))
+        return (version, str(tmp_path / version)), {}
+
+    def publish(version, project_path):
+        publish_package('abc', version, storage, project_path, 'dist')
+
+    with count_calls(storage) as calls:
+        args, _ = setup()
+        publish(*args)
+    expected = PUBLISH_PACKAGE_CALLS[backend(storage)](num_dists)
+    assert record(benchmark, calls) == dict((k, v) for k, v in expected.items() if v)
+
+    benchmark.pedantic(publish, setup=setup, rounds=10, warmup_rounds=1)
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_build_index(benchmark, size):
+    items = [manifest_entry(dist_filename('abc', i), '0' * 64, '>=3.6')
+             for i in range(size)]
+    index = benchmark(build_index, 'Links for abc', items, 'pkg')
+    assert index.count('<a href=') == size
@@ -0,0 +1,87 @@
+"""Benchmarks of listing large S3 prefixes (backed by moto)
+
+Run with,
+
+    $ make bench
+
+Set PP_BENCH_LARGE=1 to include the larger prefixes.
+"""
+
+import os
+
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+moto = pytest.importorskip('moto')
+
+import boto3
+
+import pypiprivate.s3 as s3
+
+from conftest import s3_api_calls
+
+
+SIZES = [1000]
+if os.environ.get('PP_BENCH_LARGE'):
+    SIZES += [10000]
+
+BUCKET = 'bench'
+
+
+def legacy_listdir(storage, path):
+    """The listdir implementation prior to ListObjectsV2, for comparison
+
+    Every `search` walks the paginator again, so each page is fetched
+    twice.
+    """
+    s3_prefix = storage.dir_prefix(path)
+    paginator = storage.client.get_paginator('list_objects')
+    response = paginator.paginate(Bucket=storage.bucket,
+                                  Prefix=s3_prefix,
+                                  Delimiter='/')
+    file_objs = [c for c in response.search('Contents') if c]
+    dir_objs = [cp for cp in response.search('CommonPrefixes') if cp]
+    files = (c['Key'][len(s3_prefix):] for c in file_objs)
+    files = [f for f in files if f != '']
+    dirs = [cp['Prefix'][len(s3_prefix):].rstrip('/') for cp in dir_objs]
+    return files + dirs
+
+
+@pytest.fixture(scope='module', params=SIZES)
+def storage(request):
+    size = request.param
+    with moto.mock_aws():
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        client = boto3.client('s3')
+        client.create_bucket(Bucket=BUCKET)
+        for i in range(size):
+            client.put_object(Bucket=BUCKET,
+                              Key='simple/abc/abc-0.{0}.0.tar.gz'.format(i),
+                              Body=b'')
+        storage = s3.AWSS3Storage(BUCKET, 'private', prefix='simple')
+        storage.size = size
+        yield storage
+
+
+def count_calls(storage, operation, fn, *args):
+    with s3_api_calls(storage) as calls:
+        fn(*args)
+    return calls[operation]
+
+
+def test_listdir(benchmark, storage):
+    # One request per page of (upto) 1000 keys
+    pages = -(-storage.size // 1000)
+    assert count_calls(storage, 'ListObjectsV2',
+                       storage.listdir, 'abc') == pages
+    names = benchmark(storage.listdir, 'abc')
+    assert len(names) == storage.size
+
+
+def test_legacy_listdir(benchmark, storage):
+    # Every page is fetched twice
+    pages = -(-storage.size // 1000)
+    assert count_calls(storage, 'ListObjects',
+                       legacy_listdir, storage, 'abc') == 2 * pages
+    names = benchmark(legacy_listdir, storage, 'abc')
+    assert len(names) == storage.size
@@ -0,0 +1,483 @@
+import os
+import sys
+import asyncio
+import hashlib
+import logging
+import posixpath
+import functools
+from importlib.util import find_spec
+
+from packaging.version import Version
+
+from .storage import (PathNotFound, COMPRESS_ENCODINGS, compress,
+                      decompress, guess_content_type)
+from .publish import (DistNotFound, find_pkg_dists, file_sha256,
+                      dist_path, record_upload, get_published_digest,
+                      check_dist_digest, plan_existence_check,
+                      update_pkg_index)
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncStorage(object):
+    """Async interface to `storage`
+
+    Exposes coroutine counterparts of the methods of `Storage` prefixed
+    with 'a', eg. `alistdir`. This implementation runs the blocking
+    methods of the storage in the `executor` (the default executor of
+    the event loop if None) and works with every backend. Subclasses
+    provide native implementations for specific backends (see
+    `get_async_storage`).
+
+    Can be used as an async context manager which closes it on exit.
+    """
+
+    def __init__(self, storage, executor=None):
+        self.storage = storage
+        self.executor = executor
+        self._open_lock = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
+
+    async def open(self):
+        pass
+
+    @property
+    def open_lock(self):
+        # Serializes the concurrent calls to `open` (by the operations
+        # gathered on first use) so that only one client is created.
+        # It's created lazily to be bound to the running loop.
+        if self._open_lock is None:
+            self._open_lock = asyncio.Lock()
+        return self._open_lock
+
+    async def aclose(self):
+        pass
+
+    @property
+    def supports_batch_exists(self):
+        return self.storage.supports_batch_exists
+
+    def join_path(self, *args):
+        return self.storage.join_path(*args)
+
+    async def run(self, func, *args, **kwargs):
+        """Runs the blocking func in the executor"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor,
+                                          functools.partial(func, *args, **kwargs))
+
+    async def alistdir(self, path):
+        return await self.run(self.storage.listdir, path)
+
+    async def apath_exists(self, path):
+        return await self.run(self.storage.path_exists, path)
+
+    async def apaths_exist(self, paths):
+        """Async version of `Storage.paths_exist`
+
+        The parent dirs (or the individual paths if the storage doesn't
+        support batch existence checks) are checked concurrently.
+        """
+        if not self.supports_batch_exists:
+            results = await asyncio.gather(*[self.apath_exists(p) for p in paths])
+            return dict(zip(paths, results))
+
+        async def _listdir(parent):
+            try:
+                return set(await self.alistdir(parent or '.'))
+            except PathNotFound:
+                return set()
+
+        parents = []
+        for path in paths:
+            parent = posixpath.dirname(path)
+            if parent not in parents:
+                parents.append(parent)
+        listings = dict(zip(parents, await asyncio.gather(*[_listdir(p) for p in parents])))
+        result = {}
+        for path in paths:
+            parent, name = posixpath.split(path)
+            result[path] = name in listings[parent]
+        return result
+
+    async def aget_contents(self, path):
+        return await self.run(self.storage.get_contents, path)
+
+    async def aput_contents(self, contents, dest, sync=False, content_type=None,
+                            encoding=None):
+        return await self.run(self.storage.put_contents, contents, dest,
+                              sync=sync, content_type=content_type,
+                              encoding=encoding)
+
+    async def aput_file(self, src, dest, sync=False):
+        return await self.run(self.storage.put_file, src, dest, sync=sync)
+
+    async def aget_metadata(self, path):
+        return await self.run(self.storage.get_metadata, path)
+
+    def __repr__(self):
+        return '<{0}({1!r})>'.format(self.__class__.__name__, self.storage)
+
+
+class AsyncAWSS3Storage(AsyncStorage):
+    """Native async implementation for `AWSS3Storage` using aiobotocore
+
+    The client is created with the same config as that of the wrapped
+    storage. Files larger than the multipart threshold are uploaded by
+    the (blocking) transfer manager of boto3 in the executor as
+    aiobotocore doesn't provide one.
+    """
+
+    def __init__(self, storage, executor=None, client=None):
+        super(AsyncAWSS3Storage, self).__init__(storage, executor=executor)
+        self.client = client
+        self._client_context = None
+
+    async def open(self):
+        if self.client is not None:
+            return
+        async with self.open_lock:
+            if self.client is not None:
+                return
+            from aiobotocore.session import get_session
+            kwargs = {'config': self.storage.client_config}
+            if self.storage.endpoint is not None:
+                kwargs['endpoint_url'] = self.storage.endpoint
+            if self.storage.region is not None:
+                kwargs['region_name'] = self.storage.region
+            creds = self.storage.session.get_credentials()
+            if creds is not None:
+                creds = creds.get_frozen_credentials()
+                kwargs.update(aws_access_key_id=creds.access_key,
+                              aws_secret_access_key=creds.secret_key,
+                              aws_session_token=creds.token)
+            client_context = get_session().create_client('s3', **kwargs)
+            self.client = await client_context.__aenter__()
+            self._client_context = client_context
+
+    async def aclose(self):
+        if self._client_context is not None:
+            await self._client_context.__aexit__(None, None, None)
+            self._client_context = None
+            self.client = None
+
+    async def alistdir(self, path):
+        await self.open()
+        s3_prefix = self.storage.dir_prefix(path)
+        logger.debug('Listing objects prefixed with: {0}'.format(s3_prefix))
+        paginator = self.client.get_paginator('list_objects_v2')
+        files = []
+        dirs = []
+        async for page in paginator.paginate(Bucket=self.storage.bucket,
+                                             Prefix=s3_prefix,
+                                             Delimiter='/'):
+            files.extend(c['Key'][len(s3_prefix):] for c in page.get('Contents', []))
+            dirs.extend(cp['Prefix'][len(s3_prefix):].rstrip('/')
+                        for cp in page.get('CommonPrefixes', []))
+        # If no objs found, it means the path doesn't exist
+        if len(files) == len(dirs) == 0:
+            raise PathNotFound('Path {0} not found'.format(s3_prefix))
+        return [f for f in files if f != ''] + dirs
+
+    async def _head_object(self, path):
+        from botocore.exceptions import ClientError
+        await self.open()
+        try:
+            return await self.client.head_object(Bucket=self.storage.bucket,
+                                                 Key=path)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                raise PathNotFound('Path {0} not found'.format(path))
+            raise e
+
+    async def apath_exists(self, path):
+        path = self.storage.prefixed_path(path)
+        logger.debug('Checking if key exists: {0}'.format(path))
+        try:
+            await self._head_object(path)
+        except PathNotFound:
+            return False
+        return True
+
+    async def aget_contents(self, path):
+        from botocore.exceptions import ClientError
+        await self.open()
+        path = self.storage.prefixed_path(path)
+        logger.debug('Reading contents of key: {0}'.format(path))
+        try:
+            response = await self.client.get_object(Bucket=self.storage.bucket,
+                                                    Key=path)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                raise PathNotFound('Path {0} not found'.format(path))
+            raise e
+        async with response['Body'] as stream:
+            body = await stream.read()
+        if response.get('ContentEncoding') in COMPRESS_ENCODINGS:
+            body = decompress(body, response['ContentEncoding'])
+        return body.decode('utf-8')
+
+    async def _put_object(self, dest_path, body, content_type, sync=False,
+                          **kwargs):
+        await self.open()
+        response = await self.client.put_object(
+            **self.storage.put_object_args(dest_path, body, content_type,
+                                           **kwargs))
+        if sync:
+            await self.run(self.storage.wait_for_sync, dest_path, body, response)
+        return response
+
+    async def aput_contents(self, contents, dest, sync=False, content_type=None,
+                            encoding=None):
+        dest_path = self.storage.prefixed_path(dest)
+        logger.debug('Writing content to s3: {0}'.format(dest_path))
+        body = contents.encode('utf-8')
+        if encoding is not None:
+            body = compress(body, encoding)
+        await self._put_object(dest_path, body,
+                               content_type or guess_content_type(dest),
+                               sync=sync, encoding=encoding)
+
+    async def aput_file(self, src, dest, sync=False):
+        if os.path.getsize(src) >= self.storage.transfer_config.multipart_threshold:
+            return await super(AsyncAWSS3Storage, self).aput_file(src, dest,
+                                                                  sync=sync)
+        dest_path = self.storage.prefixed_path(dest)
+        logger.debug('Uploading file to s3: {0} -> {1}'.format(src, dest_path))
+        body = await self.run(_read_file, src)
+        digest = hashlib.sha256(body).hexdigest()
+        await self._put_object(dest_path, body, guess_content_type(dest),
+                               sync=sync, metadata={'sha256': digest},
+                               is_index=False)
+        return digest
+
+    async def aget_metadata(self, path):
+        path = self.storage.prefixed_path(path)
+        logger.debug('Reading metadata of key: {0}'.format(path))
+        response = await self._head_object(path)
+        return response.get('Metadata', {})
+
+
+class AsyncAzureBlobStorage(AsyncStorage):
+    """Native async implementation for `AzureBlobStorage` using
+    azure.storage.blob.aio (which requires aiohttp)
+    """
+
+    def __init__(self, storage, executor=None, container_client=None):
+        super(AsyncAzureBlobStorage, self).__init__(storage, executor=executor)
+        self.container_client = container_client
+        self._blob_service_client = None
+
+    async def open(self):
+        if self.container_client is not None:
+            return
+        async with self.open_lock:
+            if self.container_client is not None:
+                return
+            from azure.storage.blob.aio import BlobServiceClient
+            # The transport of the wrapped storage is blocking, so the
+            # async client uses its default one
+            kwargs = {k: v for k, v in self.storage._client_kwargs.items()
+                      if k != 'transport'}
+            self._blob_service_client = BlobServiceClient.from_connection_string(
+                self.storage._connection_string, **kwargs)
+            self.container_client = self._blob_service_client.get_container_client(
+                self.storage.container)
+
+    async def aclose(self):
+        if self._blob_service_client is not None:
+            await self._blob_service_client.close()
+            self._blob_service_client = None
+            self.container_client = None
+
+    async def alistdir(self, path):
+        await self.open()
+        prefix = self.storage.dir_prefix(path)
+        logger.debug('Listing blobs prefixed with: {0}'.format(prefix))
+        items = self.container_client.walk_blobs(name_starts_with=prefix,
+                                                 delimiter='/')
+        names = [item.name[len(prefix):].rstrip('/') async for item in items]
+        # If no blobs found, it means the path doesn't exist
+        if not names:
+            raise PathNotFound('Path {0} not found'.format(prefix))
+        return [n for n in names if n != '']
+
+    async def apath_exists(self, path):
+        await self.open()
+        path = self.storage.prefixed_path(path)
+        logger.debug('Checking if blob exists: {0}'.format(path))
+        return await self.container_client.get_blob_client(path).exists()
+
+    async def aget_contents(self, path):
+        from azure.core.exceptions import ResourceNotFoundError
+        await self.open()
+        path = self.storage.prefixed_path(path)
+        logger.debug('Reading contents of blob: {0}'.format(path))
+        try:
+            downloader = await self.container_client.download_blob(path)
+        except ResourceNotFoundError:
+            raise PathNotFound('Path {0} not found'.format(path))
+        body = await downloader.readall()
+        encoding = downloader.properties.content_settings.content_encoding
+        if encoding in COMPRESS_ENCODINGS:
+            body = decompress(body, encoding)
+        return body.decode('utf-8')
+
+    async def aput_contents(self, contents, dest, sync=False, content_type=None,
+                            encoding=None):
+        await self.open()
+        dest_path = self.storage.prefixed_path(dest)
+        logger.debug('Writing content to azure: {0}'.format(dest_path))
+        content_settings = self.storage.content_settings(dest, content_type,
+                                                         encoding)
+        data = contents.encode('utf-8')
+        if encoding is not None:
+            data = compress(data, encoding)
+        await self.container_client.upload_blob(name=dest_path, data=data,
+                                                overwrite=True,
+                                                content_settings=content_settings)
+
+    async def aput_file(self, src, dest, sync=False):
+        # Large files are uploaded in blocks by the (blocking) client of
+        # the wrapped storage in the executor, so that they needn't be
+        # held in memory
+        if os.path.getsize(src) >= self.storage.multipart_threshold:
+            return await super(AsyncAzureBlobStorage, self).aput_file(src, dest,
+                                                                      sync=sync)
+        await self.open()
+        dest_path = self.storage.prefixed_path(dest)
+        logger.debug('Writing content to azure: {0}'.format(dest_path))
+        content_settings = self.storage.content_settings(dest, is_index=False)
+        # Small files are read in memory (in the executor) as the SDK
+        # reads file objects synchronously which would block the loop
+        data = await self.run(_read_file, src)
+        digest = hashlib.sha256(data).hexdigest()
+        await self.container_client.upload_blob(name=dest_path, data=data,
+                                                overwrite=True,
+                                                content_settings=content_settings,
+                                                metadata={'sha256': digest})
+        return digest
+
+    async def aget_metadata(self, path):
+        from azure.core.exceptions import ResourceNotFoundError
+        await self.open()
+        path = self.storage.prefixed_path(path)
+        logger.debug('Reading metadata of blob: {0}'.format(path))
+        blob_client = self.container_client.get_blob_client(path)
+        try:
+            properties = await blob_client.get_blob_properties()
+        except ResourceNotFoundError:
+            raise PathNotFound('Path {0} not found'.format(path))
+        return dict(properties.metadata or {})
+
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+# Native async implementations by the module and name of the storage
+# class along with the package that they require
+NATIVE_BACKENDS = {
+    ('pypiprivate.s3', 'AWSS3Storage'): (AsyncAWSS3Storage, 'aiobotocore'),
+    ('pypiprivate.azure', 'AzureBlobStorage'): (AsyncAzureBlobStorage, 'aiohttp'),
+}
+
+
+def get_async_storage(storage, executor=None):
+    """Returns an AsyncStorage for the storage
+
+    The native implementation for the backend is used if available
+    and its dependencies are installed, else the blocking calls are
+    offloaded to the executor.
+    """
+    if isinstance(storage, AsyncStorage):
+        return storage
+    key = (type(storage).__module__, type(storage).__name__)
+    if key in NATIVE_BACKENDS:
+        async_cls, requirement = NATIVE_BACKENDS[key]
+        if requirement in sys.modules or find_spec(requirement) is not None:
+            return async_cls(storage, executor=executor)
+        logger.debug((
+            '{0} not installed: offloading storage calls to threads'
+        ).format(requirement))
+    return AsyncStorage(storage, executor=executor)
+
+
+async def afind_published_dists(storage, dists):
+    """Async version of `pypiprivate.publish.find_published_dists`"""
+    paths, batch = plan_existence_check(storage, dists)
+    if batch:
+        exists = await storage.apaths_exist(paths)
+    else:
+        results = await asyncio.gather(*[storage.apath_exists(p) for p in paths])
+        exists = dict(zip(paths, results))
+    return [d for d, p in zip(dists, paths) if exists[p]]
+
+
+async def aupload_dist(storage, dist):
+    """Async version of `pypiprivate.publish.upload_dist`"""
+    logger.info('Uploading dist: {0}'.format(dist['artifact']))
+    digest = await storage.aput_file(dist['path'], dist_path(storage, dist),
+                                     sync=True)
+    await storage.run(record_upload, dist, digest)
+
+
+async def averify_published_dist(storage, dist):
+    """Async version of `pypiprivate.publish.verify_published_dist`"""
+    metadata = await storage.aget_metadata(dist_path(storage, dist))
+    published_digest = get_published_digest(dist, metadata)
+    if published_digest is not None:
+        digest = await storage.run(file_sha256, dist['path'])
+        check_dist_digest(dist, published_digest, digest)
+
+
+async def _gather_bounded(semaphore, func, storage, dists):
+    async def _run(dist):
+        async with semaphore:
+            await func(storage, dist)
+    await asyncio.gather(*[_run(d) for d in dists])
+
+
+async def async_publish_package(name, version, storage, project_path,
+                                dist_dir, jobs=4, semaphore=None):
+    """Async version of `pypiprivate.publish.publish_package`
+
+    `storage` may be a `Storage` or an `AsyncStorage`. At most `jobs`
+    dists are verified or uploaded concurrently. A `semaphore` may be
+    passed instead to bound the concurrency across multiple packages
+    being published at the same time. The indexes are updated after
+    all the uploads have completed (in the executor, as it's a small
+    number of requests which must happen in order).
+    """
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(max(jobs, 1))
+    if not isinstance(storage, AsyncStorage):
+        async with get_async_storage(storage) as astorage:
+            return await async_publish_package(name, version, astorage,
+                                               project_path, dist_dir,
+                                               semaphore=semaphore)
+    version = Version(version)
+    dists = find_pkg_dists(project_path, dist_dir, name, version)
+    if not dists:
+        raise DistNotFound((
+            'No package distribution found in path {0}'
+        ).format(dist_dir))
+    published = await afind_published_dists(storage, dists)
+    new_dists = [d for d in dists if d not in published]
+    await _gather_bounded(semaphore, averify_published_dist, storage, published)
+    for dist in published:
+        logger.debug((
+            'Dist already published: {0} [skipping]'
+        ).format(dist['artifact']))
+    await _gather_bounded(semaphore, aupload_dist, storage, new_dists)
+    logger.info('Updating index')
+    await storage.run(update_pkg_index, storage.storage,
+                      dists[0]['normalized_name'], new_dists, published)
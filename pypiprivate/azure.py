@@ -1,19 +1,54 @@
-import logging
 import os
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
-from azure.storage.blob import BlobServiceClient, ContentSettings
+import requests
+from requests.adapters import HTTPAdapter
+from azure.core import MatchConditions
+from azure.core.exceptions import (ResourceNotFoundError, ResourceExistsError,
+                                   ResourceModifiedError)
+from azure.core.pipeline.transport import RequestsTransport
+from azure.storage.blob import BlobServiceClient, BlobBlock, ContentSettings
 
-from pypiprivate.storage import Storage, guess_content_type
+from pypiprivate.storage import (Storage, PathNotFound, PreconditionFailed,
+                                 HashingReader,
+                                 guess_content_type, compress, decompress,
+                                 compress_chunks, validate_encoding,
+                                 COMPRESS_ENCODINGS, DIST_CACHE_CONTROL,
+                                 INDEX_CACHE_CONTROL,
+                                 parse_size, MULTIPART_THRESHOLD,
+                                 MULTIPART_CHUNKSIZE, MAX_CONCURRENCY,
+                                 MAX_POOL_CONNECTIONS, CONNECT_TIMEOUT,
+                                 READ_TIMEOUT)
 
 logger = logging.getLogger(__name__)
 
 
+def make_transport(max_pool_connections=MAX_POOL_CONNECTIONS,
+                   connect_timeout=CONNECT_TIMEOUT,
+                   read_timeout=READ_TIMEOUT):
+    """Returns a transport with a connection pool large enough to be
+    shared by all the threads uploading blocks concurrently (the
+    default pool of requests holds only 10 connections)
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max_pool_connections,
+                          pool_maxsize=max_pool_connections)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return RequestsTransport(session=session,
+                             connection_timeout=connect_timeout,
+                             read_timeout=read_timeout)
+
+
 class AzureBlobClientMixin(object):
 
-    def __init__(self, connection_string, container):
+    def __init__(self, connection_string, container, **client_kwargs):
         super().__init__()
         self._connection_string = connection_string
         self._container = container
+        self._client_kwargs = client_kwargs
         self._blob_service_client = None
         self._container_client = None
 
@@ -25,7 +60,8 @@ class AzureBlobClientMixin(object):
     def blob_service_client(self):
         if self._blob_service_client:
             return self._blob_service_client
-        self._blob_service_client = BlobServiceClient.from_connection_string(self._connection_string)
+        self._blob_service_client = BlobServiceClient.from_connection_string(self._connection_string,
+                                                                             **self._client_kwargs)
         return self._blob_service_client
 
     @property
@@ -41,9 +77,35 @@ class AzureBlobClientMixin(object):
 
 class AzureBlobStorage(Storage, AzureBlobClientMixin):
 
-    def __init__(self, connection_string, container, prefix=None):
-        super().__init__(connection_string, container)
+    supports_batch_exists = True
+    supports_conditional_put = True
+
+    def __init__(self, connection_string, container, prefix=None,
+                 multipart_threshold=MULTIPART_THRESHOLD,
+                 multipart_chunksize=MULTIPART_CHUNKSIZE,
+                 max_concurrency=MAX_CONCURRENCY, compress_indexes=None,
+                 dist_cache_control=DIST_CACHE_CONTROL,
+                 index_cache_control=INDEX_CACHE_CONTROL,
+                 max_pool_connections=MAX_POOL_CONNECTIONS,
+                 connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT):
+        # Blobs larger than max_single_put_size are uploaded as blocks
+        # of max_block_size which are staged (and retried)
+        # independently by max_concurrency workers
+        transport = make_transport(max_pool_connections=max_pool_connections,
+                                   connect_timeout=connect_timeout,
+                                   read_timeout=read_timeout)
+        super().__init__(connection_string, container,
+                         max_single_put_size=multipart_threshold,
+                         max_block_size=multipart_chunksize,
+                         transport=transport)
         self.prefix = prefix
+        self.multipart_threshold = multipart_threshold
+        self.multipart_chunksize = multipart_chunksize
+        self.max_concurrency = max_concurrency
+        self.compress_indexes = validate_encoding(compress_indexes)
+        self.dist_cache_control = dist_cache_control
+        self.index_cache_control = index_cache_control
 
     @classmethod
     def from_config(cls, config):
@@ -51,7 +113,32 @@ class AzureBlobStorage(Storage, AzureBlobClientMixin):
         container = storage_config['container']
         conn_str = config.env['PP_AZURE_CONN_STR']
         prefix = storage_config.get('prefix')
-        return cls(conn_str, container, prefix=prefix)
+        multipart_threshold = parse_size(storage_config.get('multipart_threshold',
+                                                            MULTIPART_THRESHOLD))
+        multipart_chunksize = parse_size(storage_config.get('multipart_chunksize',
+                                                            MULTIPART_CHUNKSIZE))
+        max_concurrency = int(storage_config.get('max_concurrency',
+                                                 MAX_CONCURRENCY))
+        compress_indexes = storage_config.get('compress_indexes')
+        dist_cache_control = storage_config.get('dist_cache_control',
+                                                DIST_CACHE_CONTROL)
+        index_cache_control = storage_config.get('index_cache_control',
+                                                 INDEX_CACHE_CONTROL)
+        max_pool_connections = int(storage_config.get('max_pool_connections',
+                                                      MAX_POOL_CONNECTIONS))
+        connect_timeout = float(storage_config.get('connect_timeout',
+                                                   CONNECT_TIMEOUT))
+        read_timeout = float(storage_config.get('read_timeout', READ_TIMEOUT))
+        return cls(conn_str, container, prefix=prefix,
+                   multipart_threshold=multipart_threshold,
+                   multipart_chunksize=multipart_chunksize,
+                   max_concurrency=max_concurrency,
+                   compress_indexes=compress_indexes,
+                   dist_cache_control=dist_cache_control,
+                   index_cache_control=index_cache_control,
+                   max_pool_connections=max_pool_connections,
+                   connect_timeout=connect_timeout,
+                   read_timeout=read_timeout)
 
     def join_path(self, *args):
         return '/'.join(args)
@@ -64,35 +151,197 @@ class AzureBlobStorage(Storage, AzureBlobClientMixin):
             parts.append(path)
         return self.join_path(*parts)
 
-    def listdir(self, path):
+    def dir_prefix(self, path):
         path = self.prefixed_path(path)
         if path != '' and not path.endswith('/'):
-            prefix = '{0}/'.format(path)
-        else:
-            prefix = path
-        logger.debug('Listing objects prefixed with: {0}'.format(prefix))
-        blobs = self.container_client.list_blobs(name_starts_with=prefix)
-        files = [b.name[len(prefix):] for b in blobs]
-        dirs = list({os.path.dirname(f) for f in files})
-        return files + dirs
+            return '{0}/'.format(path)
+        return path
+
+    def iter_dir(self, path):
+        """Yields the names of the blobs and virtual dirs under `path`
+
+        The listing is hierarchical (delimited by '/'), so the blobs in
+        the sub dirs are not enumerated, eg. listing the root returns
+        only the package dirs and the index files. Pages are fetched
+        lazily as the names are consumed. Raises `PathNotFound` once
+        the listing is exhausted if nothing was found under `path`.
+        """
+        prefix = self.dir_prefix(path)
+        logger.debug('Listing blobs prefixed with: {0}'.format(prefix))
+        items = self.container_client.walk_blobs(name_starts_with=prefix,
+                                                 delimiter='/')
+        found = False
+        for item in items:
+            found = True
+            # Virtual dirs (BlobPrefix) are named with the trailing
+            # delimiter
+            name = item.name[len(prefix):].rstrip('/')
+            if name != '':
+                yield name
+        if not found:
+            raise PathNotFound('Path {0} not found'.format(prefix))
+
+    def listdir(self, path):
+        return list(self.iter_dir(path))
 
     def path_exists(self, path):
         path = self.prefixed_path(path)
-        logger.debug('Checking if key exists: {0}'.format(path))
-        return bool(list(self.container_client.list_blobs(name_starts_with=path)))
+        logger.debug('Checking if blob exists: {0}'.format(path))
+        return self.container_client.get_blob_client(path).exists()
+
+    def content_settings(self, dest, content_type=None, encoding=None,
+                         is_index=True):
+        kwargs = {'content_type': content_type or guess_content_type(dest)}
+        if encoding is not None:
+            kwargs['content_encoding'] = encoding
+        cache_control = self.cache_control(is_index, encoding)
+        if cache_control is not None:
+            kwargs['cache_control'] = cache_control
+        return ContentSettings(**kwargs)
+
+    def get_contents(self, path):
+        return self.get_versioned_contents(path)[0]
 
-    def put_contents(self, contents, dest, sync=False):
+    def get_versioned_contents(self, path):
+        path = self.prefixed_path(path)
+        logger.debug('Reading contents of blob: {0}'.format(path))
+        try:
+            downloader = self.container_client.download_blob(path)
+        except ResourceNotFoundError:
+            raise PathNotFound('Path {0} not found'.format(path))
+        body = downloader.readall()
+        encoding = downloader.properties.content_settings.content_encoding
+        if encoding in COMPRESS_ENCODINGS:
+            body = decompress(body, encoding)
+        return body.decode('utf-8'), downloader.properties.etag
+
+    def put_contents_if_match(self, contents, dest, token, content_type=None,
+                              encoding=None):
+        dest_path = self.prefixed_path(dest)
+        logger.debug('Conditionally writing content to azure: {0}'.format(dest_path))
+        content_settings = self.content_settings(dest, content_type, encoding)
+        data = contents.encode('utf-8')
+        if encoding is not None:
+            data = compress(data, encoding)
+        if token is None:
+            # Fails if the blob exists
+            kwargs = {'overwrite': False}
+        else:
+            kwargs = {'overwrite': True,
+                      'etag': token,
+                      'match_condition': MatchConditions.IfNotModified}
+        try:
+            response = self.container_client.upload_blob(name=dest_path, data=data,
+                                                         content_settings=content_settings,
+                                                         **kwargs)
+        except (ResourceExistsError, ResourceModifiedError):
+            raise PreconditionFailed((
+                'Blob {0} was modified: expected version {1}'
+            ).format(dest_path, token))
+        except ResourceNotFoundError as e:
+            # Only the blob that was read (at token) having been
+            # deleted since is a conflict. Anything else (eg. a
+            # missing container) is an error.
+            if token is None or getattr(e, 'error_code', None) != 'BlobNotFound':
+                raise e
+            raise PreconditionFailed((
+                'Blob {0} was deleted: expected version {1}'
+            ).format(dest_path, token))
+        return response['etag']
+
+    def put_contents(self, contents, dest, sync=False, content_type=None,
+                     encoding=None):
         dest_path = self.prefixed_path(dest)
         logger.debug('Writing content to azure: {0}'.format(dest_path))
-        content_settings = ContentSettings(content_type=guess_content_type(dest))
-        self.container_client.upload_blob(name=dest_path, data=contents.encode('utf-8'),
+        content_settings = self.content_settings(dest, content_type, encoding)
+        data = contents.encode('utf-8')
+        if encoding is not None:
+            data = compress(data, encoding)
+        self.container_client.upload_blob(name=dest_path, data=data,
                                           overwrite=True, content_settings=content_settings)
 
+    def put_stream(self, chunks, dest, sync=False, content_type=None,
+                   encoding=None):
+        dest_path = self.prefixed_path(dest)
+        logger.debug('Streaming content to azure: {0}'.format(dest_path))
+        content_settings = self.content_settings(dest, content_type, encoding)
+        if encoding is not None:
+            chunks = compress_chunks(chunks, encoding)
+        # An iterable is uploaded in blocks by the SDK, without
+        # building the full body in memory
+        self.container_client.upload_blob(name=dest_path, data=chunks,
+                                          overwrite=True, content_settings=content_settings,
+                                          max_concurrency=self.max_concurrency)
+
+    def stage_blocks(self, blob_client, f):
+        """Stages the contents of the file object as blocks of
+        `multipart_chunksize`, upto `max_concurrency` at a time, and
+        returns the ids of the blocks in order
+        """
+        block_ids = []
+        pending = set()
+        with ThreadPoolExecutor(max_workers=max(self.max_concurrency, 1)) as executor:
+            for chunk in iter(lambda: f.read(self.multipart_chunksize), b''):
+                # The ids of all the blocks of a blob must be of the
+                # same length
+                block_id = '{0:08d}'.format(len(block_ids))
+                block_ids.append(block_id)
+                if len(pending) >= self.max_concurrency:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                pending.add(executor.submit(blob_client.stage_block,
+                                            block_id, chunk))
+            for future in wait(pending).done:
+                future.result()
+        return block_ids
+
     def put_file(self, src, dest, sync=False):
         dest_path = self.prefixed_path(dest)
         logger.debug('Writing content to azure: {0}'.format(dest_path))
-        content_settings = ContentSettings(content_type=guess_content_type(dest))
-        with open(src, "rb") as data:
+        content_settings = self.content_settings(dest, is_index=False)
+        if os.path.getsize(src) < self.multipart_threshold:
+            with open(src, 'rb') as f:
+                data = f.read()
+            digest = hashlib.sha256(data).hexdigest()
             self.container_client.upload_blob(name=dest_path, data=data,
-                                              overwrite=True, content_settings=content_settings)
+                                              overwrite=True, content_settings=content_settings,
+                                              metadata={'sha256': digest})
+            return digest
+        # Large files are staged as blocks while computing the digest,
+        # which is then set as metadata when the blocks are committed
+        blob_client = self.container_client.get_blob_client(dest_path)
+        with open(src, 'rb') as f:
+            reader = HashingReader(f)
+            block_ids = self.stage_blocks(blob_client, reader)
+        digest = reader.hexdigest()
+        blob_client.commit_block_list([BlobBlock(block_id=b) for b in block_ids],
+                                      content_settings=content_settings,
+                                      metadata={'sha256': digest})
+        return digest
+
+    def get_metadata(self, path):
+        path = self.prefixed_path(path)
+        logger.debug('Reading metadata of blob: {0}'.format(path))
+        blob_client = self.container_client.get_blob_client(path)
+        try:
+            properties = blob_client.get_blob_properties()
+        except ResourceNotFoundError:
+            raise PathNotFound('Path {0} not found'.format(path))
+        return dict(properties.metadata or {})
+
+    def path_token(self, path):
+        path = self.prefixed_path(path)
+        blob_client = self.container_client.get_blob_client(path)
+        try:
+            properties = blob_client.get_blob_properties()
+        except ResourceNotFoundError:
+            return None
+        return properties.etag
 
+    def __repr__(self):
+        account = dict(p.split('=', 1) for p in self._connection_string.split(';')
+                       if '=' in p).get('AccountName')
+        return (
+            '<AzureBlobStorage(account="{0}", container="{1}", prefix="{2}")>'
+        ).format(account, self.container, self.prefix)
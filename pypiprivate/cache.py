@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import posixpath
+from contextlib import contextmanager
+
+from .storage import Storage, PathNotFound
+
+
+logger = logging.getLogger(__name__)
+
+
+# Default location of the listing cache
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', '~/.cache'),
+                         'pypiprivate')
+CACHE_FILE = 'listings.sqlite'
+
+# Max number of listings kept in the cache. The least recently used
+# ones are evicted beyond it.
+CACHE_MAX_ENTRIES = 1000
+
+# File in every dir whose version (token) is used to validate the
+# cached listing of the dir. The index is rewritten whenever a file is
+# added to the dir, so an unchanged index means an unchanged listing.
+VALIDATOR_FILE = 'index.html'
+
+
+class ListingCache(object):
+    """On-disk (sqlite) cache of dir listings
+
+    Every listing is stored along with the token (eg. ETag) of the
+    validator file at the time of listing and is returned only if the
+    token still matches. The cache is bounded to `max_entries`
+    listings with the least recently used ones evicted first.
+    """
+
+    def __init__(self, path=None, max_entries=CACHE_MAX_ENTRIES):
+        if path is None:
+            path = os.path.join(CACHE_DIR, CACHE_FILE)
+        self.path = os.path.expanduser(path)
+        self.max_entries = max_entries
+        cache_dir = os.path.dirname(self.path)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        with self.transaction() as conn:
+            conn.execute((
+                'CREATE TABLE IF NOT EXISTS listings ('
+                'key TEXT PRIMARY KEY, token TEXT NOT NULL, '
+                'entries TEXT NOT NULL, accessed REAL NOT NULL)'
+            ))
+
+    @classmethod
+    def from_config(cls, config):
+        cache_config = config.cache_config
+        return cls(path=cache_config.get('path'),
+                   max_entries=int(cache_config.get('max_entries',
+                                                    CACHE_MAX_ENTRIES)))
+
+    @contextmanager
+    def transaction(self):
+        # A new connection is used for every operation as the cache
+        # is accessed from multiple threads (and processes)
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key, token):
+        with self.transaction() as conn:
+            row = conn.execute('SELECT token, entries FROM listings WHERE key = ?',
+                               (key,)).fetchone()
+            if row is None or row[0] != token:
+                return None
+            conn.execute('UPDATE listings SET accessed = ? WHERE key = ?',
+                         (time.time(), key))
+        return json.loads(row[1])
+
+    def put(self, key, token, entries):
+        with self.transaction() as conn:
+            conn.execute(('INSERT OR REPLACE INTO listings '
+                          '(key, token, entries, accessed) VALUES (?, ?, ?, ?)'),
+                         (key, token, json.dumps(entries), time.time()))
+            conn.execute(('DELETE FROM listings WHERE key NOT IN '
+                          '(SELECT key FROM listings ORDER BY accessed DESC LIMIT ?)'),
+                         (self.max_entries,))
+
+    def __len__(self):
+        with self.transaction() as conn:
+            return conn.execute('SELECT COUNT(*) FROM listings').fetchone()[0]
+
+
+class CachedStorage(object):
+    """Proxy to `storage` that serves `listdir` from the `cache` when
+    the validator file of the dir is unchanged
+
+    Validating a cached listing costs a single HEAD (or stat) instead
+    of a (paginated) listing. Dirs without the validator file, and
+    backends that can't provide its token, are always listed.
+    `paths_exist` trusts a cached listing only when all the paths in
+    the dir are found in it, so a republish costs a single HEAD. The
+    listings are keyed by the repr of the storage, which is expected
+    to identify its location (eg. bucket and prefix).
+    """
+
+    def __init__(self, storage, cache, validator=VALIDATOR_FILE):
+        self.storage = storage
+        self.cache = cache
+        self.validator = validator
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def cache_key(self, path):
+        return '{0!r}:{1}'.format(self.storage, path)
+
+    def cached_listdir(self, path):
+        """Returns the listing of the dir and whether it was found in
+        the cache
+        """
+        if path in ('', '.'):
+            validator = self.validator
+        else:
+            validator = self.storage.join_path(path, self.validator)
+        token = self.storage.path_token(validator)
+        if token is None:
+            return self.storage.listdir(path), False
+        key = self.cache_key(path)
+        entries = self.cache.get(key, token)
+        if entries is not None:
+            logger.debug('Listing of {0} found in cache'.format(path))
+            return entries, True
+        entries = self.storage.listdir(path)
+        self.cache.put(key, token, entries)
+        return entries, False
+
+    def listdir(self, path):
+        return self.cached_listdir(path)[0]
+
+    def paths_exist(self, paths):
+        if (not self.storage.supports_batch_exists or
+                type(self.storage).paths_exist is not Storage.paths_exist):
+            # Existence is checked without listings (eg. stat calls on
+            # the local filesystem)
+            return self.storage.paths_exist(paths)
+        names = {}
+        for path in paths:
+            parent, name = posixpath.split(path)
+            names.setdefault(parent or '.', set()).add(name)
+        listings = {}
+        for parent in names:
+            try:
+                entries, cached = self.cached_listdir(parent)
+            except PathNotFound:
+                entries, cached = [], False
+            if cached and not names[parent].issubset(entries):
+                # A cached listing misses the files uploaded without
+                # the index being rewritten (eg. by a publish that
+                # failed midway). As the absent paths are then written
+                # without any checks, they're confirmed by listing the
+                # storage itself.
+                logger.debug((
+                    'Confirming absent paths in {0} without the cache'
+                ).format(parent))
+                entries = self.storage.listdir(parent)
+            listings[parent] = set(entries)
+        return dict((path, posixpath.basename(path) in
+                     listings[posixpath.dirname(path) or '.'])
+                    for path in paths)
+
+    def __repr__(self):
+        return '<CachedStorage({0!r})>'.format(self.storage)
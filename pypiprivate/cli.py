@@ -1,11 +1,13 @@
 import os
 import argparse
 import logging
+from contextlib import contextmanager
 
 from . import __version__
 from .config import Config
-from .storage import load_storage
-from .publish import publish_package
+from .storage import load_storage, parse_bool
+from .publish import (publish_package, publish_packages, read_releases,
+                      reindex_repository)
 
 
 logger = logging.getLogger(__name__)
@@ -22,14 +24,74 @@ def log_level(verbosity):
     return logging.WARN
 
 
+def load_cached_storage(config, args):
+    """Loads the storage with the listing cache if it's enabled in the
+    config and not disabled using --no-cache
+    """
+    storage = load_storage(config)
+    enabled = parse_bool(config.cache_config.get('enabled', False))
+    if not enabled or args.no_cache:
+        return storage
+    from .cache import ListingCache, CachedStorage
+    return CachedStorage(storage, ListingCache.from_config(config))
+
+
+@contextmanager
+def instrumented(storage, config, args):
+    """Yields the storage instrumented to collect the stats of the
+    storage operations if --stats is passed or any sinks are
+    configured in the [stats] section of the config
+
+    At the end (even if the command fails), the stats are flushed to
+    the sinks and with --stats, a breakdown is printed.
+    """
+    if not args.stats and not config.stats_config:
+        yield storage
+        return
+    from .stats import StatsCollector, InstrumentedStorage, load_sinks
+    collector = StatsCollector(load_sinks(config))
+    try:
+        yield InstrumentedStorage(storage, collector)
+    finally:
+        collector.flush()
+        if args.stats:
+            print(collector.report())
+
+
 def cmd_publish(args):
+    config = Config(args.conf_path, os.environ, args.env_interpolation)
+    storage = load_cached_storage(config, args)
+    with instrumented(storage, config, args) as storage:
+        return publish_package(args.pkg_name,
+                               args.pkg_ver,
+                               storage,
+                               args.project_path,
+                               args.dist_dir,
+                               jobs=args.jobs)
+
+
+def cmd_publish_many(args):
+    if not args.manifest and not args.dist_dirs:
+        raise ValueError('Either a manifest or dist dirs must be specified')
+    releases = read_releases(args.manifest) if args.manifest else None
+    dist_dirs = [os.path.join(args.project_path, d) for d in args.dist_dirs]
+    config = Config(args.conf_path, os.environ, args.env_interpolation)
+    storage = load_cached_storage(config, args)
+    with instrumented(storage, config, args) as storage:
+        return publish_packages(storage,
+                                releases=releases,
+                                dist_dirs=dist_dirs,
+                                dist_dir=args.dist_dir,
+                                jobs=args.jobs)
+
+
+def cmd_reindex(args):
     config = Config(args.conf_path, os.environ, args.env_interpolation)
     storage = load_storage(config)
-    return publish_package(args.pkg_name,
-                           args.pkg_ver,
-                           storage,
-                           args.project_path,
-                           args.dist_dir)
+    with instrumented(storage, config, args) as storage:
+        return reindex_repository(storage,
+                                  jobs=args.jobs,
+                                  only_changed=args.only_changed)
 
 
 def main():
@@ -51,10 +113,48 @@ def main():
     publish = subparsers.add_parser('publish', help='Publish package')
     publish.add_argument('-d', '--dist-dir', default='dist',
                          help='Directory to look for built distributions')
+    publish.add_argument('-j', '--jobs', default=1, type=int,
+                         help='Number of dists to publish concurrently')
+    publish.add_argument('--no-cache', action='store_true',
+                         help='Don\'t use the listing cache')
     publish.add_argument('pkg_name')
     publish.add_argument('pkg_ver')
+    publish.add_argument('--stats', action='store_true',
+                         help='Print the stats of the storage operations at the end')
     publish.set_defaults(func=cmd_publish)
 
+    publish_many = subparsers.add_parser('publish-many', help=(
+        'Publish multiple packages at once'
+    ))
+    publish_many.add_argument('-m', '--manifest', help=(
+        'File listing the releases to publish, one per line as '
+        '"<pkg_name> <pkg_ver> [<project_path>]"'
+    ))
+    publish_many.add_argument('-d', '--dist-dir', default='dist',
+                              help=('Directory of the projects in the '
+                                    'manifest to look for built distributions'))
+    publish_many.add_argument('-j', '--jobs', default=1, type=int,
+                              help='Number of dists to publish concurrently')
+    publish_many.add_argument('--no-cache', action='store_true',
+                              help='Don\'t use the listing cache')
+    publish_many.add_argument('dist_dirs', nargs='*', help=(
+        'Directories all distributions in which are to be published'
+    ))
+    publish_many.add_argument('--stats', action='store_true',
+                              help='Print the stats of the storage operations at the end')
+    publish_many.set_defaults(func=cmd_publish_many)
+
+    reindex = subparsers.add_parser('reindex', help=(
+        'Rebuild the indexes of all packages and the repository'
+    ))
+    reindex.add_argument('-j', '--jobs', default=1, type=int,
+                         help='Number of packages to reindex concurrently')
+    reindex.add_argument('--only-changed', action='store_true',
+                         help='Skip uploading indexes that are unchanged')
+    reindex.add_argument('--stats', action='store_true',
+                         help='Print the stats of the storage operations at the end')
+    reindex.set_defaults(func=cmd_reindex)
+
     args = parser.parse_args()
 
     logging.basicConfig(format=LOGGING_FORMAT)
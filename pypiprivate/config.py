@@ -25,3 +25,15 @@ class Config(object):
     @property
     def storage_config(self):
         return dict(self.c.items(self.storage))
+
+    @property
+    def cache_config(self):
+        if not self.c.has_section('cache'):
+            return {}
+        return dict(self.c.items('cache'))
+
+    @property
+    def stats_config(self):
+        if not self.c.has_section('stats'):
+            return {}
+        return dict(self.c.items('stats'))
@@ -1,19 +1,55 @@
 import os
 import re
+import json
+import time
+import random
 import logging
+import tarfile
+import zipfile
+from collections import namedtuple
+from email.parser import HeaderParser
+from concurrent.futures import ThreadPoolExecutor
 
-from pkg_resources import packaging
-from jinja2 import Environment
+from packaging.version import Version, InvalidVersion
+
+from .storage import (PathNotFound, PreconditionFailed, ENCODING_EXTS,
+                      file_sha256)
 
 
 logger = logging.getLogger(__name__)
 
 INDEX_HTML = 'index.html'
+INDEX_JSON = 'index.json'
+MANIFEST_JSON = 'manifest.json'
+
+# Content type of the JSON based Simple API as per PEP 691
+SIMPLE_JSON_CONTENT_TYPE = 'application/vnd.pypi.simple.v1+json'
+
+# Files generated by pypiprivate which are not to be listed in the
+# indexes
+INDEX_FILES = (INDEX_HTML, INDEX_JSON, MANIFEST_JSON)
+
+# Extensions of the pre-compressed copies of the index files
+COMPRESSED_EXTS = tuple('.{0}'.format(e) for e in ENCODING_EXTS.values())
+
+# Extensions of the sdists that are recognized when scanning dist dirs
+SDIST_EXTS = ('.tar.gz', '.tar.bz2', '.tar.xz', '.zip')
+
+# Max number of attempts at updating a manifest that's concurrently
+# updated by other publishers and the max delay (in seconds, growing
+# with every attempt) before retrying
+MAX_UPDATE_ATTEMPTS = 10
+UPDATE_RETRY_DELAY = 0.2
+
 
 class DistNotFound(Exception):
     pass
 
 
+class DistMismatch(Exception):
+    pass
+
+
 def normalized_name(name):
     """Convert the project name to normalized form as per PEP-0503
 
@@ -22,31 +58,162 @@ def normalized_name(name):
     return re.sub(r"[-_.]+", "-", name).lower()
 
 
+DistFile = namedtuple('DistFile', ['filename', 'path', 'name', 'version',
+                                   'tags'])
+DistFile.__doc__ = """A wheel or sdist file
+
+`tags` is the (build, python, abi, platform) tuple of a wheel and
+None for sdists.
+"""
+
+
+def version_key(version):
+    """Returns the normalized form of the version (as per PEP 440) that
+    dists are indexed by. Invalid (legacy) versions are used as is.
+    """
+    try:
+        return str(Version(str(version)))
+    except InvalidVersion:
+        return str(version)
+
+
+def _sdist_name_versions(stem):
+    """Returns all the possible (name, version) splits of the file name
+    of an sdist without the extension, ie. the ones that result in a
+    valid version
+    """
+    parts = stem.split('-')
+    result = []
+    for i in range(1, len(parts)):
+        version = '-'.join(parts[i:])
+        try:
+            Version(version)
+        except InvalidVersion:
+            continue
+        result.append(('-'.join(parts[:i]), version))
+    return result
+
+
+def parse_dist_filename(filename):
+    """Parses the (name, version, tags) of the package from the file
+    name of a wheel or sdist
+
+    Returns None if the file is not a dist or if the name and version
+    of an sdist can't be told apart from its file name alone.
+    """
+    if filename.endswith('.whl'):
+        parts = filename[:-len('.whl')].split('-')
+        if len(parts) == 5:
+            return parts[0], parts[1], (None,) + tuple(parts[2:])
+        if len(parts) == 6:
+            return parts[0], parts[1], tuple(parts[2:])
+        return None
+    for ext in SDIST_EXTS:
+        if filename.endswith(ext):
+            candidates = _sdist_name_versions(filename[:-len(ext)])
+            if len(candidates) == 1:
+                name, version = candidates[0]
+                return name, version, None
+            return None
+    return None
+
+
+def is_dist_filename(filename):
+    return filename.endswith(('.whl',) + SDIST_EXTS)
+
+
+class DistIndex(object):
+    """Index of the dists found in a dir by their normalized name and
+    version
+
+    The dir is scanned only once irrespective of the number of
+    packages looked up in it, so publishing many packages from a
+    shared dist dir doesn't cost a listing (and matching all files)
+    per package.
+    """
+
+    def __init__(self, dists=()):
+        self._index = {}
+        for dist in dists:
+            self.add(dist)
+
+    @classmethod
+    def scan(cls, dist_dir):
+        """Builds the index using a single pass over the dist_dir
+
+        The names and versions are parsed from the file names. The
+        core metadata of the dist is read only if they are ambiguous
+        (eg. sdists with non PEP 440 versions).
+        """
+        logger.info('Looking for package dists in {0}'.format(dist_dir))
+        index = cls()
+        with os.scandir(dist_dir) as entries:
+            for entry in entries:
+                if not is_dist_filename(entry.name) or not entry.is_file():
+                    continue
+                parsed = parse_dist_filename(entry.name)
+                if parsed is None:
+                    parsed = _parse_dist_metadata(entry.path)
+                if parsed is None:
+                    logger.warning((
+                        'Could not determine the name and version of {0} [skipping]'
+                    ).format(entry.path))
+                    continue
+                name, version, tags = parsed
+                index.add(DistFile(entry.name, entry.path, name, version, tags))
+        return index
+
+    def add(self, dist):
+        key = (normalized_name(dist.name), version_key(dist.version))
+        self._index.setdefault(key, []).append(dist)
+
+    def find(self, pkg_name, pkg_ver):
+        """Returns the dists of the package version sorted by file name"""
+        key = (normalized_name(pkg_name), version_key(pkg_ver))
+        return sorted(self._index.get(key, []), key=lambda d: d.filename)
+
+    def __iter__(self):
+        for key in sorted(self._index):
+            for dist in self.find(*key):
+                yield dist
+
+
+def _parse_dist_metadata(path):
+    metadata = read_dist_metadata(path)
+    if metadata is None or not metadata.get('Name') or not metadata.get('Version'):
+        return None
+    return metadata['Name'], metadata['Version'], None
+
+
 def _filter_pkg_dists(dists, pkg_name, pkg_ver):
     # Wheels have different naming conventions: https://www.python.org/dev/peps/pep-0491/#escaping-and-unicode
-    # We want to account for both sdist and wheel naming.
-    wheel_name = re.sub(r"[^\w\d.]+", "_", pkg_name, re.UNICODE)
-    pkg_name_candidates = (pkg_name, wheel_name)
-    pkg_ver = re.escape(str(pkg_ver))
-    name_re_alternation = '|'.join((re.escape(candidate) for candidate in pkg_name_candidates))
-    regexp = re.compile(r'({0})-{1}[.-]'.format(name_re_alternation, pkg_ver))
-    return filter(regexp.match, dists)
+    # The names are compared in normalized form to account for both
+    # sdist and wheel naming.
+    index = DistIndex(DistFile(f, f, *parsed) for f, parsed in
+                      ((f, parse_dist_filename(f)) for f in dists)
+                      if parsed is not None)
+    found = set(d.filename for d in index.find(pkg_name, pkg_ver))
+    return [f for f in dists if f in found]
+
 
+def find_pkg_dists(project_path, dist_dir, pkg_name, pkg_ver, index=None):
+    """Returns the dists of the package version in the dist_dir
 
-def find_pkg_dists(project_path, dist_dir, pkg_name, pkg_ver):
+    An already built DistIndex of the dist_dir may be passed to avoid
+    scanning it again.
+    """
     dist_dir = os.path.join(project_path, dist_dir)
-    logger.info('Looking for package dists in {0}'.format(dist_dir))
-    dists = _filter_pkg_dists(os.listdir(dist_dir), pkg_name, pkg_ver)
+    if index is None:
+        index = DistIndex.scan(dist_dir)
     dists = [{'pkg': pkg_name,
               'normalized_name': normalized_name(pkg_name),
-              'artifact': f,
-              'path': os.path.join(dist_dir, f)}
-             for f in dists]
+              'artifact': d.filename,
+              'path': d.path}
+             for d in index.find(pkg_name, pkg_ver)]
     return dists
 
 
-def build_index(title, items, index_type='root'):
-    tmpl = """<!DOCTYPE html>
+INDEX_TEMPLATE = """<!DOCTYPE html>
 <html>
 <head>
     <meta charset="UTF-8">
@@ -57,67 +224,748 @@ def build_index(title, items, index_type='root'):
     <h1>{{title}}</h1>
     {% endif -%}
     {% for item in items %}
+    {%- if item is mapping %}
+    <a href="{{item.filename}}{% if item.sha256 %}#sha256={{item.sha256}}{% endif %}"
+       {%- if item.requires_python %} data-requires-python="{{item.requires_python}}"{% endif %}>{{item.filename}}</a><br>
+    {%- else %}
     <a href="{{item}}">{{item}}</a><br>
+    {%- endif %}
     {% endfor %}
 </body>
 </html>
 """
-    env = Environment(autoescape=True)
-    template = env.from_string(tmpl)
+
+# Size of the encoded chunks in which indexes are streamed to storage
+INDEX_CHUNK_SIZE = 64 * 1024
+
+_index_template = None
+
+
+def get_index_template():
+    """Returns the compiled index template
+
+    The template is compiled only once and reused for all the indexes
+    built by the process.
+    """
+    global _index_template
+    if _index_template is None:
+        # Imported here as it's not needed by the commands that don't
+        # build any index
+        from jinja2 import Environment
+        env = Environment(autoescape=True)
+        _index_template = env.from_string(INDEX_TEMPLATE)
+    return _index_template
+
+
+def build_index(title, items, index_type='root'):
+    template = get_index_template()
     return template.render(title=title, items=items,
                            index_type=index_type)
 
 
+def stream_index(title, items, index_type='root',
+                 chunk_size=INDEX_CHUNK_SIZE):
+    """Renders the index incrementally as utf-8 encoded chunks
+
+    Unlike `build_index`, the full page is never held in memory at
+    once which makes it suitable for indexes with a large number of
+    items.
+    """
+    template = get_index_template()
+    buf = []
+    size = 0
+    for s in template.generate(title=title, items=items,
+                               index_type=index_type):
+        chunk = s.encode('utf-8')
+        buf.append(chunk)
+        size += len(chunk)
+        if size >= chunk_size:
+            yield b''.join(buf)
+            buf = []
+            size = 0
+    if buf:
+        yield b''.join(buf)
+
+
+def dist_path(storage, dist):
+    return storage.join_path(dist['normalized_name'], dist['artifact'])
+
+
 def is_dist_published(storage, dist):
-    path = storage.join_path(dist['normalized_name'], dist['artifact'])
+    path = dist_path(storage, dist)
     logger.info('Ensuring dist is not already published: {0}'.format(path))
     return storage.path_exists(path)
 
 
+def _read_metadata_file(path):
+    if path.endswith('.whl'):
+        with zipfile.ZipFile(path) as zf:
+            for name in zf.namelist():
+                parts = name.split('/')
+                if (len(parts) == 2 and parts[0].endswith('.dist-info')
+                        and parts[1] == 'METADATA'):
+                    return zf.read(name)
+    elif path.endswith('.zip'):
+        with zipfile.ZipFile(path) as zf:
+            for name in zf.namelist():
+                if name.count('/') == 1 and name.endswith('/PKG-INFO'):
+                    return zf.read(name)
+    elif path.endswith(('.tar.gz', '.tgz', '.tar.bz2', '.tar.xz', '.tar')):
+        with tarfile.open(path) as tf:
+            # Members are read sequentially and PKG-INFO is usually
+            # among the first ones, so the archive is not decompressed
+            # entirely
+            for member in tf:
+                if (member.name.count('/') == 1
+                        and member.name.endswith('/PKG-INFO')):
+                    return tf.extractfile(member).read()
+    return None
+
+
+def read_dist_metadata(path):
+    """Returns the core metadata (METADATA of wheels and PKG-INFO of
+    sdists) of the dist as an email.message.Message or None if it
+    can't be found
+    """
+    try:
+        contents = _read_metadata_file(path)
+    except (zipfile.BadZipfile, tarfile.TarError, IOError) as e:
+        logger.warning('Could not read metadata of {0}: {1}'.format(path, e))
+        return None
+    if contents is None:
+        return None
+    return HeaderParser().parsestr(contents.decode('utf-8', 'replace'))
+
+
+def read_requires_python(path):
+    metadata = read_dist_metadata(path)
+    if metadata is None:
+        return None
+    return metadata.get('Requires-Python')
+
+
+# The following helpers are shared by the sync publish functions
+# below and their async versions in `pypiprivate.aio`, which only
+# differ in how the storage is called
+
+def record_upload(dist, digest):
+    """Records the details of the uploaded dist that go in its entry
+    in the package manifest
+    """
+    dist['sha256'] = digest
+    dist['requires_python'] = read_requires_python(dist['path'])
+
+
+def get_published_digest(dist, metadata):
+    """Returns the digest from the metadata of the published dist or
+    None (with a warning) if it was published without one
+    """
+    published_digest = metadata.get('sha256')
+    if published_digest is None:
+        logger.warning((
+            'Dist published without digest, can\'t verify: {0}'
+        ).format(dist['artifact']))
+    return published_digest
+
+
+def check_dist_digest(dist, published_digest, digest):
+    """Raises DistMismatch if the digest of the local dist differs
+    from the one of the published dist
+    """
+    if digest != published_digest:
+        raise DistMismatch((
+            'Dist already published with different contents: {0} '
+            '(published sha256: {1}, local sha256: {2})'
+        ).format(dist['artifact'], published_digest, digest))
+    dist['sha256'] = digest
+
+
+def plan_existence_check(storage, dists):
+    """Returns the paths of the dists in the storage and whether their
+    existence is to be checked using a single bulk check
+
+    A bulk check is used only if the storage `supports_batch_exists`.
+    A single dist is always checked on its own as that's cheaper than
+    listing the package dir.
+    """
+    paths = [dist_path(storage, d) for d in dists]
+    logger.info('Checking if dists are already published: {0}'.format(
+        ', '.join(d['artifact'] for d in dists)))
+    return paths, len(dists) > 1 and storage.supports_batch_exists
+
+
 def upload_dist(storage, dist):
     logger.info('Uploading dist: {0}'.format(dist['artifact']))
-    dest = storage.join_path(dist['normalized_name'], dist['artifact'])
-    storage.put_file(dist['path'], dest, sync=True)
+    # The digest is computed by the storage while reading the file for
+    # the upload
+    digest = storage.put_file(dist['path'], dist_path(storage, dist),
+                              sync=True)
+    record_upload(dist, digest)
 
 
-def update_pkg_index(storage, pkg_name):
-    logger.info('Updating index for package: {0}'.format(pkg_name))
-    dists = [d for d in storage.listdir(pkg_name) if d != INDEX_HTML]
+def verify_published_dist(storage, dist):
+    """Ensures that the published dist is identical to the local one
+
+    The SHA-256 digest of the local file is compared with the one
+    stored along with the published artifact. Raises DistMismatch if
+    they differ. Artifacts published before digests were stored
+    can't be verified and are skipped with a warning.
+    """
+    metadata = storage.get_metadata(dist_path(storage, dist))
+    published_digest = get_published_digest(dist, metadata)
+    if published_digest is not None:
+        check_dist_digest(dist, published_digest, file_sha256(dist['path']))
+
+
+def is_index_file(name):
+    """Checks whether the file is generated by pypiprivate"""
+    for ext in COMPRESSED_EXTS:
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+            break
+    return name in INDEX_FILES
+
+
+def load_manifest(storage, path):
+    """Returns the manifest stored at path or None if it doesn't exist"""
+    try:
+        contents = storage.get_contents(path)
+    except PathNotFound:
+        return None
+    return json.loads(contents)
+
+
+def load_versioned_manifest(storage, path):
+    """Returns a tuple of the manifest stored at path and the token of
+    its version or (None, None) if it doesn't exist
+    """
+    try:
+        contents, token = storage.get_versioned_contents(path)
+    except PathNotFound:
+        return None, None
+    return json.loads(contents), token
+
+
+def put_if_changed(storage, contents, path, **kwargs):
+    """Writes contents to path unless it already has identical contents
+    (stored in the same encoding)
+
+    Returns True if the contents were written. Any kwargs are passed
+    on to `storage.put_contents`.
+    """
+    try:
+        existing = storage.get_contents(path)
+    except PathNotFound:
+        existing = None
+    if (existing == contents and
+            storage.has_encoding(path, kwargs.get('encoding'))):
+        logger.debug('Contents unchanged: {0} [skipping]'.format(path))
+        return False
+    storage.put_contents(contents, path, **kwargs)
+    return True
+
+
+def dump_manifest(manifest):
+    return json.dumps(manifest, sort_keys=True, separators=(',', ':'))
+
+
+def save_manifest(storage, path, manifest, only_changed=False):
+    contents = dump_manifest(manifest)
+    if only_changed:
+        return put_if_changed(storage, contents, path)
+    storage.put_contents(contents, path)
+    return True
+
+
+def update_manifest(storage, path, merge, rebuild):
+    """Updates the manifest at path with the changes applied by `merge`
+
+    `merge` is called with the current manifest (or the one returned
+    by `rebuild` if there's none yet) and returns the updated manifest
+    or None if no update is required. Returns a tuple of the saved
+    manifest (None if not updated), the token of its version (None if
+    unknown) and whether it was rebuilt.
+
+    If the storage `supports_conditional_put`, the manifest is saved
+    only if it's unchanged since it was read. If another publisher
+    updated it in the meantime, it's read again and the changes are
+    merged into it, upto MAX_UPDATE_ATTEMPTS times with a random
+    (growing) delay in between. Otherwise it's simply overwritten, in
+    which case the changes made by concurrent publishers may be lost.
+    """
+    conditional = storage.supports_conditional_put
+    for attempt in range(1, MAX_UPDATE_ATTEMPTS + 1):
+        if conditional:
+            manifest, token = load_versioned_manifest(storage, path)
+        else:
+            manifest, token = load_manifest(storage, path), None
+        rebuilt = manifest is None
+        if rebuilt:
+            manifest = rebuild()
+        updated = merge(manifest)
+        if updated is None:
+            if not rebuilt:
+                return None, token, rebuilt
+            # A rebuilt manifest is saved even if nothing is merged
+            updated = manifest
+        if not conditional:
+            save_manifest(storage, path, updated)
+            return updated, None, rebuilt
+        try:
+            token = storage.put_contents_if_match(dump_manifest(updated),
+                                                  path, token)
+        except PreconditionFailed:
+            if attempt == MAX_UPDATE_ATTEMPTS:
+                raise
+            logger.info((
+                'Manifest {0} updated concurrently: retrying ({1}/{2})'
+            ).format(path, attempt, MAX_UPDATE_ATTEMPTS))
+            time.sleep(random.uniform(0, UPDATE_RETRY_DELAY * attempt))
+        else:
+            return updated, token, rebuilt
+
+
+def render_latest(storage, path, manifest, token, render):
+    """Renders the indexes from the manifest (saved at path with the
+    version `token`) using `render`
+
+    Concurrent publishers may render their indexes in any order. So
+    after rendering, if the manifest has been updated by another
+    publisher in the meantime, the indexes are rendered again from the
+    latest manifest. This ensures that the indexes are eventually
+    rendered from the latest manifest by one of the publishers.
+    """
+    for _ in range(MAX_UPDATE_ATTEMPTS):
+        render(manifest)
+        if token is None or storage.path_token(path) == token:
+            return
+        logger.info('Manifest {0} updated concurrently: re-rendering'.format(path))
+        manifest, token = load_versioned_manifest(storage, path)
+        if manifest is None:
+            return
+
+
+def save_index(storage, path, title, items, index_type, only_changed=False):
+    encoding = storage.compress_indexes
+    if only_changed:
+        # Comparing requires the full page, so it can't be streamed
+        index = build_index(title, items, index_type)
+        return put_if_changed(storage, index, path, encoding=encoding)
+    storage.put_stream(stream_index(title, items, index_type), path,
+                       encoding=encoding)
+    return True
+
+
+def save_json_index(storage, path, data, only_changed=False):
+    contents = json.dumps(data, sort_keys=True, separators=(',', ':'))
+    kwargs = {'content_type': SIMPLE_JSON_CONTENT_TYPE,
+              'encoding': storage.compress_indexes}
+    if only_changed:
+        return put_if_changed(storage, contents, path, **kwargs)
+    storage.put_contents(contents, path, **kwargs)
+    return True
+
+
+def build_pkg_json_index(pkg_name, manifest):
+    """Builds the project detail page of the JSON based Simple API (PEP
+    691) from the manifest of the package
+    """
+    files = []
+    for f in manifest['files']:
+        entry = {'filename': f['filename'],
+                 'url': f['filename'],
+                 'hashes': {},
+                 'yanked': False}
+        if f.get('sha256'):
+            entry['hashes']['sha256'] = f['sha256']
+        if 'requires_python' in f:
+            entry['requires-python'] = f['requires_python']
+        files.append(entry)
+    return {'meta': {'api-version': '1.0'},
+            'name': pkg_name,
+            'files': files}
+
+
+def build_root_json_index(manifest):
+    """Builds the project list page of the JSON based Simple API (PEP
+    691) from the manifest of the repository
+    """
+    return {'meta': {'api-version': '1.0'},
+            'projects': [{'name': p} for p in manifest['packages']]}
+
+
+def write_pkg_index(storage, pkg_name, manifest, only_changed=False):
+    manifest_path = storage.join_path(pkg_name, MANIFEST_JSON)
+    save_manifest(storage, manifest_path, manifest, only_changed)
+    render_pkg_index(storage, pkg_name, manifest, only_changed)
+
+
+def render_pkg_index(storage, pkg_name, manifest, only_changed=False):
+    # Both the HTML and the JSON index are generated from the manifest
     title = 'Links for {0}'.format(pkg_name)
-    index = build_index(title, dists, 'pkg')
+    items = manifest['files']
     index_path = storage.join_path(pkg_name, INDEX_HTML)
-    storage.put_contents(index, index_path)
+    save_index(storage, index_path, title, items, 'pkg', only_changed)
+    json_index_path = storage.join_path(pkg_name, INDEX_JSON)
+    save_json_index(storage, json_index_path,
+                    build_pkg_json_index(pkg_name, manifest), only_changed)
 
 
-def update_root_index(storage):
-    logger.info('Updating repository index')
-    pkgs = sorted([p for p in storage.listdir('.') if p != INDEX_HTML])
+def write_root_index(storage, manifest, only_changed=False):
+    manifest_path = storage.join_path(MANIFEST_JSON)
+    save_manifest(storage, manifest_path, manifest, only_changed)
+    render_root_index(storage, manifest, only_changed)
+
+
+def render_root_index(storage, manifest, only_changed=False):
     title = 'Private Index'
-    index = build_index(title, pkgs, 'root')
     index_path = storage.join_path(INDEX_HTML)
-    storage.put_contents(index, index_path)
+    save_index(storage, index_path, title, manifest['packages'], 'root',
+               only_changed)
+    json_index_path = storage.join_path(INDEX_JSON)
+    save_json_index(storage, json_index_path,
+                    build_root_json_index(manifest), only_changed)
+
+
+def manifest_entry(filename, sha256=None, requires_python=None):
+    # A null sha256 records that the artifact was published without a
+    # digest, so that its metadata isn't fetched again on reindex
+    entry = {'filename': filename, 'sha256': sha256 or None}
+    if requires_python:
+        entry['requires_python'] = requires_python
+    return entry
+
+
+def reindex_pkg_manifest(storage, pkg_name, exclude=()):
+    """Builds the manifest of the package from a full listing of the
+    package dir
+
+    The details of the artifacts already in the existing manifest are
+    retained. For the others, the digests are read from the metadata
+    of the artifacts stored at the time of upload. Artifacts in
+    `exclude` are left out (eg. the ones about to be added by the
+    caller).
+    """
+    logger.info('Rebuilding manifest for package: {0}'.format(pkg_name))
+    exclude = set(exclude)
+    files = [d for d in storage.listdir(pkg_name)
+             if not is_index_file(d) and d not in exclude]
+    existing = load_manifest(storage, storage.join_path(pkg_name, MANIFEST_JSON))
+    known = dict((f['filename'], f) for f in (existing or {}).get('files', []))
+    entries = []
+    for f in sorted(files):
+        entry = known.get(f)
+        if entry is None or 'sha256' not in entry:
+            path = storage.join_path(pkg_name, f)
+            try:
+                sha256 = storage.get_metadata(path).get('sha256')
+            except PathNotFound:
+                continue
+            entry = manifest_entry(f, sha256,
+                                   (entry or {}).get('requires_python'))
+        entries.append(entry)
+    return {'files': entries}
+
+
+def update_pkg_index(storage, pkg_name, dists=None, published=()):
+    """Updates the manifest and the index of the package
+
+    When the newly uploaded dists are passed, they are added to the
+    existing manifest and the index is re-rendered from it without
+    listing the package dir. If no dists are passed or the package
+    doesn't have a manifest yet, the manifest is rebuilt from a full
+    listing.
+
+    The (verified) dists of the release that were already `published`
+    are added only if they are missing from the manifest, eg. when
+    an earlier publish of the release failed after uploading them but
+    before updating the index. If there's nothing to add, neither the
+    manifest nor the index is rewritten.
+
+    If the storage `supports_conditional_put`, the dists are merged
+    into the manifest safely even if other publishers update it
+    concurrently (see `update_manifest`).
+
+    If the package doesn't have a manifest yet, it may be new to the
+    repository, so it's registered in the repository index before its
+    manifest is created. Thus a package with a manifest is always
+    registered and publishing to it doesn't need to read the
+    repository manifest. Returns True if the manifest was created.
+    """
+    logger.info('Updating index for package: {0}'.format(pkg_name))
+    if dists is None:
+        manifest = reindex_pkg_manifest(storage, pkg_name)
+        write_pkg_index(storage, pkg_name, manifest)
+        return False
+
+    def merge(manifest):
+        # The details of the new dists known at the time of upload
+        # supersede the ones found in the storage
+        files = dict((f['filename'], f) for f in manifest['files'])
+        missing = [d for d in published if d['artifact'] not in files]
+        if not dists and not missing:
+            return None
+        for dist in dists:
+            files[dist['artifact']] = manifest_entry(dist['artifact'],
+                                                     dist.get('sha256'),
+                                                     dist.get('requires_python'))
+        for dist in missing:
+            logger.info((
+                'Dist missing from the index: {0} [adding]'
+            ).format(dist['artifact']))
+            files[dist['artifact']] = manifest_entry(
+                dist['artifact'], dist.get('sha256'),
+                read_requires_python(dist['path'])
+            )
+        manifest['files'] = [files[k] for k in sorted(files)]
+        return manifest
+
+    def rebuild():
+        update_root_index(storage, [pkg_name])
+        return reindex_pkg_manifest(storage, pkg_name,
+                                    [d['artifact'] for d in dists] +
+                                    [d['artifact'] for d in published])
+
+    manifest_path = storage.join_path(pkg_name, MANIFEST_JSON)
+    manifest, token, created = update_manifest(storage, manifest_path,
+                                               merge, rebuild)
+    if manifest is None:
+        logger.debug('No new dists: skipping package index update')
+        return created
+    render_latest(storage, manifest_path, manifest, token,
+                  lambda m: render_pkg_index(storage, pkg_name, m))
+    return created
+
+
+def reindex_root_manifest(storage):
+    """Builds the manifest of the repository from a full listing of the
+    root dir
+    """
+    logger.info('Rebuilding repository manifest')
+    # The package dirs are named by the normalized names of the
+    # packages, so other entries (eg. robots.txt) can't be packages
+    pkgs = [p for p in storage.listdir('.')
+            if not is_index_file(p) and p == normalized_name(p)]
+    return {'packages': sorted(pkgs)}
 
 
-def publish_package(name, version, storage, project_path, dist_dir):
-    version = packaging.version.Version(version)
+def update_root_index(storage, pkgs=None):
+    """Updates the manifest and the index of the repository
+
+    The manifest of the repository serves as the registry of all
+    packages. When the names of the published packages are passed,
+    the index is rewritten only if any of them is not registered
+    yet. If no packages are passed or the repository doesn't have a
+    manifest yet, it's rebuilt from a full listing of the root dir.
+    Concurrent updates are handled as in `update_pkg_index`.
+    """
+    logger.info('Updating repository index')
+    if pkgs is None:
+        manifest = reindex_root_manifest(storage)
+        write_root_index(storage, manifest)
+        return
+
+    def merge(manifest):
+        new_pkgs = set(pkgs) - set(manifest['packages'])
+        if not new_pkgs:
+            return None
+        manifest['packages'] = sorted(set(manifest['packages']) | new_pkgs)
+        return manifest
+
+    manifest_path = storage.join_path(MANIFEST_JSON)
+    manifest, token, _ = update_manifest(
+        storage, manifest_path, merge,
+        lambda: reindex_root_manifest(storage)
+    )
+    if manifest is None:
+        logger.debug('No new packages: skipping repository index update')
+        return
+    render_latest(storage, manifest_path, manifest, token,
+                  lambda m: render_root_index(storage, m))
+
+
+def reindex_package(storage, pkg_name, only_changed=False):
+    manifest = reindex_pkg_manifest(storage, pkg_name)
+    write_pkg_index(storage, pkg_name, manifest, only_changed)
+
+
+def reindex_repository(storage, jobs=1, only_changed=False):
+    """Rebuilds the manifests and the indexes of all the packages and
+    of the repository from full listings of the storage
+
+    Useful for recovering from drift between the indexes and the
+    artifacts (eg. after manual deletions or failed publishes). The
+    packages are reindexed concurrently by a bounded pool of
+    workers. With `only_changed`, the files whose contents are
+    identical to the existing ones are not uploaded. Entries of the
+    root dir that can't be listed as a dir are skipped and left out
+    of the repository manifest.
+    """
+    pkgs = reindex_root_manifest(storage)['packages']
+    logger.info('Reindexing {0} packages'.format(len(pkgs)))
+
+    def reindex(pkg_name):
+        try:
+            reindex_package(storage, pkg_name, only_changed)
+        except PathNotFound:
+            logger.warning('Not a package dir: {0} [skipping]'.format(pkg_name))
+            return False
+        return True
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        reindexed = list(executor.map(reindex, pkgs))
+    manifest = {'packages': [p for p, ok in zip(pkgs, reindexed) if ok]}
+    write_root_index(storage, manifest, only_changed)
+
+
+def find_published_dists(storage, dists):
+    """Returns the dists that are already published
+
+    If the storage `supports_batch_exists`, all dists are checked using
+    a single bulk existence check rather than one request per dist. A
+    single dist is always checked on its own as that's cheaper than
+    listing the package dir.
+    """
+    paths, batch = plan_existence_check(storage, dists)
+    if batch:
+        exists = storage.paths_exist(paths)
+    else:
+        exists = dict((p, storage.path_exists(p)) for p in paths)
+    return [d for d, p in zip(dists, paths) if exists[p]]
+
+
+def publish_dists(storage, dists, jobs=1):
+    """Publishes the dists, which may belong to multiple packages
+
+    The verification of published dists and the uploads and sync
+    waits of the new ones are run concurrently using a bounded pool
+    of `jobs` workers. All published dists are verified before
+    uploading anything so that a mismatch fails fast. The index of
+    every package is updated once after all the uploads have completed,
+    which also registers the packages new to the repository (see
+    `update_pkg_index`). The indexes are updated even if all the dists
+    are already published, so that the ones left out of them by an
+    earlier publish that failed midway are added. In that case, only
+    the manifest of every package is read if nothing is missing.
+    """
+    published = find_published_dists(storage, dists)
+    new_dists = [d for d in dists if d not in published]
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        list(executor.map(lambda d: verify_published_dist(storage, d),
+                          published))
+        for dist in published:
+            logger.debug((
+                'Dist already published: {0} [skipping]'
+            ).format(dist['artifact']))
+        list(executor.map(lambda d: upload_dist(storage, d), new_dists))
+        logger.info('Updating index')
+        pkg_dists = {}
+        for dist in dists:
+            new, old = pkg_dists.setdefault(dist['normalized_name'], ([], []))
+            (old if dist in published else new).append(dist)
+        list(executor.map(lambda p: update_pkg_index(storage, p, *pkg_dists[p]),
+                          list(pkg_dists)))
+
+
+def publish_package(name, version, storage, project_path, dist_dir,
+                    jobs=1):
+    version = Version(version)
     dists = find_pkg_dists(project_path, dist_dir, name, version)
     if not dists:
         raise DistNotFound((
             'No package distribution found in path {0}'
         ).format(dist_dir))
-    rebuild_index = False
+    publish_dists(storage, dists, jobs=jobs)
+
+
+def read_releases(path):
+    """Reads the releases to be published from a manifest file
+
+    Every non-empty line of the file (except comments starting with
+    '#') is of the form `<pkg_name> <pkg_ver> [<project_path>]`. The
+    project path defaults to the dir containing the manifest and
+    relative paths are resolved against it. Returns a list of
+    (pkg_name, pkg_ver, project_path) tuples.
+    """
+    base_path = os.path.dirname(os.path.abspath(path))
+    releases = []
+    with open(path) as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            parts = line.split()
+            if len(parts) not in (2, 3):
+                raise ValueError((
+                    'Invalid release at {0}:{1}: {2}'
+                ).format(path, lineno, line))
+            project_path = os.path.join(base_path, *parts[2:])
+            releases.append((parts[0], parts[1], project_path))
+    return releases
+
+
+def scan_dist_dir(dist_dir):
+    """Returns all dists found in the dist_dir"""
+    return [{'pkg': d.name,
+             'normalized_name': normalized_name(d.name),
+             'artifact': d.filename,
+             'path': d.path}
+            for d in DistIndex.scan(dist_dir)]
+
+
+def unique_dists(dists):
+    """Returns the dists with the ones found more than once (eg. by a
+    release and by scanning its dist dir) included only once
+
+    Raises DistMismatch if the same artifact of a package is found at
+    different local paths, as only one of them can be published.
+    """
+    found = {}
+    result = []
     for dist in dists:
-        if not is_dist_published(storage, dist):
-            logger.info('Trying to publish dist: {0}'.format(dist['artifact']))
-            upload_dist(storage, dist)
-            rebuild_index = True
-        else:
-            logger.debug((
-                'Dist already published: {0} [skipping]'
-            ).format(dist['artifact']))
-    if rebuild_index:
-        logger.info('Updating index')
-        update_pkg_index(storage, dist['normalized_name'])
-        update_root_index(storage)
-    else:
-        logger.debug('No index update required as no new dists uploaded')
+        key = (dist['normalized_name'], dist['artifact'])
+        path = os.path.realpath(dist['path'])
+        if key not in found:
+            found[key] = path
+            result.append(dist)
+        elif found[key] != path:
+            raise DistMismatch((
+                'Dist found at multiple paths: {0} ({1}, {2})'
+            ).format(dist['artifact'], found[key], path))
+    return result
+
+
+def publish_packages(storage, releases=None, dist_dirs=None, dist_dir='dist',
+                     jobs=1):
+    """Publishes multiple packages at once
+
+    The packages are specified either as `releases` ie. a list of
+    (pkg_name, pkg_ver, project_path) tuples whose dists are looked up
+    in the `dist_dir` of the project, or as `dist_dirs` all dists in
+    which are published. Raises DistNotFound if no dists are found for
+    any release or dist dir, before publishing anything. Dists found
+    more than once are published once (see `unique_dists`).
+    """
+    dists = []
+    # Every dist dir is scanned only once even if it's shared by
+    # multiple releases
+    indexes = {}
+    for name, version, project_path in (releases or []):
+        path = os.path.join(project_path, dist_dir)
+        if path not in indexes:
+            indexes[path] = DistIndex.scan(path)
+        found = find_pkg_dists(project_path, dist_dir, name, Version(version),
+                               index=indexes[path])
+        if not found:
+            raise DistNotFound((
+                'No package distribution found for {0} {1} in path {2}'
+            ).format(name, version, os.path.join(project_path, dist_dir)))
+        dists.extend(found)
+    for path in (dist_dirs or []):
+        found = scan_dist_dir(path)
+        if not found:
+            raise DistNotFound((
+                'No package distribution found in path {0}'
+            ).format(path))
+        dists.extend(found)
+    publish_dists(storage, unique_dists(dists), jobs=jobs)
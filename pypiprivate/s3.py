@@ -0,0 +1,456 @@
+import os
+import hashlib
+import logging
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotocoreConfig
+from botocore.exceptions import ClientError
+
+from pypiprivate.storage import (Storage, PathNotFound, SyncFailed,
+                                 PreconditionFailed,
+                                 ChunkedReader, file_sha256,
+                                 guess_content_type, compress, decompress,
+                                 compress_chunks, validate_encoding,
+                                 parse_size, parse_bool, COMPRESS_ENCODINGS,
+                                 DIST_CACHE_CONTROL, INDEX_CACHE_CONTROL,
+                                 MULTIPART_THRESHOLD, MULTIPART_CHUNKSIZE,
+                                 MAX_CONCURRENCY, MAX_POOL_CONNECTIONS,
+                                 CONNECT_TIMEOUT, READ_TIMEOUT)
+
+logger = logging.getLogger(__name__)
+
+
+RETRY_MODE = 'standard'
+RETRY_MAX_ATTEMPTS = 5
+
+# Strategies for ensuring that uploaded objects are readable when
+# sync=True is passed to the put_* methods of AWSS3Storage
+SYNC_NONE = 'none'
+SYNC_ETAG_VERIFY = 'etag-verify'
+SYNC_WAITER = 'waiter'
+SYNC_STRATEGIES = (SYNC_NONE, SYNC_ETAG_VERIFY, SYNC_WAITER)
+
+
+def has_conditional_put(client):
+    """Returns whether the PutObject model of the client has the
+    IfMatch and IfNoneMatch params (added in botocore 1.35.69)
+    """
+    operation = client.meta.service_model.operation_model('PutObject')
+    members = operation.input_shape.members
+    return 'IfMatch' in members and 'IfNoneMatch' in members
+
+
+class AWSS3Storage(Storage):
+
+    supports_batch_exists = True
+
+    def __init__(self, bucket, acl, creds=None, prefix=None,
+                 endpoint=None, region=None,
+                 multipart_threshold=MULTIPART_THRESHOLD,
+                 multipart_chunksize=MULTIPART_CHUNKSIZE,
+                 max_concurrency=MAX_CONCURRENCY,
+                 sync_strategy=SYNC_ETAG_VERIFY, sync_delay=5,
+                 sync_max_attempts=20, compress_indexes=None,
+                 dist_cache_control=DIST_CACHE_CONTROL,
+                 index_cache_control=INDEX_CACHE_CONTROL,
+                 max_pool_connections=MAX_POOL_CONNECTIONS,
+                 connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT,
+                 retry_mode=RETRY_MODE,
+                 retry_max_attempts=RETRY_MAX_ATTEMPTS,
+                 tcp_keepalive=True, conditional_writes=True):
+        if sync_strategy not in SYNC_STRATEGIES:
+            raise ValueError('Unsupported sync strategy "{0}"'.format(sync_strategy))
+        if creds:
+            logger.info('S3 Auth: using explicitly passed credentials')
+            access_key, secret_key, session_token = creds
+            session = boto3.Session(aws_access_key_id=access_key,
+                                    aws_secret_access_key=secret_key,
+                                    aws_session_token=session_token)
+        else:
+            logger.info('S3 Auth: using default boto3 methods')
+            session = boto3.Session()
+        self.session = session
+        self.endpoint = endpoint
+        self.region = region
+        kwargs = dict()
+        if endpoint is not None:
+            kwargs['endpoint_url'] = endpoint
+        if region is not None:
+            kwargs['region_name'] = region
+        # A single low level client is shared by all the threads. It's
+        # thread safe and reuses the connections from its pool.
+        self.client_config = BotocoreConfig(
+            max_pool_connections=max_pool_connections,
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+            retries={'mode': retry_mode,
+                     'max_attempts': retry_max_attempts},
+            tcp_keepalive=tcp_keepalive
+        )
+        self.client = session.client('s3', config=self.client_config,
+                                     **kwargs)
+        self.bucket = bucket
+        self.prefix = prefix
+        self.acl = acl
+        # Files larger than the threshold are uploaded using multipart
+        # upload with the parts uploaded (and retried) independently
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_chunksize,
+            max_concurrency=max_concurrency
+        )
+        self.sync_strategy = sync_strategy
+        self.sync_delay = sync_delay
+        self.sync_max_attempts = sync_max_attempts
+        self.compress_indexes = validate_encoding(compress_indexes)
+        self.dist_cache_control = dist_cache_control
+        self.index_cache_control = index_cache_control
+        # Conditional writes (If-Match/If-None-Match) may not be
+        # supported by other S3 compatible storages
+        self.conditional_writes = conditional_writes
+        self._supports_conditional_put = None
+
+    @classmethod
+    def from_config(cls, config):
+        storage_config = config.storage_config
+        env = config.env
+        bucket = storage_config['bucket']
+        prefix = storage_config.get('prefix')
+        acl = storage_config.get('acl', 'private')
+        endpoint = storage_config.get('endpoint', None)
+        region = storage_config.get('region', None)
+        multipart_threshold = parse_size(storage_config.get('multipart_threshold',
+                                                            MULTIPART_THRESHOLD))
+        multipart_chunksize = parse_size(storage_config.get('multipart_chunksize',
+                                                            MULTIPART_CHUNKSIZE))
+        max_concurrency = int(storage_config.get('max_concurrency',
+                                                 MAX_CONCURRENCY))
+        sync_strategy = storage_config.get('sync_strategy', SYNC_ETAG_VERIFY)
+        sync_delay = int(storage_config.get('sync_delay', 5))
+        sync_max_attempts = int(storage_config.get('sync_max_attempts', 20))
+        compress_indexes = storage_config.get('compress_indexes')
+        dist_cache_control = storage_config.get('dist_cache_control',
+                                                DIST_CACHE_CONTROL)
+        index_cache_control = storage_config.get('index_cache_control',
+                                                 INDEX_CACHE_CONTROL)
+        max_pool_connections = int(storage_config.get('max_pool_connections',
+                                                      MAX_POOL_CONNECTIONS))
+        connect_timeout = float(storage_config.get('connect_timeout',
+                                                   CONNECT_TIMEOUT))
+        read_timeout = float(storage_config.get('read_timeout', READ_TIMEOUT))
+        retry_mode = storage_config.get('retry_mode', RETRY_MODE)
+        retry_max_attempts = int(storage_config.get('retry_max_attempts',
+                                                    RETRY_MAX_ATTEMPTS))
+        tcp_keepalive = parse_bool(storage_config.get('tcp_keepalive', True))
+        conditional_writes = parse_bool(storage_config.get('conditional_writes',
+                                                           True))
+        # Following 2 are the required env vars for s3 auth. If any of
+        # these are not set, we try using the default boto3 methods
+        # (same as the ones that AWS CLI and other tools support)
+        pp_cred_keys = ['PP_S3_ACCESS_KEY', 'PP_S3_SECRET_KEY']
+        if all([(k in env) for k in pp_cred_keys]):
+            logger.debug('PP_S3_* env vars found: using them for auth')
+            creds = (env['PP_S3_ACCESS_KEY'],
+                     env['PP_S3_SECRET_KEY'],
+                     env.get('PP_S3_SESSION_TOKEN', None))
+        else:
+            logger.debug((
+                'PP_S3_* env vars not found: '
+                'Falling back to default methods supported by boto3'
+            ))
+            creds = None
+        return cls(bucket, acl, creds=creds, prefix=prefix,
+                   endpoint=endpoint, region=region,
+                   multipart_threshold=multipart_threshold,
+                   multipart_chunksize=multipart_chunksize,
+                   max_concurrency=max_concurrency,
+                   sync_strategy=sync_strategy,
+                   sync_delay=sync_delay,
+                   sync_max_attempts=sync_max_attempts,
+                   compress_indexes=compress_indexes,
+                   dist_cache_control=dist_cache_control,
+                   index_cache_control=index_cache_control,
+                   max_pool_connections=max_pool_connections,
+                   connect_timeout=connect_timeout,
+                   read_timeout=read_timeout,
+                   retry_mode=retry_mode,
+                   retry_max_attempts=retry_max_attempts,
+                   tcp_keepalive=tcp_keepalive,
+                   conditional_writes=conditional_writes)
+
+    @property
+    def supports_conditional_put(self):
+        # Checked on first use, as the installed botocore may be too
+        # old to send the conditional params
+        if self._supports_conditional_put is None:
+            supported = self.conditional_writes
+            if supported and not has_conditional_put(self.client):
+                logger.warning('Conditional writes are not supported by the '
+                               'installed botocore, upgrade boto3 to update '
+                               'manifests safely')
+                supported = False
+            self._supports_conditional_put = supported
+        return self._supports_conditional_put
+
+    def join_path(self, *args):
+        return '/'.join(args)
+
+    def prefixed_path(self, path):
+        parts = []
+        if self.prefix:
+            parts.append(self.prefix)
+        if path != '.':
+            parts.append(path)
+        return self.join_path(*parts)
+
+    def dir_prefix(self, path):
+        path = self.prefixed_path(path)
+        if path != '' and not path.endswith('/'):
+            return '{0}/'.format(path)
+        return path
+
+    def iter_dir(self, path):
+        """Yields the names of the files and dirs under `path`
+
+        The pages of the listing are fetched lazily (ListObjectsV2, upto
+        1000 keys per page) and the names are yielded as each page is
+        received, in a single pass. Raises `PathNotFound` once the
+        listing is exhausted if nothing was found under `path`.
+        """
+        s3_prefix = self.dir_prefix(path)
+        logger.debug('Listing objects prefixed with: {0}'.format(s3_prefix))
+        paginator = self.client.get_paginator('list_objects_v2')
+        pages = paginator.paginate(Bucket=self.bucket,
+                                   Prefix=s3_prefix,
+                                   Delimiter='/')
+        found = False
+        for page in pages:
+            for c in page.get('Contents', ()):
+                found = True
+                name = c['Key'][len(s3_prefix):]
+                if name != '':
+                    yield name
+            for cp in page.get('CommonPrefixes', ()):
+                found = True
+                yield cp['Prefix'][len(s3_prefix):].rstrip('/')
+        # If no objs found, it means the path doesn't exist
+        if not found:
+            raise PathNotFound('Path {0} not found'.format(s3_prefix))
+
+    def listdir(self, path):
+        return list(self.iter_dir(path))
+
+    def path_exists(self, path):
+        path = self.prefixed_path(path)
+        logger.debug('Checking if key exists: {0}'.format(path))
+        client = self.client
+        try:
+            client.head_object(Bucket=self.bucket, Key=path)
+        except ClientError as e:
+            logger.debug('Handled ClientError: {0}'.format(e))
+            return False
+        else:
+            return True
+
+    def get_contents(self, path):
+        return self.get_versioned_contents(path)[0]
+
+    def get_versioned_contents(self, path):
+        path = self.prefixed_path(path)
+        logger.debug('Reading contents of key: {0}'.format(path))
+        client = self.client
+        try:
+            response = client.get_object(Bucket=self.bucket, Key=path)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                raise PathNotFound('Path {0} not found'.format(path))
+            raise e
+        body = response['Body'].read()
+        if response.get('ContentEncoding') in COMPRESS_ENCODINGS:
+            body = decompress(body, response['ContentEncoding'])
+        return body.decode('utf-8'), response['ETag']
+
+    def wait_for_sync(self, dest_path, body=None, response=None):
+        """Ensures that the object uploaded to dest_path is readable as
+        per the configured sync strategy
+
+        As S3 provides strong read-after-write consistency, polling for
+        the object using the waiter is not required and the default
+        'etag-verify' strategy only verifies the integrity of the
+        upload by comparing the ETag in the `put_object` response with
+        the MD5 of the body. It's skipped when the ETag is not an MD5
+        (multipart uploads, for which S3 verifies the checksums of the
+        individual parts, and SSE-KMS encrypted objects).
+        """
+        client = self.client
+        if self.sync_strategy == SYNC_WAITER:
+            waiter = client.get_waiter('object_exists')
+            waiter.wait(Bucket=self.bucket, Key=dest_path,
+                        WaiterConfig={'Delay': self.sync_delay,
+                                      'MaxAttempts': self.sync_max_attempts})
+        elif self.sync_strategy == SYNC_ETAG_VERIFY:
+            if response is None or body is None:
+                return
+            if response.get('ServerSideEncryption', '').startswith('aws:kms'):
+                return
+            etag = response['ETag'].strip('"')
+            md5 = hashlib.md5(body).hexdigest()
+            if etag != md5:
+                raise SyncFailed((
+                    'ETag mismatch for {0}: expected {1}, got {2}'
+                ).format(dest_path, md5, etag))
+
+    def put_object_args(self, dest_path, body, content_type, metadata=None,
+                        encoding=None, is_index=True):
+        """Returns the kwargs for the put_object API call"""
+        kwargs = {'Bucket': self.bucket,
+                  'Key': dest_path,
+                  'Body': body,
+                  'ContentType': content_type,
+                  'ACL': self.acl,
+                  'Metadata': metadata or {}}
+        if encoding is not None:
+            kwargs['ContentEncoding'] = encoding
+        cache_control = self.cache_control(is_index, encoding)
+        if cache_control is not None:
+            kwargs['CacheControl'] = cache_control
+        return kwargs
+
+    def put_object(self, dest_path, body, content_type, metadata=None,
+                   encoding=None, is_index=True):
+        kwargs = self.put_object_args(dest_path, body, content_type,
+                                      metadata=metadata, encoding=encoding,
+                                      is_index=is_index)
+        return self.client.put_object(**kwargs)
+
+    def put_contents(self, contents, dest, sync=False, content_type=None,
+                     encoding=None):
+        dest_path = self.prefixed_path(dest)
+        logger.debug('Writing content to s3: {0}'.format(dest_path))
+        body = contents.encode('utf-8')
+        if encoding is not None:
+            body = compress(body, encoding)
+        response = self.put_object(dest_path, body,
+                                   content_type or guess_content_type(dest),
+                                   encoding=encoding)
+        if sync:
+            self.wait_for_sync(dest_path, body, response)
+
+    def put_contents_if_match(self, contents, dest, token, content_type=None,
+                              encoding=None):
+        dest_path = self.prefixed_path(dest)
+        logger.debug('Conditionally writing content to s3: {0}'.format(dest_path))
+        body = contents.encode('utf-8')
+        if encoding is not None:
+            body = compress(body, encoding)
+        kwargs = self.put_object_args(dest_path, body,
+                                      content_type or guess_content_type(dest),
+                                      encoding=encoding)
+        if token is None:
+            kwargs['IfNoneMatch'] = '*'
+        else:
+            kwargs['IfMatch'] = token
+        try:
+            response = self.client.put_object(**kwargs)
+        except ClientError as e:
+            # 409 is returned when the object is concurrently written
+            # by another conditional request
+            if e.response['Error']['Code'] in ('PreconditionFailed',
+                                               'ConditionalRequestConflict'):
+                raise PreconditionFailed((
+                    'Key {0} was modified: expected version {1}'
+                ).format(dest_path, token))
+            raise e
+        return response['ETag']
+
+    def put_stream(self, chunks, dest, sync=False, content_type=None,
+                   encoding=None):
+        dest_path = self.prefixed_path(dest)
+        client = self.client
+        logger.debug('Streaming content to s3: {0}'.format(dest_path))
+        extra_args = {'ContentType': content_type or guess_content_type(dest),
+                      'ACL': self.acl}
+        if encoding is not None:
+            chunks = compress_chunks(chunks, encoding)
+            extra_args['ContentEncoding'] = encoding
+        cache_control = self.cache_control(True, encoding)
+        if cache_control is not None:
+            extra_args['CacheControl'] = cache_control
+        # upload_fileobj switches to multipart upload for large
+        # contents, so the body is never held in memory in full
+        client.upload_fileobj(ChunkedReader(chunks),
+                              self.bucket,
+                              dest_path,
+                              ExtraArgs=extra_args,
+                              Config=self.transfer_config)
+        if sync:
+            self.wait_for_sync(dest_path)
+
+    def put_file(self, src, dest, sync=False):
+        dest_path = self.prefixed_path(dest)
+        client = self.client
+        content_type = guess_content_type(dest)
+        headers = {'ContentType': content_type, 'ACL': self.acl}
+        cache_control = self.cache_control(False)
+        if cache_control is not None:
+            headers['CacheControl'] = cache_control
+        logger.debug('Uploading file to s3: {0} -> {1}'.format(src, dest_path))
+        if os.path.getsize(src) < self.transfer_config.multipart_threshold:
+            # Small files are read in memory once to compute the
+            # digest and uploaded with a single put_object so that the
+            # ETag in the response can be verified
+            with open(src, 'rb') as f:
+                body = f.read()
+            digest = hashlib.sha256(body).hexdigest()
+            response = self.put_object(dest_path, body, content_type,
+                                       metadata={'sha256': digest},
+                                       is_index=False)
+        else:
+            body = response = None
+            # Large files are hashed (locally) before the upload so that
+            # the digest is set as metadata by the upload itself
+            # instead of rewriting the object afterwards
+            digest = file_sha256(src)
+            headers['Metadata'] = {'sha256': digest}
+            with open(src, 'rb') as f:
+                client.upload_fileobj(f,
+                                      self.bucket,
+                                      dest_path,
+                                      ExtraArgs=headers,
+                                      Config=self.transfer_config)
+        if sync:
+            self.wait_for_sync(dest_path, body, response)
+        return digest
+
+    def get_metadata(self, path):
+        path = self.prefixed_path(path)
+        logger.debug('Reading metadata of key: {0}'.format(path))
+        client = self.client
+        try:
+            response = client.head_object(Bucket=self.bucket, Key=path)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                raise PathNotFound('Path {0} not found'.format(path))
+            raise e
+        return response.get('Metadata', {})
+
+    def path_token(self, path):
+        path = self.prefixed_path(path)
+        try:
+            response = self.client.head_object(Bucket=self.bucket, Key=path)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise e
+        return response['ETag']
+
+    def __repr__(self):
+        if self.endpoint is not None:
+            return (
+                '<AWSS3Storage(bucket="{0}", prefix="{1}", endpoint="{2}")>'
+            ).format(self.bucket, self.prefix, self.endpoint)
+        return (
+            '<AWSS3Storage(bucket="{0}", prefix="{1}")>'
+        ).format(self.bucket, self.prefix)
@@ -0,0 +1,438 @@
+import os
+import json
+import time
+import socket
+import logging
+import tempfile
+import threading
+
+from .storage import PathNotFound, parse_bool
+
+
+logger = logging.getLogger(__name__)
+
+
+# Storage methods that are instrumented
+OPERATIONS = ('listdir', 'path_exists', 'paths_exist', 'get_contents',
+              'get_versioned_contents', 'put_contents', 'put_contents_if_match',
+              'put_stream', 'put_file', 'get_metadata', 'path_token')
+
+# Upper bounds (in seconds) of the buckets of the latency histograms.
+# Besides the usual range of API calls, they cover large uploads.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                   10, 30, 60, 120, 300)
+
+# Prefix of the names of the metrics in all sinks
+METRICS_PREFIX = 'pypiprivate'
+
+
+class StatsException(Exception):
+    pass
+
+
+class OperationStats(object):
+    """Stats of the calls to a single storage operation"""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.bytes = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        # Number of calls that took upto the bound of the bucket (non
+        # cumulative). The last one is for the calls that took longer
+        # than the last bound.
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def record(self, duration, nbytes=0, error=False):
+        self.count += 1
+        self.errors += int(error)
+        self.bytes += nbytes
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if duration <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def quantile(self, q):
+        """Returns the upper bound of the bucket in which the q-quantile
+        of the latencies lies (or the max latency if it's beyond the
+        last bucket)
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(LATENCY_BUCKETS, self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max_time)
+        return self.max_time
+
+    def to_dict(self):
+        return {'count': self.count,
+                'errors': self.errors,
+                'bytes': self.bytes,
+                'total_time': self.total_time,
+                'max_time': self.max_time,
+                'buckets': dict(zip([str(b) for b in LATENCY_BUCKETS] + ['+Inf'],
+                                    self.buckets))}
+
+
+class StatsCollector(object):
+    """Thread safe collector of the stats of the storage operations and
+    of the API calls made by the storage clients (along with their
+    retries)
+
+    Every call is also passed on to the `sinks` as it's recorded and
+    the sinks are flushed with the collected stats on `flush`.
+    """
+
+    def __init__(self, sinks=None):
+        self.sinks = list(sinks or [])
+        self.operations = {}
+        self.api_calls = {}
+        self.lock = threading.Lock()
+
+    def record(self, operation, start, duration, nbytes=0, error=False):
+        with self.lock:
+            stats = self.operations.setdefault(operation, OperationStats())
+            stats.record(duration, nbytes, error)
+        for sink in self.sinks:
+            try:
+                sink.record(operation, start, duration, nbytes, error)
+            except Exception as e:
+                # As in flush, a failing sink must not fail the storage
+                # call (or mask its exception)
+                logger.warning('Could not record stats to {0!r}: {1}'.format(sink, e))
+
+    def record_api_call(self, name, retries=0):
+        with self.lock:
+            calls = self.api_calls.setdefault(name, {'count': 0, 'retries': 0})
+            calls['count'] += 1
+            calls['retries'] += retries
+
+    def watch_client(self, storage):
+        """Records the API calls (and retries) made by the S3 client of
+        the storage, if it has one
+
+        Retries of the other backends aren't visible to pypiprivate and
+        so are included only in the latencies of the operations.
+        """
+        client = getattr(storage, 'client', None)
+        events = getattr(getattr(client, 'meta', None), 'events', None)
+        if events is None:
+            return
+
+        def after_call(model, parsed, **kwargs):
+            retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+            self.record_api_call('s3.{0}'.format(model.name), retries)
+
+        events.register('after-call.s3', after_call)
+
+    def snapshot(self):
+        with self.lock:
+            return {'operations': dict((op, s.to_dict())
+                                       for op, s in self.operations.items()),
+                    'api_calls': dict((name, dict(c))
+                                      for name, c in self.api_calls.items())}
+
+    def flush(self):
+        for sink in self.sinks:
+            try:
+                sink.flush(self)
+            except Exception as e:
+                # Failing to export the stats must not fail the command
+                logger.warning('Could not flush stats to {0!r}: {1}'.format(sink, e))
+
+    def report(self):
+        """Returns a table of the stats of all operations, the slowest
+        first, followed by the API calls
+        """
+        with self.lock:
+            ops = sorted(self.operations.items(),
+                         key=lambda item: item[1].total_time, reverse=True)
+            api_calls = sorted(self.api_calls.items())
+        header = ('operation', 'calls', 'errors', 'bytes', 'total s',
+                  'mean ms', 'p95 ms', 'max ms')
+        rows = [header]
+        for op, s in ops:
+            rows.append((op, str(s.count), str(s.errors), str(s.bytes),
+                         '{0:.3f}'.format(s.total_time),
+                         '{0:.1f}'.format(1000 * s.total_time / s.count),
+                         '{0:.1f}'.format(1000 * s.quantile(0.95)),
+                         '{0:.1f}'.format(1000 * s.max_time)))
+        lines = format_table(rows)
+        if api_calls:
+            lines.append('')
+            lines.extend(format_table(
+                [('api call', 'calls', 'retries')] +
+                [(name, str(c['count']), str(c['retries'])) for name, c in api_calls]
+            ))
+        return '\n'.join(lines)
+
+
+def format_table(rows):
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return ['  '.join([row[0].ljust(widths[0])] +
+                      [c.rjust(w) for c, w in zip(row[1:], widths[1:])])
+            for row in rows]
+
+
+class InstrumentedStorage(object):
+    """Proxy to `storage` that records the latency, bytes transferred and
+    errors of every call to the storage operations in the `collector`
+
+    The bytes are of the (uncompressed) contents read or written.
+    `PathNotFound` is not counted as an error. All other attributes
+    are delegated to the storage.
+    """
+
+    def __init__(self, storage, collector):
+        self.storage = storage
+        self.collector = collector
+        collector.watch_client(storage)
+
+    def __getattr__(self, name):
+        attr = getattr(self.storage, name)
+        if name not in OPERATIONS:
+            return attr
+        return lambda *args, **kwargs: self.call(name, attr, *args, **kwargs)
+
+    def call(self, operation, method, *args, **kwargs):
+        start = time.time()
+        t0 = time.perf_counter()
+        error = True
+        result = None
+        try:
+            result = method(*args, **kwargs)
+            error = False
+            return result
+        except PathNotFound:
+            # Not found is an expected outcome of reads, not an error
+            error = False
+            raise
+        finally:
+            duration = time.perf_counter() - t0
+            nbytes = 0 if error else self.count_bytes(operation, args,
+                                                       kwargs, result)
+            self.collector.record(operation, start, duration, nbytes, error)
+
+    @staticmethod
+    def count_bytes(operation, args, kwargs, result):
+        # Counting is best effort as it must never mask the result (or
+        # the exception) of the call
+        try:
+            if operation == 'get_contents' and result is not None:
+                return len(result.encode('utf-8'))
+            if operation == 'get_versioned_contents' and result is not None:
+                return len(result[0].encode('utf-8'))
+            if operation in ('put_contents', 'put_contents_if_match'):
+                contents = args[0] if args else kwargs['contents']
+                return len(contents.encode('utf-8'))
+            if operation == 'put_file':
+                return os.path.getsize(args[0] if args else kwargs['src'])
+        except Exception as e:
+            logger.debug('Could not count bytes of {0}: {1}'.format(operation, e))
+        return 0
+
+    def put_stream(self, chunks, *args, **kwargs):
+        # The chunks are counted as they are consumed by the upload
+        counted = [0]
+
+        def count(chunks):
+            for chunk in chunks:
+                counted[0] += len(chunk)
+                yield chunk
+
+        start = time.time()
+        t0 = time.perf_counter()
+        error = True
+        try:
+            result = self.storage.put_stream(count(chunks), *args, **kwargs)
+            error = False
+            return result
+        finally:
+            self.collector.record('put_stream', start, time.perf_counter() - t0,
+                                  counted[0], error)
+
+    def __repr__(self):
+        return '<InstrumentedStorage({0!r})>'.format(self.storage)
+
+
+class Sink(object):
+    """Destination of the stats
+
+    `record` is called for every call to an operation as it completes
+    and `flush` once with the collector at the end.
+    """
+
+    def record(self, operation, start, duration, nbytes, error):
+        pass
+
+    def flush(self, collector):
+        pass
+
+
+def write_atomically(path, contents):
+    # Readers (eg. the node exporter) never see a partially written file
+    path = os.path.expanduser(path)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    with os.fdopen(fd, 'w') as f:
+        f.write(contents)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
+
+
+class JSONSink(Sink):
+    """Writes the snapshot of the stats to a JSON file"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def flush(self, collector):
+        write_atomically(self.path, json.dumps(collector.snapshot(), indent=2,
+                                               sort_keys=True))
+
+    def __repr__(self):
+        return '<JSONSink(path="{0}")>'.format(self.path)
+
+
+class PrometheusTextfileSink(Sink):
+    """Writes the stats in the Prometheus text format to a file, to be
+    exported by the textfile collector of the node exporter
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    # Counters of the operations and the keys of their values in the
+    # snapshot
+    COUNTERS = (('calls_total', 'count'),
+                ('errors_total', 'errors'),
+                ('bytes_total', 'bytes'))
+
+    def flush(self, collector):
+        snapshot = collector.snapshot()
+        operations = sorted(snapshot['operations'].items())
+        name = '{0}_storage_operation'.format(METRICS_PREFIX)
+        lines = []
+        for metric, key in self.COUNTERS:
+            lines.append('# TYPE {0}_{1} counter'.format(name, metric))
+            for op, s in operations:
+                lines.append('{0}_{1}{{operation="{2}"}} {3}'.format(
+                    name, metric, op, s[key]))
+        lines.append('# TYPE {0}_duration_seconds histogram'.format(name))
+        for op, s in operations:
+            cumulative = 0
+            for bound in [str(b) for b in LATENCY_BUCKETS] + ['+Inf']:
+                cumulative += s['buckets'][bound]
+                lines.append('{0}_duration_seconds_bucket{{operation="{1}",le="{2}"}} {3}'.format(
+                    name, op, bound, cumulative))
+            lines.append('{0}_duration_seconds_sum{{operation="{1}"}} {2}'.format(
+                name, op, s['total_time']))
+            lines.append('{0}_duration_seconds_count{{operation="{1}"}} {2}'.format(
+                name, op, s['count']))
+        name = '{0}_api'.format(METRICS_PREFIX)
+        for metric, key in (('calls_total', 'count'), ('retries_total', 'retries')):
+            lines.append('# TYPE {0}_{1} counter'.format(name, metric))
+            for call, c in sorted(snapshot['api_calls'].items()):
+                lines.append('{0}_{1}{{call="{2}"}} {3}'.format(name, metric, call, c[key]))
+        write_atomically(self.path, '\n'.join(lines) + '\n')
+
+    def __repr__(self):
+        return '<PrometheusTextfileSink(path="{0}")>'.format(self.path)
+
+
+class StatsDSink(Sink):
+    """Sends the latency of every call as a StatsD timer (along with
+    the bytes and errors as counters) over UDP
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix=METRICS_PREFIX):
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, *metrics):
+        data = '\n'.join('{0}.{1}'.format(self.prefix, m) for m in metrics)
+        try:
+            self.sock.sendto(data.encode('utf-8'), self.address)
+        except (IOError, OSError) as e:
+            logger.debug('Could not send metrics to statsd: {0}'.format(e))
+
+    def record(self, operation, start, duration, nbytes, error):
+        metrics = ['storage.{0}:{1:.3f}|ms'.format(operation, 1000 * duration)]
+        if nbytes:
+            metrics.append('storage.{0}.bytes:{1}|c'.format(operation, nbytes))
+        if error:
+            metrics.append('storage.{0}.errors:1|c'.format(operation))
+        self.send(*metrics)
+
+    def flush(self, collector):
+        api_calls = collector.snapshot()['api_calls']
+        metrics = []
+        for call, c in sorted(api_calls.items()):
+            metrics.append('api.{0}:{1}|c'.format(call, c['count']))
+            if c['retries']:
+                metrics.append('api.{0}.retries:{1}|c'.format(call, c['retries']))
+        if metrics:
+            self.send(*metrics)
+
+    def __repr__(self):
+        return '<StatsDSink(address="{0}:{1}")>'.format(*self.address)
+
+
+def _import_opentelemetry():
+    try:
+        from opentelemetry import trace
+    except ImportError:
+        raise StatsException((
+            'The "opentelemetry-api" package is required for the '
+            'opentelemetry sink'
+        ))
+    return trace
+
+
+class OpenTelemetrySink(Sink):
+    """Records every call as a span using the globally configured
+    OpenTelemetry tracer provider
+    """
+
+    def __init__(self, tracer=None):
+        if tracer is None:
+            tracer = _import_opentelemetry().get_tracer(__name__)
+        self.tracer = tracer
+
+    def record(self, operation, start, duration, nbytes, error):
+        span = self.tracer.start_span(
+            'storage.{0}'.format(operation),
+            start_time=int(start * 1e9),
+            attributes={'pypiprivate.operation': operation,
+                        'pypiprivate.bytes': nbytes,
+                        'pypiprivate.error': error}
+        )
+        span.end(end_time=int((start + duration) * 1e9))
+
+    def __repr__(self):
+        return '<OpenTelemetrySink()>'
+
+
+def load_sinks(config):
+    """Returns the sinks configured in the [stats] section of the config"""
+    stats_config = config.stats_config
+    sinks = []
+    if stats_config.get('json'):
+        sinks.append(JSONSink(stats_config['json']))
+    if stats_config.get('prometheus_textfile'):
+        sinks.append(PrometheusTextfileSink(stats_config['prometheus_textfile']))
+    if stats_config.get('statsd'):
+        host, _, port = stats_config['statsd'].partition(':')
+        sinks.append(StatsDSink(host, port or 8125,
+                                stats_config.get('statsd_prefix', METRICS_PREFIX)))
+    if parse_bool(stats_config.get('opentelemetry', False)):
+        sinks.append(OpenTelemetrySink())
+    return sinks
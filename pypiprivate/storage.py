@@ -1,22 +1,222 @@
+import io
 import os
+import json
+import zlib
 import errno
+import hashlib
+import posixpath
 import shutil
+import tempfile
 import mimetypes
 import logging
 
-import boto3
-from botocore.exceptions import ClientError
+from importlib import import_module
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows
+    fcntl = None
 
 
 logger = logging.getLogger(__name__)
 
 
+# Defaults for uploading large files in multiple parts (S3) or blocks
+# (Azure) concurrently
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+MAX_CONCURRENCY = 4
+
+# Defaults for the HTTP connections of the storage clients. The pool
+# is shared by all the threads (publish jobs and multipart workers) so
+# it needs to be larger than the default of 10 of botocore.
+MAX_POOL_CONNECTIONS = 50
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+
+# Encodings in which the index files may be stored pre-compressed and
+# the extensions of the compressed copies written by
+# LocalFileSystemStorage
+COMPRESS_ENCODINGS = ('gzip', 'br')
+ENCODING_EXTS = {'gzip': 'gz', 'br': 'br'}
+
+# Default Cache-Control policies for the two classes of objects. Dists
+# never change once published whereas the indexes (and manifests) are
+# updated on every publish.
+DIST_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+INDEX_CACHE_CONTROL = 'no-cache'
+
+# Pre-compressed objects must be served as is by proxies and CDNs
+COMPRESSED_CACHE_CONTROL = 'no-transform'
+
+_size_units = {'kb': 1024, 'mb': 1024 ** 2, 'gb': 1024 ** 3}
+
+
+def parse_size(value):
+    """Parses size in bytes from config values such as 8MB or 4096"""
+    value = str(value).strip().lower()
+    for unit, multiplier in _size_units.items():
+        if value.endswith(unit):
+            return int(value[:-len(unit)].strip()) * multiplier
+    return int(value)
+
+
+def parse_bool(value):
+    """Parses boolean config values such as yes/no, true/false or 1/0"""
+    if isinstance(value, bool):
+        return value
+    value = str(value).strip().lower()
+    if value in ('1', 'yes', 'true', 'on'):
+        return True
+    if value in ('0', 'no', 'false', 'off'):
+        return False
+    raise ValueError('Invalid boolean value "{0}"'.format(value))
+
+
+def _import_brotli():
+    try:
+        import brotli
+    except ImportError:
+        raise StorageException((
+            'The "brotli" package is required for "br" encoding'
+        ))
+    return brotli
+
+
+def validate_encoding(encoding):
+    if encoding is None:
+        return None
+    if encoding not in COMPRESS_ENCODINGS:
+        raise ValueError('Unsupported encoding "{0}"'.format(encoding))
+    if encoding == 'br':
+        _import_brotli()
+    return encoding
+
+
+def compress_chunks(chunks, encoding):
+    """Compresses the byte chunks incrementally using the given content
+    encoding
+    """
+    if encoding == 'gzip':
+        # The gzip header written by zlib has mtime set to 0, so the
+        # output is deterministic
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        process, finish = compressor.compress, compressor.flush
+    elif encoding == 'br':
+        compressor = _import_brotli().Compressor()
+        process, finish = compressor.process, compressor.finish
+    else:
+        raise ValueError('Unsupported encoding "{0}"'.format(encoding))
+    for chunk in chunks:
+        out = process(chunk)
+        if out:
+            yield out
+    out = finish()
+    if out:
+        yield out
+
+
+def compress(data, encoding):
+    """Compresses data (bytes) using the given content encoding"""
+    return b''.join(compress_chunks([data], encoding))
+
+
+def decompress(data, encoding):
+    if encoding == 'gzip':
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    if encoding == 'br':
+        return _import_brotli().decompress(data)
+    raise ValueError('Unsupported encoding "{0}"'.format(encoding))
+
+
 def guess_content_type(path, default='application/octet-stream'):
     ctype = mimetypes.guess_type(path)[0] or default
     logger.debug('Guessed ctype of "{0}": "{1}"'.format(path, ctype))
     return ctype
 
 
+class ChunkedReader(io.RawIOBase):
+    """Read-only file-like object over an iterable of byte chunks
+
+    Allows streamed contents to be consumed by APIs that expect a file
+    object without joining all the chunks in memory.
+    """
+
+    def __init__(self, chunks):
+        super(ChunkedReader, self).__init__()
+        self._chunks = iter(chunks)
+        self._pending = b''
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        # Unlike raw reads, the requested size is always filled unless
+        # the chunks are exhausted (multipart uploads rely on it)
+        if size is None or size < 0:
+            return self.readall()
+        buf = bytearray()
+        while len(buf) < size:
+            b = bytearray(size - len(buf))
+            n = self.readinto(b)
+            if not n:
+                break
+            buf += b[:n]
+        return bytes(buf)
+
+    def readinto(self, b):
+        while not self._pending:
+            try:
+                self._pending = next(self._chunks)
+            except StopIteration:
+                return 0
+        n = min(len(b), len(self._pending))
+        b[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class HashingReader(io.RawIOBase):
+    """Read-only file-like wrapper that computes the SHA-256 digest of
+    the data as it's being read
+
+    It's intentionally not seekable, so that the uploaders read it
+    sequentially exactly once, buffering the parts they may need to
+    retry.
+    """
+
+    def __init__(self, f):
+        super(HashingReader, self).__init__()
+        self._f = f
+        self._sha256 = hashlib.sha256()
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        self._sha256.update(data)
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        n = len(data)
+        b[:n] = data
+        return n
+
+    def hexdigest(self):
+        return self._sha256.hexdigest()
+
+
 class StorageException(Exception):
     pass
 
@@ -25,8 +225,49 @@ class PathNotFound(StorageException):
     pass
 
 
+class SyncFailed(StorageException):
+    pass
+
+
+class PreconditionFailed(StorageException):
+    """Raised when a conditional write fails because the object was
+    modified (or created) by someone else since it was read
+    """
+    pass
+
+
 class Storage(object):
 
+    # Capabilities of the backend, based on which the publish and
+    # reindex operations pick the cheapest way of doing things:
+    #
+    # supports_batch_exists: `paths_exist` answers for many paths of a
+    #   dir with a single listing, which is cheaper than calling
+    #   `path_exists` for each of them
+    # supports_conditional_put: writes can be made conditional on the
+    #   current version of the object (optimistic concurrency)
+    supports_batch_exists = False
+    supports_conditional_put = False
+
+    # Encoding (eg. 'gzip') in which the indexes are to be stored
+    # pre-compressed. None means uncompressed.
+    compress_indexes = None
+
+    # Cache-Control policies for dists (uploaded with `put_file`) and
+    # indexes (uploaded with `put_contents` or `put_stream`)
+    dist_cache_control = DIST_CACHE_CONTROL
+    index_cache_control = INDEX_CACHE_CONTROL
+
+    def cache_control(self, is_index, encoding=None):
+        """Returns the Cache-Control header for the class of object or
+        None if it's not to be set
+        """
+        policy = self.index_cache_control if is_index else self.dist_cache_control
+        directives = [policy]
+        if encoding is not None:
+            directives.append(COMPRESSED_CACHE_CONTROL)
+        return ', '.join(d for d in directives if d) or None
+
     def join_path(self, *args):
         raise NotImplementedError
 
@@ -36,22 +277,140 @@ class Storage(object):
     def path_exists(self, path):
         raise NotImplementedError
 
-    def put_contents(self, contents, dest, sync=False):
+    def paths_exist(self, paths):
+        """Checks whether each of the given paths exists
+
+        If the backend `supports_batch_exists`, the paths are grouped
+        by their parent dir and every dir is listed only once, so
+        checking all the artifacts of a package costs a single
+        (paginated) listing instead of one request per path. Otherwise
+        `path_exists` is called for every path. Returns a dict mapping
+        every path to a bool.
+        """
+        if not self.supports_batch_exists:
+            return {path: self.path_exists(path) for path in paths}
+        listings = {}
+        result = {}
+        for path in paths:
+            parent, name = posixpath.split(path)
+            if parent not in listings:
+                try:
+                    listings[parent] = set(self.listdir(parent or '.'))
+                except PathNotFound:
+                    listings[parent] = set()
+            result[path] = name in listings[parent]
+        return result
+
+    def get_contents(self, path):
+        raise NotImplementedError
+
+    def put_contents(self, contents, dest, sync=False, content_type=None,
+                     encoding=None):
+        """Writes the contents (str) to dest
+
+        The content type is guessed from dest unless explicitly
+        passed. If an `encoding` (eg. 'gzip') is passed, the contents
+        are stored pre-compressed using it, so that they can be served
+        with the corresponding Content-Encoding.
+        """
         raise NotImplementedError
 
+    def put_stream(self, chunks, dest, sync=False, content_type=None,
+                   encoding=None):
+        """Writes the utf-8 encoded byte chunks to dest
+
+        Accepts the same options as `put_contents`. Backends should
+        override this to upload the chunks (compressing them
+        incrementally if required) without building the full body in
+        memory. This default implementation simply joins them.
+        """
+        contents = b''.join(chunks).decode('utf-8')
+        return self.put_contents(contents, dest, sync=sync,
+                                 content_type=content_type,
+                                 encoding=encoding)
+
+    def has_encoding(self, path, encoding):
+        """Returns whether the object at path is stored in the
+        `encoding` (None for uncompressed) it would be written with
+
+        Backends that store the encoding in the object itself don't
+        need to override this. Those that store the compressed
+        contents separately (eg. in sibling files) should, so that
+        unchanged contents are still rewritten when the encoding
+        changes.
+        """
+        return True
+
     def put_file(self, src, dest, sync=False):
+        """Uploads the file at src to dest
+
+        The SHA-256 digest of the file is stored along with the
+        uploaded object by the upload itself (see `get_metadata`).
+        Returns the hex digest.
+        """
+        raise NotImplementedError
+
+    def get_metadata(self, path):
+        """Returns the metadata stored along with the object at path
+
+        The 'sha256' key is present for objects uploaded with
+        `put_file`.
+        """
+        raise NotImplementedError
+
+    def path_token(self, path):
+        """Returns an opaque token (eg. ETag) that changes whenever the
+        object at path is modified or None if it doesn't exist
+
+        Backends that can't provide one return None, in which case
+        nothing is cached based on it.
+        """
+        return None
+
+    def get_versioned_contents(self, path):
+        """Returns a tuple of the contents (str) of path and the token of
+        the version that was read (see `path_token`)
+
+        Backends that `supports_conditional_put` must read both
+        atomically, ie. the token must be of the returned contents.
+        """
+        return self.get_contents(path), self.path_token(path)
+
+    def put_contents_if_match(self, contents, dest, token, content_type=None,
+                              encoding=None):
+        """Writes the contents to dest only if the object at dest is
+        still at the version identified by `token`, or doesn't exist
+        if `token` is None
+
+        Raises `PreconditionFailed` otherwise. Returns the token of the
+        written version. Only available if the backend
+        `supports_conditional_put`.
+        """
         raise NotImplementedError
 
 
 class LocalFileSystemStorage(Storage):
 
-    def __init__(self, base_path):
+    # Stat calls are cheaper than listing the dir, so the existence
+    # of every path is checked on its own
+    supports_batch_exists = False
+    # Conditional writes are serialized using locks on the dirs of the
+    # files, which requires fcntl
+    supports_conditional_put = fcntl is not None
+
+    # Metadata of the files is stored in json sidecar files
+    METADATA_SUFFIX = '.metadata.json'
+    TMP_PREFIX = '.tmp-'
+
+    def __init__(self, base_path, compress_indexes=None):
         self.base_path = base_path
+        self.compress_indexes = validate_encoding(compress_indexes)
 
     @classmethod
     def from_config(cls, config):
         storage_config = config.storage_config
-        return cls(storage_config['base_path'])
+        return cls(storage_config['base_path'],
+                   compress_indexes=storage_config.get('compress_indexes'))
 
     def join_path(self, *args):
         return os.path.join(*args)
@@ -59,9 +418,12 @@ class LocalFileSystemStorage(Storage):
     def listdir(self, path):
         path = self.join_path(self.base_path, path)
         try:
-            return os.listdir(path)
+            return [f for f in os.listdir(path)
+                    if not (f.endswith(self.METADATA_SUFFIX) or
+                            f.startswith(self.TMP_PREFIX))]
         except OSError as e:
-            if e.errno == errno.ENOENT:
+            # As with the other backends, a file is not a dir
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
                 raise PathNotFound('Path {0} not found'.format(path))
             raise e
 
@@ -69,167 +431,228 @@ class LocalFileSystemStorage(Storage):
         path = self.join_path(self.base_path, path)
         return os.path.exists(path)
 
+    def get_contents(self, path):
+        path = self.join_path(self.base_path, path)
+        try:
+            with open(path) as f:
+                return f.read()
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                raise PathNotFound('Path {0} not found'.format(path))
+            raise e
+
     def ensure_dir(self, path):
-        if not os.path.exists(path):
-            os.makedirs(path)
+        # The dir may be created concurrently by another thread
+        # uploading to the same package
+        os.makedirs(path, exist_ok=True)
+
+    def remove_stale_siblings(self, dest_path, encoding):
+        # The compressed siblings of other encodings (eg. left by an
+        # earlier write with a different compress_indexes) would be
+        # served instead of the new contents
+        for enc, ext in ENCODING_EXTS.items():
+            if enc == encoding:
+                continue
+            try:
+                os.unlink('{0}.{1}'.format(dest_path, ext))
+            except FileNotFoundError:
+                pass
+
+    def has_encoding(self, path, encoding):
+        path = self.join_path(self.base_path, path)
+        return all(os.path.exists('{0}.{1}'.format(path, ext)) == (enc == encoding)
+                   for enc, ext in ENCODING_EXTS.items())
 
-    def put_contents(self, contents, dest, sync=False):
+    def put_contents(self, contents, dest, sync=False, content_type=None,
+                     encoding=None):
         dest_path = self.join_path(self.base_path, dest)
         self.ensure_dir(os.path.dirname(dest_path))
         with open(dest_path, 'w') as f:
             f.write(contents)
+        # The compressed contents are written to a sibling file with
+        # the extension of the encoding (eg. index.json.gz) to be
+        # served using nginx's gzip_static
+        if encoding is not None:
+            with open('{0}.{1}'.format(dest_path, ENCODING_EXTS[encoding]), 'wb') as f:
+                f.write(compress(contents.encode('utf-8'), encoding))
+        self.remove_stale_siblings(dest_path, encoding)
         # In LocalFileSystemStorage sync makes no sense
         return dest_path
 
-    def put_file(self, src, dest, sync=False):
+    def put_stream(self, chunks, dest, sync=False, content_type=None,
+                   encoding=None):
         dest_path = self.join_path(self.base_path, dest)
         self.ensure_dir(os.path.dirname(dest_path))
-        shutil.copy(src, dest_path)
+        self.remove_stale_siblings(dest_path, encoding)
+        if encoding is None:
+            with open(dest_path, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            return dest_path
+
+        # Chunks are written to the file as well as fed to the
+        # compressor which writes the compressed sibling file
+        def tee(f):
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+
+        compressed_path = '{0}.{1}'.format(dest_path, ENCODING_EXTS[encoding])
+        with open(dest_path, 'wb') as f, open(compressed_path, 'wb') as cf:
+            for out in compress_chunks(tee(f), encoding):
+                cf.write(out)
         return dest_path
 
-    def __repr__(self):
-        return (
-            '<LocalFileSystemStorage(base_path="{0}")>'
-        ).format(self.base_path)
-
-
-class AWSS3Storage(Storage):
-
-    def __init__(self, bucket, acl, creds=None, prefix=None,
-                 endpoint=None, region=None):
-        if creds:
-            logger.info('S3 Auth: using explicitly passed credentials')
-            access_key, secret_key, session_token = creds
-            session = boto3.Session(aws_access_key_id=access_key,
-                                    aws_secret_access_key=secret_key,
-                                    aws_session_token=session_token)
-        else:
-            logger.info('S3 Auth: using default boto3 methods')
-            session = boto3.Session()
-        self.endpoint = endpoint
-        self.region = region
-        kwargs = dict()
-        if endpoint is not None:
-            kwargs['endpoint_url'] = endpoint
-        if region is not None:
-            kwargs['region_name'] = region
-        self.s3 = s3 = session.resource('s3', **kwargs)
-        self.bucket = s3.Bucket(bucket)
-        self.prefix = prefix
-        self.acl = acl
-
-    @classmethod
-    def from_config(cls, config):
-        storage_config = config.storage_config
-        env = config.env
-        bucket = storage_config['bucket']
-        prefix = storage_config.get('prefix')
-        acl = storage_config.get('acl', 'private')
-        endpoint = storage_config.get('endpoint', None)
-        region = storage_config.get('region', None)
-        # Following 2 are the required env vars for s3 auth. If any of
-        # these are not set, we try using the default boto3 methods
-        # (same as the ones that AWS CLI and other tools support)
-        pp_cred_keys = ['PP_S3_ACCESS_KEY', 'PP_S3_SECRET_KEY']
-        if all([(k in env) for k in pp_cred_keys]):
-            logger.debug('PP_S3_* env vars found: using them for auth')
-            creds = (env['PP_S3_ACCESS_KEY'],
-                     env['PP_S3_SECRET_KEY'],
-                     env.get('PP_S3_SESSION_TOKEN', None))
-        else:
-            logger.debug((
-                'PP_S3_* env vars not found: '
-                'Falling back to default methods supported by boto3'
-            ))
-            creds = None
-        return cls(bucket, acl, creds=creds, prefix=prefix,
-                   endpoint=endpoint, region=region)
-
-    def join_path(self, *args):
-        return '/'.join(args)
+    def put_file(self, src, dest, sync=False):
+        dest_path = self.join_path(self.base_path, dest)
+        self.ensure_dir(os.path.dirname(dest_path))
+        with open(src, 'rb') as fsrc, open(dest_path, 'wb') as fdest:
+            reader = HashingReader(fsrc)
+            shutil.copyfileobj(reader, fdest)
+        shutil.copymode(src, dest_path)
+        digest = reader.hexdigest()
+        with open(dest_path + self.METADATA_SUFFIX, 'w') as f:
+            json.dump({'sha256': digest}, f)
+        return digest
+
+    def get_metadata(self, path):
+        path = self.join_path(self.base_path, path)
+        try:
+            with open(path + self.METADATA_SUFFIX) as f:
+                return json.load(f)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise e
+        if not os.path.exists(path):
+            raise PathNotFound('Path {0} not found'.format(path))
+        return {}
 
-    def prefixed_path(self, path):
-        parts = []
-        if self.prefix:
-            parts.append(self.prefix)
-        if path != '.':
-            parts.append(path)
-        return self.join_path(*parts)
+    @staticmethod
+    def stat_token(st):
+        # Conditional writes replace the file, so the inode changes
+        # even if the mtime and size don't
+        return '{0}-{1}-{2}'.format(st.st_ino, st.st_mtime_ns, st.st_size)
 
-    def listdir(self, path):
-        path = self.prefixed_path(path)
-        if path != '' and not path.endswith('/'):
-            s3_prefix = '{0}/'.format(path)
-        else:
-            s3_prefix = path
-        logger.debug('Listing objects prefixed with: {0}'.format(s3_prefix))
-        client = self.s3.meta.client
-        paginator = client.get_paginator('list_objects')
-        response = paginator.paginate(Bucket=self.bucket.name,
-                                      Prefix=s3_prefix,
-                                      Delimiter='/')
-        file_objs = [c for c in response.search('Contents') if c]
-        dir_objs = [cp for cp in response.search('CommonPrefixes') if cp]
-        # If no objs found, it means the path doesn't exist
-        if len(file_objs) == len(dir_objs) == 0:
-            raise PathNotFound('Path {0} not found'.format(s3_prefix))
-        files = (c['Key'][len(s3_prefix):] for c in file_objs)
-        files = [f for f in files if f != '']
-        dirs = [cp['Prefix'][len(s3_prefix):].rstrip('/') for cp in dir_objs]
-        return files + dirs
+    def path_token(self, path):
+        path = self.join_path(self.base_path, path)
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise e
+        return self.stat_token(st)
 
-    def path_exists(self, path):
-        path = self.prefixed_path(path)
-        logger.debug('Checking if key exists: {0}'.format(path))
-        client = self.s3.meta.client
+    def get_versioned_contents(self, path):
+        path = self.join_path(self.base_path, path)
         try:
-            client.head_object(Bucket=self.bucket.name, Key=path)
-        except ClientError as e:
-            logger.debug('Handled ClientError: {0}'.format(e))
-            return False
-        else:
-            return True
-
-    def put_contents(self, contents, dest, sync=False):
-        dest_path = self.prefixed_path(dest)
-        client = self.s3.meta.client
-        logger.debug('Writing content to s3: {0}'.format(dest_path))
-        client.put_object(Bucket=self.bucket.name,
-                          Key=dest_path,
-                          Body=contents.encode('utf-8'),
-                          ContentType=guess_content_type(dest),
-                          ACL=self.acl)
-        if sync:
-            waiter = client.get_waiter('object_exists')
-            waiter.wait(Bucket=self.bucket.name, Key=dest_path)
+            with open(path) as f:
+                return f.read(), self.stat_token(os.fstat(f.fileno()))
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                raise PathNotFound('Path {0} not found'.format(path))
+            raise e
 
-    def put_file(self, src, dest, sync=False):
-        dest_path = self.prefixed_path(dest)
-        client = self.s3.meta.client
-        logger.debug('Uploading file to s3: {0} -> {1}'.format(src, dest_path))
-        with open(src, 'rb') as f:
-            client.put_object(Bucket=self.bucket.name,
-                              Key=dest_path,
-                              Body=f,
-                              ContentType=guess_content_type(dest),
-                              ACL=self.acl)
-        if sync:
-            waiter = client.get_waiter('object_exists')
-            waiter.wait(Bucket=self.bucket.name, Key=dest_path)
+    def replace_contents(self, data, dest_path):
+        # The data is written to a temp file in the same dir which is
+        # then renamed over dest_path, so that readers never see a
+        # partially written file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest_path),
+                                        prefix=self.TMP_PREFIX)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, dest_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def put_contents_if_match(self, contents, dest, token, content_type=None,
+                              encoding=None):
+        dest_path = self.join_path(self.base_path, dest)
+        self.ensure_dir(os.path.dirname(dest_path))
+        # The lock is held on the dir (as dest is replaced) while the
+        # current version is compared and replaced. Unlike a lock file,
+        # it leaves nothing in the served tree.
+        lock = os.open(os.path.dirname(dest_path), os.O_RDONLY)
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            current = self.path_token(dest)
+            if current != token:
+                raise PreconditionFailed((
+                    'Path {0} was modified: expected version {1}, found {2}'
+                ).format(dest_path, token, current))
+            data = contents.encode('utf-8')
+            if encoding is not None:
+                self.replace_contents(compress(data, encoding),
+                                      '{0}.{1}'.format(dest_path, ENCODING_EXTS[encoding]))
+            self.replace_contents(data, dest_path)
+            self.remove_stale_siblings(dest_path, encoding)
+            return self.path_token(dest)
+        finally:
+            # Closing the dir releases the lock
+            os.close(lock)
 
     def __repr__(self):
         return (
-            '<AWSS3Storage(bucket="{0}", prefix="{1}")>'
-        ).format(self.bucket.name, self.prefix)
+            '<LocalFileSystemStorage(base_path="{0}")>'
+        ).format(self.base_path)
+
+
+# Entry point group in which third party packages can register
+# storage backends by the type to be used in the [storage] section of
+# the config, eg.
+#
+#   entry_points={
+#       'pypiprivate.storage_backends': [
+#           'gcs = pypiprivate_gcs:GCSStorage'
+#       ]
+#   }
+STORAGE_BACKENDS_GROUP = 'pypiprivate.storage_backends'
+
+# Built-in storage backends. These are also registered as entry points
+# but are looked up here first so that the metadata of the installed
+# packages needn't be scanned in the common case. The SDK of a backend
+# (boto3, azure-storage-blob) is imported only when it's selected, so
+# that it doesn't add to the startup time of the CLI when a different
+# backend is used.
+STORAGE_BACKENDS = {
+    'local-filesystem': 'pypiprivate.storage:LocalFileSystemStorage',
+    'aws-s3': 'pypiprivate.s3:AWSS3Storage',
+    'azure': 'pypiprivate.azure:AzureBlobStorage',
+}
+
+
+def iter_entry_points(group):
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        return []
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        return eps.select(group=group)
+    # Python < 3.10 returns a dict of entry points by group
+    return eps.get(group, [])
+
+
+def get_storage_class(storage_type):
+    spec = STORAGE_BACKENDS.get(storage_type)
+    if spec is not None:
+        module_name, class_name = spec.split(':')
+        return getattr(import_module(module_name), class_name)
+    for ep in iter_entry_points(STORAGE_BACKENDS_GROUP):
+        if ep.name == storage_type:
+            return ep.load()
+    raise ValueError('Unsupported storage "{0}"'.format(storage_type))
 
 
 def load_storage(config):
-    if config.storage == 'local-filesystem':
-        return LocalFileSystemStorage.from_config(config)
-    elif config.storage == 'aws-s3':
-        return AWSS3Storage.from_config(config)
-    elif config.storage == 'azure':
-        from pypiprivate.azure import AzureBlobStorage
-        return AzureBlobStorage.from_config(config)
-    else:
-        raise ValueError('Unsupported storage "{0}"'.format(config.storage))
+    return get_storage_class(config.storage).from_config(config)
+
+
+def __getattr__(name):
+    # AWSS3Storage used to be defined in this module
+    if name == 'AWSS3Storage':
+        return get_storage_class('aws-s3')
+    raise AttributeError('module {0!r} has no attribute {1!r}'.format(__name__, name))
@@ -16,7 +16,20 @@ with open('./README.rst') as f:
 
 extras_require = {
     'azure': [
-        'azure-storage-blob==12.2.0'
+        'azure-storage-blob>=12.5.0'
+    ],
+    'brotli': [
+        'brotli'
+    ],
+    'aws-async': [
+        'aiobotocore'
+    ],
+    'azure-async': [
+        'azure-storage-blob>=12.5.0',
+        'aiohttp'
+    ],
+    'opentelemetry': [
+        'opentelemetry-api'
     ]
 }
 
@@ -30,22 +43,32 @@ setup(
     license='MIT License',
     description='Private package management tool for Python projects',
     long_description=long_desc,
-    install_requires=['setuptools>=36.0.0',
+    install_requires=['packaging',
                       'Jinja2==2.10.0',
-                      'boto3==1.5.27'],
+                      'boto3>=1.35.69'],
     extras_require=extras_require,
     packages=['pypiprivate'],
+    python_requires='>=3.8',
     entry_points={
         'console_scripts': [
             'pypi-private = pypiprivate.cli:main'
+        ],
+        'pypiprivate.storage_backends': [
+            'local-filesystem = pypiprivate.storage:LocalFileSystemStorage',
+            'aws-s3 = pypiprivate.s3:AWSS3Storage',
+            'azure = pypiprivate.azure:AzureBlobStorage'
         ]
     },
     classifiers=[
         'Environment :: Console',
         'Intended Audience :: Developers',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 2.7',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12',
     ]
 )
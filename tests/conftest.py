@@ -0,0 +1,44 @@
+"""Fixtures shared by the tests"""
+
+import io
+import tarfile
+import zipfile
+
+import pytest
+
+
+def _make_wheel(path, name, version, requires_python=None):
+    metadata = 'Metadata-Version: 2.1\nName: {0}\nVersion: {1}\n'.format(name, version)
+    if requires_python:
+        metadata += 'Requires-Python: {0}\n'.format(requires_python)
+    with zipfile.ZipFile(path, 'w') as zf:
+        zf.writestr('{0}/__init__.py'.format(name), '')
+        zf.writestr('{0}-{1}.dist-info/METADATA'.format(name, version), metadata)
+
+
+def _make_sdist(path, name, version, requires_python=None):
+    metadata = 'Metadata-Version: 2.1\nName: {0}\nVersion: {1}\n'.format(name, version)
+    if requires_python:
+        metadata += 'Requires-Python: {0}\n'.format(requires_python)
+    data = metadata.encode('utf-8')
+    info = tarfile.TarInfo('{0}-{1}/PKG-INFO'.format(name, version))
+    info.size = len(data)
+    mode = 'w:xz' if path.endswith('.tar.xz') else 'w:gz'
+    with tarfile.open(path, mode) as tf:
+        tf.addfile(info, io.BytesIO(data))
+
+
+@pytest.fixture
+def make_wheel():
+    """Returns a function that writes a wheel with just the core
+    metadata to path
+    """
+    return _make_wheel
+
+
+@pytest.fixture
+def make_sdist():
+    """Returns a function that writes an sdist with just the PKG-INFO
+    to path (.tar.gz or .tar.xz)
+    """
+    return _make_sdist
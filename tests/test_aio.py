@@ -0,0 +1,243 @@
+import sys
+import time
+import types
+import asyncio
+import hashlib
+import threading
+
+import pytest
+
+import pypiprivate.aio as pa
+import pypiprivate.publish as pp
+import pypiprivate.storage as ps
+
+
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
+
+def test_async_publish_package_local(tmpdir, make_wheel):
+    dist_dir = tmpdir.mkdir('dist')
+    dist_dir.join('abc-0.1.0.tar.gz').write('sdist')
+    whl = str(dist_dir.join('abc-0.1.0-py2-none-any.whl'))
+    make_wheel(whl, 'abc', '0.1.0', '>=2.7')
+    storage = ps.LocalFileSystemStorage(str(tmpdir.join('simple')))
+
+    asyncio.run(pa.async_publish_package('abc', '0.1.0', storage,
+                                         str(tmpdir), 'dist', jobs=2))
+    assert '<a href="abc">' in tmpdir.join('simple', 'index.html').read()
+    index = tmpdir.join('simple', 'abc', 'index.html').read()
+    assert ('<a href="abc-0.1.0-py2-none-any.whl#sha256={0}" '
+            'data-requires-python="&gt;=2.7">').format(pp.file_sha256(whl)) in index
+
+    # Republishing identical dists is a no-op
+    with mock.patch.object(storage, 'put_file') as put_file:
+        asyncio.run(pa.async_publish_package('abc', '0.1.0', storage,
+                                             str(tmpdir), 'dist'))
+        assert put_file.call_count == 0
+
+    dist_dir.join('abc-0.1.0.tar.gz').write('rebuilt sdist')
+    with pytest.raises(pp.DistMismatch):
+        asyncio.run(pa.async_publish_package('abc', '0.1.0', storage,
+                                             str(tmpdir), 'dist'))
+
+
+def test_async_publish_package_bounded(tmpdir, monkeypatch):
+    dists = []
+    for i in range(6):
+        path = tmpdir.join('abc-0.1.0-{0}.tar.gz'.format(i))
+        path.write(str(i))
+        dists.append({'pkg': 'abc',
+                      'normalized_name': 'abc',
+                      'artifact': path.basename,
+                      'path': str(path)})
+    monkeypatch.setattr(pp, 'find_pkg_dists', lambda *args: dists)
+    monkeypatch.setattr(pa, 'find_pkg_dists', lambda *args: dists)
+    storage = ps.LocalFileSystemStorage(str(tmpdir.join('simple')))
+    lock = threading.Lock()
+    active = []
+    peak = []
+    _put_file = storage.put_file
+
+    def put_file(src, dest, sync=False):
+        with lock:
+            active.append(dest)
+            peak.append(len(active))
+        time.sleep(0.02)
+        with lock:
+            active.remove(dest)
+        return _put_file(src, dest, sync=sync)
+
+    monkeypatch.setattr(storage, 'put_file', put_file)
+    asyncio.run(pa.async_publish_package('abc', '0.1.0', storage,
+                                         str(tmpdir), 'dist', jobs=2))
+    assert len(peak) == 6
+    assert max(peak) <= 2
+    assert all(d['sha256'] == pp.file_sha256(d['path']) for d in dists)
+
+
+def test_AsyncStorage_apaths_exist(tmpdir):
+    tmpdir.mkdir('abc').join('abc-0.1.0.tar.gz').write('')
+    storage = pa.get_async_storage(ps.LocalFileSystemStorage(str(tmpdir)))
+    assert type(storage) is pa.AsyncStorage
+    paths = ['abc/abc-0.1.0.tar.gz',
+             'abc/abc-0.1.0-py2-none-any.whl',
+             'xyz/xyz-1.0.tar.gz']
+    expected = {'abc/abc-0.1.0.tar.gz': True,
+                'abc/abc-0.1.0-py2-none-any.whl': False,
+                'xyz/xyz-1.0.tar.gz': False}
+
+    # The local filesystem checks every path on its own
+    with mock.patch.object(storage.storage, 'listdir') as listdir:
+        assert asyncio.run(storage.apaths_exist(paths)) == expected
+        assert listdir.call_count == 0
+
+    # Backends that support batch existence checks list every dir once
+    storage.storage.supports_batch_exists = True
+    with mock.patch.object(storage.storage, 'listdir',
+                           wraps=storage.storage.listdir) as listdir:
+        assert asyncio.run(storage.apaths_exist(paths)) == expected
+        assert sorted(c[0][0] for c in listdir.call_args_list) == ['abc', 'xyz']
+
+
+def test_get_async_storage():
+    import pypiprivate.s3 as s3
+    with mock.patch('pypiprivate.s3.boto3.Session'):
+        storage = s3.AWSS3Storage('mybucket', 'private')
+    with mock.patch('pypiprivate.aio.find_spec', return_value=None):
+        assert type(pa.get_async_storage(storage)) is pa.AsyncStorage
+    with mock.patch('pypiprivate.aio.find_spec', return_value=mock.Mock()):
+        assert type(pa.get_async_storage(storage)) is pa.AsyncAWSS3Storage
+    astorage = pa.AsyncStorage(storage)
+    assert pa.get_async_storage(astorage) is astorage
+
+
+def test_AsyncAWSS3Storage(tmpdir):
+    import pypiprivate.s3 as s3
+    from botocore.exceptions import ClientError
+    with mock.patch('pypiprivate.s3.boto3.Session'):
+        storage = s3.AWSS3Storage('mybucket', 'private', prefix='simple',
+                                  sync_strategy='none')
+    client = mock.Mock()
+    client.put_object = mock.AsyncMock(return_value={})
+    client.head_object = mock.AsyncMock(side_effect=[
+        {'Metadata': {'sha256': 'abc'}},
+        ClientError({'Error': {'Code': '404'}}, 'HeadObject'),
+    ])
+    astorage = pa.AsyncAWSS3Storage(storage, client=client)
+
+    src = tmpdir.join('abc-0.1.0.tar.gz')
+    src.write('abc')
+
+    async def run():
+        async with astorage:
+            digest = await astorage.aput_file(str(src), 'abc/abc-0.1.0.tar.gz')
+            await astorage.aput_contents('<html></html>', 'abc/index.html')
+            assert await astorage.apath_exists('abc/abc-0.1.0.tar.gz')
+            assert not await astorage.apath_exists('abc/abc-0.2.0.tar.gz')
+            return digest
+
+    digest = asyncio.run(run())
+    assert digest == hashlib.sha256(b'abc').hexdigest()
+    (_, file_kwargs), (_, index_kwargs) = client.put_object.call_args_list
+    assert file_kwargs == {'Bucket': 'mybucket',
+                           'Key': 'simple/abc/abc-0.1.0.tar.gz',
+                           'Body': b'abc',
+                           'ContentType': 'application/x-tar',
+                           'ACL': 'private',
+                           'Metadata': {'sha256': digest},
+                           'CacheControl': ps.DIST_CACHE_CONTROL}
+    assert index_kwargs['Key'] == 'simple/abc/index.html'
+    assert index_kwargs['ContentType'] == 'text/html'
+    assert index_kwargs['CacheControl'] == ps.INDEX_CACHE_CONTROL
+    client.head_object.assert_called_with(Bucket='mybucket',
+                                          Key='simple/abc/abc-0.2.0.tar.gz')
+
+
+def test_AsyncAWSS3Storage_open_concurrently(monkeypatch):
+    import pypiprivate.s3 as s3
+    with mock.patch('pypiprivate.s3.boto3.Session'):
+        storage = s3.AWSS3Storage('mybucket', 'private')
+    storage.session.get_credentials.return_value = None
+
+    class ClientContext(object):
+        async def __aenter__(self):
+            # Yields to the other operations while connecting
+            await asyncio.sleep(0.01)
+            return mock.Mock()
+
+        async def __aexit__(self, *args):
+            pass
+
+    session = mock.Mock()
+    session.create_client.side_effect = lambda *args, **kwargs: ClientContext()
+    module = types.ModuleType('aiobotocore.session')
+    module.get_session = lambda: session
+    monkeypatch.setitem(sys.modules, 'aiobotocore', types.ModuleType('aiobotocore'))
+    monkeypatch.setitem(sys.modules, 'aiobotocore.session', module)
+    astorage = pa.AsyncAWSS3Storage(storage)
+
+    async def run():
+        # The operations gathered on first use all open the storage
+        await asyncio.gather(*[astorage.open() for _ in range(8)])
+        client = astorage.client
+        await astorage.aclose()
+        return client
+
+    assert asyncio.run(run()) is not None
+    assert session.create_client.call_count == 1
+    assert astorage.client is None
+
+
+class FakeAsyncBlobs(object):
+
+    def __init__(self, blobs):
+        self.blobs = blobs
+
+    def __aiter__(self):
+        return self._iter()
+
+    async def _iter(self):
+        for blob in self.blobs:
+            yield blob
+
+
+def test_AsyncAzureBlobStorage(tmpdir):
+    pytest.importorskip('azure.storage.blob')
+    import pypiprivate.azure as paz
+    storage = paz.AzureBlobStorage('conn-str', 'mycontainer', prefix='simple')
+    container_client = mock.Mock()
+    container_client.upload_blob = mock.AsyncMock()
+    blobs = []
+    for name in ['simple/abc/abc-0.1.0.tar.gz', 'simple/abc/index.html']:
+        blob = mock.Mock()
+        blob.name = name
+        blobs.append(blob)
+    container_client.walk_blobs.side_effect = lambda name_starts_with, delimiter: FakeAsyncBlobs(
+        [b for b in blobs if b.name.startswith(name_starts_with)])
+    container_client.get_blob_client.side_effect = lambda name: mock.Mock(
+        exists=mock.AsyncMock(return_value=name in [b.name for b in blobs]))
+    astorage = pa.AsyncAzureBlobStorage(storage, container_client=container_client)
+
+    src = tmpdir.join('abc-0.1.0.tar.gz')
+    src.write('abc')
+
+    async def run():
+        digest = await astorage.aput_file(str(src), 'abc/abc-0.1.0.tar.gz')
+        listing = await astorage.alistdir('abc')
+        exists = await astorage.apaths_exist(['abc/abc-0.1.0.tar.gz',
+                                              'abc/abc-0.2.0.tar.gz'])
+        return digest, listing, exists
+
+    digest, listing, exists = asyncio.run(run())
+    assert digest == hashlib.sha256(b'abc').hexdigest()
+    kwargs = container_client.upload_blob.call_args[1]
+    assert kwargs['name'] == 'simple/abc/abc-0.1.0.tar.gz'
+    assert kwargs['data'] == b'abc'
+    assert kwargs['metadata'] == {'sha256': digest}
+    assert kwargs['content_settings'].cache_control == ps.DIST_CACHE_CONTROL
+    assert sorted(listing) == ['abc-0.1.0.tar.gz', 'index.html']
+    assert exists == {'abc/abc-0.1.0.tar.gz': True,
+                      'abc/abc-0.2.0.tar.gz': False}
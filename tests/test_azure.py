@@ -0,0 +1,177 @@
+import hashlib
+
+import pytest
+
+pytest.importorskip('azure.storage.blob')
+
+import pypiprivate.azure as pa
+
+
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
+
+def test_AzureBlobStorage__from_config():
+    sc = {'container': 'mycontainer',
+          'prefix': 'simple',
+          'multipart_threshold': '32MB',
+          'multipart_chunksize': '8MB',
+          'max_concurrency': '6',
+          'max_pool_connections': '32',
+          'read_timeout': '30'}
+    env = {'PP_AZURE_CONN_STR': 'conn-str'}
+    config = mock.Mock(storage_config=sc, env=env)
+    with mock.patch('pypiprivate.azure.BlobServiceClient') as m, \
+         mock.patch('pypiprivate.azure.make_transport') as mt:
+        s = pa.AzureBlobStorage.from_config(config)
+        assert s.prefix == 'simple'
+        assert s.max_concurrency == 6
+        mt.assert_called_once_with(max_pool_connections=32,
+                                   connect_timeout=10,
+                                   read_timeout=30)
+        client = s.blob_service_client
+        m.from_connection_string.assert_called_once_with('conn-str',
+                                                         max_single_put_size=32 * 1024 * 1024,
+                                                         max_block_size=8 * 1024 * 1024,
+                                                         transport=mt.return_value)
+        assert client is m.from_connection_string.return_value
+
+
+def test_make_transport():
+    transport = pa.make_transport(max_pool_connections=32,
+                                  connect_timeout=5, read_timeout=30)
+    adapter = transport.session.get_adapter('https://example.blob.core.windows.net')
+    assert adapter._pool_maxsize == 32
+    assert transport.connection_config.timeout == 5
+    assert transport.connection_config.read_timeout == 30
+
+
+def test_AzureBlobStorage_content_settings():
+    s = pa.AzureBlobStorage('conn-str', 'mycontainer',
+                            index_cache_control='max-age=60')
+    settings = s.content_settings('abc/abc-0.1.0.tar.gz', is_index=False)
+    assert settings.content_type == 'application/x-tar'
+    assert settings.cache_control == 'public, max-age=31536000, immutable'
+    settings = s.content_settings('abc/index.html', encoding='gzip')
+    assert settings.content_type == 'text/html'
+    assert settings.content_encoding == 'gzip'
+    assert settings.cache_control == 'max-age=60, no-transform'
+
+
+def test_AzureBlobStorage_listdir():
+    s = pa.AzureBlobStorage('conn-str', 'mycontainer', prefix='simple')
+    container_client = mock.Mock()
+    s._container_client = container_client
+    blobs = ['simple/abc/', 'simple/abc/abc-0.1.0.tar.gz',
+             'simple/abc/index.html', 'simple/abc/old/abc-0.0.1.tar.gz',
+             'simple/index.html']
+
+    def walk_blobs(name_starts_with, delimiter):
+        # Emulates the hierarchical listing of the service
+        names = []
+        for b in blobs:
+            if not b.startswith(name_starts_with):
+                continue
+            rest = b[len(name_starts_with):]
+            if delimiter in rest[:-1]:
+                b = name_starts_with + rest.split(delimiter)[0] + delimiter
+            if b not in names:
+                names.append(b)
+        items = []
+        for name in names:
+            item = mock.Mock()
+            item.name = name
+            items.append(item)
+        return iter(items)
+
+    container_client.walk_blobs.side_effect = walk_blobs
+    assert s.listdir('abc') == ['abc-0.1.0.tar.gz', 'index.html', 'old']
+    container_client.walk_blobs.assert_called_with(name_starts_with='simple/abc/',
+                                                   delimiter='/')
+    assert s.listdir('.') == ['abc', 'index.html']
+    with pytest.raises(pa.PathNotFound):
+        s.listdir('xyz')
+
+    container_client.get_blob_client.return_value.exists.return_value = True
+    assert s.path_exists('abc/abc-0.1.0.tar.gz')
+    container_client.get_blob_client.assert_called_with('simple/abc/abc-0.1.0.tar.gz')
+    assert container_client.list_blobs.call_count == 0
+
+
+def test_AzureBlobStorage_put_file(tmpdir):
+    s = pa.AzureBlobStorage('conn-str', 'mycontainer', prefix='simple',
+                            multipart_threshold=1024, multipart_chunksize=1000,
+                            max_concurrency=2)
+    container_client = mock.Mock()
+    s._container_client = container_client
+    blob_client = container_client.get_blob_client.return_value
+
+    # Small files are uploaded with their digest in a single request
+    src = tmpdir.join('abc-0.1.0.tar.gz')
+    src.write('abc')
+    digest = s.put_file(str(src), 'abc/abc-0.1.0.tar.gz')
+    assert digest == hashlib.sha256(b'abc').hexdigest()
+    kwargs = container_client.upload_blob.call_args[1]
+    assert kwargs['name'] == 'simple/abc/abc-0.1.0.tar.gz'
+    assert kwargs['metadata'] == {'sha256': digest}
+    assert blob_client.stage_block.call_count == 0
+
+    # Large files are staged as blocks and the digest is set as
+    # metadata when they're committed
+    src = tmpdir.join('abc-0.2.0.tar.gz')
+    src.write('x' * 4500)
+    digest = s.put_file(str(src), 'abc/abc-0.2.0.tar.gz')
+    assert digest == hashlib.sha256(b'x' * 4500).hexdigest()
+    container_client.get_blob_client.assert_called_with('simple/abc/abc-0.2.0.tar.gz')
+    staged = sorted(c[0] for c in blob_client.stage_block.call_args_list)
+    assert [len(data) for _, data in staged] == [1000, 1000, 1000, 1000, 500]
+    blocks, = blob_client.commit_block_list.call_args[0]
+    assert [b.id for b in blocks] == [block_id for block_id, _ in staged]
+    kwargs = blob_client.commit_block_list.call_args[1]
+    assert kwargs['metadata'] == {'sha256': digest}
+    assert kwargs['content_settings'].content_type == 'application/x-tar'
+    assert blob_client.set_blob_metadata.call_count == 0
+
+
+def test_AzureBlobStorage_put_contents_if_match():
+    from azure.core import MatchConditions
+    from azure.core.exceptions import (ResourceModifiedError, ResourceExistsError,
+                                       ResourceNotFoundError)
+    s = pa.AzureBlobStorage('conn-str', 'mycontainer', prefix='simple')
+    container_client = mock.Mock()
+    s._container_client = container_client
+    container_client.upload_blob.return_value = {'etag': '"v2"'}
+    assert s.put_contents_if_match('{}', 'abc/manifest.json', '"v1"') == '"v2"'
+    kwargs = container_client.upload_blob.call_args[1]
+    assert kwargs['name'] == 'simple/abc/manifest.json'
+    assert kwargs['etag'] == '"v1"'
+    assert kwargs['match_condition'] == MatchConditions.IfNotModified
+
+    s.put_contents_if_match('{}', 'abc/manifest.json', None)
+    kwargs = container_client.upload_blob.call_args[1]
+    assert kwargs['overwrite'] is False
+    assert 'etag' not in kwargs
+
+    for error in (ResourceModifiedError, ResourceExistsError):
+        container_client.upload_blob.side_effect = error('conflict')
+        with pytest.raises(pa.PreconditionFailed):
+            s.put_contents_if_match('{}', 'abc/manifest.json', '"v1"')
+
+    # The blob that was read is deleted since
+    def not_found(error_code):
+        error = ResourceNotFoundError('not found')
+        error.error_code = error_code
+        return error
+
+    container_client.upload_blob.side_effect = not_found('BlobNotFound')
+    with pytest.raises(pa.PreconditionFailed):
+        s.put_contents_if_match('{}', 'abc/manifest.json', '"v1"')
+    # Other missing resources aren't conflicts
+    container_client.upload_blob.side_effect = not_found('ContainerNotFound')
+    with pytest.raises(ResourceNotFoundError):
+        s.put_contents_if_match('{}', 'abc/manifest.json', '"v1"')
+    container_client.upload_blob.side_effect = not_found('BlobNotFound')
+    with pytest.raises(ResourceNotFoundError):
+        s.put_contents_if_match('{}', 'abc/manifest.json', None)
@@ -0,0 +1,147 @@
+import posixpath
+
+import pypiprivate.cache as pc
+import pypiprivate.storage as ps
+import pypiprivate.cli as cli
+
+
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
+
+class FakeStorage(ps.Storage):
+
+    supports_batch_exists = True
+
+    def __init__(self, files):
+        self.files = files
+        self.listings = 0
+
+    def join_path(self, *args):
+        return posixpath.join(*args)
+
+    def listdir(self, path):
+        self.listings += 1
+        prefix = '' if path == '.' else path + '/'
+        names = [f[len(prefix):] for f in self.files if f.startswith(prefix)]
+        if not names:
+            raise ps.PathNotFound(path)
+        return sorted(set(n.split('/')[0] for n in names))
+
+    def path_token(self, path):
+        return self.files.get(path)
+
+    def __repr__(self):
+        return '<FakeStorage>'
+
+
+def test_ListingCache(tmpdir):
+    cache = pc.ListingCache(str(tmpdir.join('cache', 'listings.sqlite')),
+                            max_entries=2)
+    assert cache.get('a', 'v1') is None
+    cache.put('a', 'v1', ['x', 'y'])
+    assert cache.get('a', 'v1') == ['x', 'y']
+    assert cache.get('a', 'v2') is None
+
+    # The least recently used entry is evicted
+    cache.put('b', 'v1', [])
+    assert cache.get('a', 'v1') == ['x', 'y']
+    cache.put('c', 'v1', ['z'])
+    assert len(cache) == 2
+    assert cache.get('b', 'v1') is None
+    assert cache.get('a', 'v1') == ['x', 'y']
+    assert cache.get('c', 'v1') == ['z']
+
+
+def test_CachedStorage(tmpdir):
+    files = {'index.html': 'root-v1',
+             'abc/index.html': 'abc-v1',
+             'abc/abc-0.1.0.tar.gz': 'etag'}
+    storage = FakeStorage(files)
+    cache = pc.ListingCache(str(tmpdir.join('listings.sqlite')))
+    cached = pc.CachedStorage(storage, cache)
+
+    assert cached.listdir('abc') == ['abc-0.1.0.tar.gz', 'index.html']
+    assert cached.listdir('.') == ['abc', 'index.html']
+    assert storage.listings == 2
+    assert cached.paths_exist(['abc/abc-0.1.0.tar.gz', 'abc/index.html']) == {
+        'abc/abc-0.1.0.tar.gz': True,
+        'abc/index.html': True,
+    }
+    assert storage.listings == 2
+
+    # Absent paths are confirmed without the cache, as a file may have
+    # been uploaded without the index being rewritten
+    files['abc/abc-0.2.0.tar.gz'] = 'etag'
+    assert cached.paths_exist(['abc/abc-0.1.0.tar.gz',
+                               'abc/abc-0.2.0.tar.gz',
+                               'abc/abc-0.3.0.tar.gz']) == {
+        'abc/abc-0.1.0.tar.gz': True,
+        'abc/abc-0.2.0.tar.gz': True,
+        'abc/abc-0.3.0.tar.gz': False,
+    }
+    assert storage.listings == 3
+    del files['abc/abc-0.2.0.tar.gz']
+
+    # A new process (with the same cache) doesn't list unchanged dirs
+    cached = pc.CachedStorage(FakeStorage(files), cache)
+    assert cached.listdir('abc') == ['abc-0.1.0.tar.gz', 'index.html']
+    assert cached.storage.listings == 0
+
+    # Once the index changes, the dir is listed again
+    files['abc/abc-0.2.0.tar.gz'] = 'etag'
+    files['abc/index.html'] = 'abc-v2'
+    assert cached.listdir('abc') == ['abc-0.1.0.tar.gz', 'abc-0.2.0.tar.gz',
+                                     'index.html']
+    assert cached.storage.listings == 1
+
+    # A fresh listing isn't confirmed again for absent paths
+    files['abc/index.html'] = 'abc-v3'
+    assert cached.paths_exist(['abc/abc-0.2.0.tar.gz',
+                               'abc/abc-0.3.0.tar.gz']) == {
+        'abc/abc-0.2.0.tar.gz': True,
+        'abc/abc-0.3.0.tar.gz': False,
+    }
+    assert cached.storage.listings == 2
+
+    # Dirs without an index are never cached
+    files['xyz/xyz-1.0.tar.gz'] = 'etag'
+    cached.listdir('xyz')
+    cached.listdir('xyz')
+    assert cached.storage.listings == 4
+
+    # Everything else is delegated to the storage
+    assert cached.join_path('abc', 'index.html') == 'abc/index.html'
+    assert cached.supports_batch_exists
+
+
+def test_LocalFileSystemStorage_path_token(tmpdir):
+    storage = ps.LocalFileSystemStorage(str(tmpdir))
+    assert storage.path_token('abc/index.html') is None
+    storage.put_contents('<html></html>', 'abc/index.html')
+    token = storage.path_token('abc/index.html')
+    assert token is not None
+    storage.put_contents('<html>abc</html>', 'abc/index.html')
+    assert storage.path_token('abc/index.html') != token
+
+
+def test_load_cached_storage(tmpdir):
+    config = mock.Mock(storage='local-filesystem',
+                       storage_config={'base_path': str(tmpdir)},
+                       cache_config={})
+    args = mock.Mock(no_cache=False)
+    assert isinstance(cli.load_cached_storage(config, args),
+                      ps.LocalFileSystemStorage)
+
+    config.cache_config = {'enabled': 'yes',
+                           'path': str(tmpdir.join('listings.sqlite')),
+                           'max_entries': '10'}
+    storage = cli.load_cached_storage(config, args)
+    assert isinstance(storage, pc.CachedStorage)
+    assert storage.cache.max_entries == 10
+
+    args = mock.Mock(no_cache=True)
+    assert isinstance(cli.load_cached_storage(config, args),
+                      ps.LocalFileSystemStorage)
@@ -0,0 +1,38 @@
+import sys
+import subprocess
+
+
+# Upper bound of the time (in microseconds) taken to import the CLI.
+# It's deliberately generous as it's meant to catch expensive imports
+# (such as the storage SDKs) creeping back in, not to benchmark.
+IMPORT_TIME_BUDGET = 500000
+
+# Modules that must be imported only when they are actually needed
+LAZY_MODULES = ('boto3', 'botocore', 'azure', 'jinja2', 'pkg_resources')
+
+
+def import_times(module):
+    """Returns the cumulative import time (in microseconds) of all the
+    modules imported by importing `module` in a fresh interpreter, as
+    reported by `python -X importtime`
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                           'import {0}'.format(module)],
+                          stderr=subprocess.PIPE, universal_newlines=True,
+                          check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _self, cumulative, name = line.split(':', 1)[1].split('|')
+        if cumulative.strip() == 'cumulative':
+            continue
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_cli_import_time():
+    times = import_times('pypiprivate.cli')
+    lazy = [m for m in times if m.split('.')[0] in LAZY_MODULES]
+    assert lazy == []
+    assert times['pypiprivate.cli'] < IMPORT_TIME_BUDGET
@@ -1,15 +1,20 @@
+import os
+import gzip
+import json
+from concurrent.futures import ThreadPoolExecutor
+
 import pypiprivate.publish as pp
+import pypiprivate.storage as ps
 
 try:
     import mock
 except ImportError:
     from unittest import mock
 
-from pkg_resources import packaging
+from packaging.version import Version
 import pytest
 
 
-Version = packaging.version.Version
 
 
 def test__filter_pkg_dists():
@@ -39,38 +44,81 @@ def test__filter_hyphenated_pkg_dists():
     assert ['a_b_c-0.1.0-cp37-cp37m-linux_x86_64.whl', 'a-b-c-0.1.0.tar.gz'] == filtered
 
 
-def test_find_pkg_dists():
-    project_path = '/tmp/abc'
-    with mock.patch('os.listdir') as mock_fn:
-        mock_fn.return_value = ['abc-0.1.0-py2-none-any.whl',
-                                'abc-0.1.0.tar.gz',
-                                'FooBar-3.2.0.tar.gz',
-                                'Bat_baz-1.8.4-py2-none-any.whl']
+def test_find_pkg_dists(tmpdir):
+    dist_dir = tmpdir.mkdir('dist')
+    for f in ['abc-0.1.0-py2-none-any.whl',
+              'abc-0.1.0.tar.gz',
+              'abc-0.1.0.post1.tar.gz',
+              'FooBar-3.2.0.tar.gz',
+              'Bat_baz-1.8.4-py2-none-any.whl',
+              'README.txt']:
+        dist_dir.join(f).write('')
+    project_path = str(tmpdir)
+    with mock.patch('os.scandir', wraps=os.scandir) as scandir:
         result = list(pp.find_pkg_dists(project_path, 'dist', 'abc', '0.1.0'))
         expected = [{'pkg': 'abc',
                      'normalized_name': 'abc',
                      'artifact': 'abc-0.1.0-py2-none-any.whl',
-                     'path': '/tmp/abc/dist/abc-0.1.0-py2-none-any.whl'},
+                     'path': str(dist_dir.join('abc-0.1.0-py2-none-any.whl'))},
                     {'pkg': 'abc',
                      'normalized_name': 'abc',
                      'artifact': 'abc-0.1.0.tar.gz',
-                     'path': '/tmp/abc/dist/abc-0.1.0.tar.gz'}]
-        assert expected == result
-
-        result = list(pp.find_pkg_dists(project_path, 'dist', 'FooBar', '3.2.0'))
-        expected = [{'pkg': 'FooBar',
-                     'normalized_name': 'foobar',
-                     'artifact': 'FooBar-3.2.0.tar.gz',
-                     'path': '/tmp/abc/dist/FooBar-3.2.0.tar.gz'}]
+                     'path': str(dist_dir.join('abc-0.1.0.tar.gz'))}]
         assert expected == result
-
-        result = list(pp.find_pkg_dists(project_path, 'dist', 'Bat_baz', '1.8.4'))
-        expected = [{'pkg': 'Bat_baz',
-                     'normalized_name': 'batbaz',
-                     'artifact': 'Bat_baz-1.8.4.tar.gz',
-                     'path': '/tmp/abc/dist/Bat_baz-1.8.4.tar.gz'}]
-
-        mock_fn.assert_called_with('/tmp/abc/dist')
+        scandir.assert_called_once_with(str(dist_dir))
+
+    result = list(pp.find_pkg_dists(project_path, 'dist', 'FooBar', '3.2.0'))
+    expected = [{'pkg': 'FooBar',
+                 'normalized_name': 'foobar',
+                 'artifact': 'FooBar-3.2.0.tar.gz',
+                 'path': str(dist_dir.join('FooBar-3.2.0.tar.gz'))}]
+    assert expected == result
+
+    result = list(pp.find_pkg_dists(project_path, 'dist', 'Bat-baz', '1.8.4'))
+    expected = [{'pkg': 'Bat-baz',
+                 'normalized_name': 'bat-baz',
+                 'artifact': 'Bat_baz-1.8.4-py2-none-any.whl',
+                 'path': str(dist_dir.join('Bat_baz-1.8.4-py2-none-any.whl'))}]
+    assert expected == result
+
+
+def test_DistIndex_scan(tmpdir, make_sdist):
+    dist_dir = tmpdir.mkdir('dist')
+    dist_dir.join('abc-0.1.0-py2-none-any.whl').write('')
+    dist_dir.join('def.ghi-1.0.tar.gz').write('')
+    # Ambiguous: either def-1.0 version 1 or def version 1.0-1
+    make_sdist(str(dist_dir.join('def-1.0-1.tar.gz')), 'def', '1.0-1')
+    dist_dir.mkdir('abc-0.2.0.tar.gz')
+    index = pp.DistIndex.scan(str(dist_dir))
+    assert [d.filename for d in index] == ['abc-0.1.0-py2-none-any.whl',
+                                           'def-1.0-1.tar.gz',
+                                           'def.ghi-1.0.tar.gz']
+    wheel, = index.find('ABC', '0.1.0')
+    assert wheel.tags == (None, 'py2', 'none', 'any')
+    sdist, = index.find('def', '1.0.post1')
+    assert (sdist.name, sdist.version, sdist.tags) == ('def', '1.0-1', None)
+    assert [d.filename for d in index.find('def-ghi', '1.0')] == ['def.ghi-1.0.tar.gz']
+    assert index.find('abc', '0.2.0') == []
+
+
+def test_build_index():
+    items = ['abc-0.1.0.tar.gz', 'abc-<0.2.0>.tar.gz']
+    index = pp.build_index('Links for abc', items, 'pkg')
+    assert '<h1>Links for abc</h1>' in index
+    assert '<a href="abc-0.1.0.tar.gz">abc-0.1.0.tar.gz</a>' in index
+    assert 'abc-&lt;0.2.0&gt;.tar.gz' in index
+    # The template is compiled only once
+    assert pp.get_index_template() is pp.get_index_template()
+
+
+def test_stream_index():
+    items = ['abc-0.{0}.0.tar.gz'.format(i) for i in range(1000)]
+    chunks = list(pp.stream_index('Links for abc', items, 'pkg',
+                                  chunk_size=1024))
+    assert len(chunks) > 1
+    assert all(isinstance(c, bytes) for c in chunks)
+    expected = pp.build_index('Links for abc', items, 'pkg')
+    assert b''.join(chunks).decode('utf-8') == expected
 
 
 def test_upload_dist():
@@ -86,7 +134,375 @@ def test_upload_dist():
                                              sync=True)
 
 
-def test_publish_package():
+def test_update_pkg_index(tmpdir):
+    pkg_dir = tmpdir.mkdir('abc')
+    pkg_dir.join('abc-0.1.0.tar.gz').write('')
+    pkg_dir.join('abc-0.1.0-py2-none-any.whl').write('')
+    storage = ps.LocalFileSystemStorage(str(tmpdir))
+
+    # Without a manifest, it's built from the listing of the pkg dir
+    assert pp.update_pkg_index(storage, 'abc', []) is True
+    manifest = json.loads(pkg_dir.join('manifest.json').read())
+    # The artifacts published without digests are marked as such
+    assert manifest == {'files': [{'filename': 'abc-0.1.0-py2-none-any.whl',
+                                   'sha256': None},
+                                  {'filename': 'abc-0.1.0.tar.gz',
+                                   'sha256': None}]}
+    index = pkg_dir.join('index.html').read()
+    assert '<a href="abc-0.1.0.tar.gz">abc-0.1.0.tar.gz</a>' in index
+    assert 'manifest.json' not in index
+
+    # With a manifest, new dists are added to it without listing
+    pkg_dir.join('abc-0.2.0.tar.gz').write('')
+    dist = {'pkg': 'abc',
+            'normalized_name': 'abc',
+            'artifact': 'abc-0.2.0.tar.gz',
+            'path': '/tmp/abc/dist/abc-0.2.0.tar.gz'}
+    with mock.patch.object(storage, 'listdir') as listdir:
+        assert pp.update_pkg_index(storage, 'abc', [dist]) is False
+        assert listdir.call_count == 0
+    manifest = json.loads(pkg_dir.join('manifest.json').read())
+    assert [f['filename'] for f in manifest['files']] == [
+        'abc-0.1.0-py2-none-any.whl',
+        'abc-0.1.0.tar.gz',
+        'abc-0.2.0.tar.gz'
+    ]
+    assert '<a href="abc-0.2.0.tar.gz">' in pkg_dir.join('index.html').read()
+
+    # Full reindex picks up the files missing from the manifest and
+    # reads the metadata of only those
+    pkg_dir.join('abc-0.3.0.tar.gz').write('')
+    with mock.patch.object(storage, 'get_metadata',
+                           wraps=storage.get_metadata) as get_metadata:
+        pp.update_pkg_index(storage, 'abc')
+        get_metadata.assert_called_once_with(os.path.join('abc', 'abc-0.3.0.tar.gz'))
+    manifest = json.loads(pkg_dir.join('manifest.json').read())
+    assert len(manifest['files']) == 4
+
+    # When bootstrapping the manifest on publish, the metadata of the
+    # dists being published isn't read
+    pkg_dir = tmpdir.mkdir('xyz')
+    pkg_dir.join('xyz-0.1.0.tar.gz').write('')
+    pkg_dir.join('xyz-0.2.0.tar.gz').write('')
+    dist = {'pkg': 'xyz',
+            'normalized_name': 'xyz',
+            'artifact': 'xyz-0.2.0.tar.gz',
+            'path': '/tmp/xyz/dist/xyz-0.2.0.tar.gz',
+            'sha256': 'deadbeef'}
+    with mock.patch.object(storage, 'get_metadata',
+                           wraps=storage.get_metadata) as get_metadata:
+        assert pp.update_pkg_index(storage, 'xyz', [dist]) is True
+        get_metadata.assert_called_once_with(os.path.join('xyz', 'xyz-0.1.0.tar.gz'))
+    manifest = json.loads(pkg_dir.join('manifest.json').read())
+    assert manifest['files'][1] == {'filename': 'xyz-0.2.0.tar.gz',
+                                    'sha256': 'deadbeef'}
+
+
+def test_update_root_index(tmpdir):
+    tmpdir.mkdir('abc')
+    tmpdir.mkdir('foobar')
+    storage = ps.LocalFileSystemStorage(str(tmpdir))
+
+    # Without a manifest, it's built from the listing of the root dir
+    pp.update_root_index(storage, ['abc'])
+    manifest = json.loads(tmpdir.join('manifest.json').read())
+    assert manifest == {'packages': ['abc', 'foobar']}
+    assert '<a href="foobar">' in tmpdir.join('index.html').read()
+
+    # Already registered packages don't result in any writes
+    with mock.patch.object(storage, 'listdir') as listdir, \
+            mock.patch.object(storage, 'put_contents') as put_contents:
+        pp.update_root_index(storage, ['abc'])
+        assert listdir.call_count == 0
+        assert put_contents.call_count == 0
+
+    # New packages are added to the manifest without listing
+    with mock.patch.object(storage, 'listdir') as listdir:
+        pp.update_root_index(storage, ['xyz'])
+        assert listdir.call_count == 0
+    manifest = json.loads(tmpdir.join('manifest.json').read())
+    assert manifest == {'packages': ['abc', 'foobar', 'xyz']}
+    assert '<a href="xyz">' in tmpdir.join('index.html').read()
+
+
+def test_update_pkg_index_conflict(tmpdir, monkeypatch):
+    pkg_dir = tmpdir.mkdir('abc')
+    pkg_dir.join('abc-0.1.0.tar.gz').write('')
+    storage = ps.LocalFileSystemStorage(str(tmpdir))
+    pp.update_pkg_index(storage, 'abc', [])
+    monkeypatch.setattr(pp, 'UPDATE_RETRY_DELAY', 0)
+
+    # Another publisher adds its dist after the manifest is read
+    _get_versioned_contents = storage.get_versioned_contents
+    concurrent = [{'pkg': 'abc', 'normalized_name': 'abc',
+                   'artifact': 'abc-0.2.0.tar.gz', 'path': ''}]
+
+    def get_versioned_contents(path):
+        result = _get_versioned_contents(path)
+        if concurrent:
+            monkeypatch.setattr(storage, 'get_versioned_contents',
+                                _get_versioned_contents)
+            pp.update_pkg_index(storage, 'abc', [concurrent.pop()])
+        return result
+
+    monkeypatch.setattr(storage, 'get_versioned_contents', get_versioned_contents)
+    dist = {'pkg': 'abc', 'normalized_name': 'abc',
+            'artifact': 'abc-0.3.0.tar.gz', 'path': ''}
+    pp.update_pkg_index(storage, 'abc', [dist])
+    manifest = json.loads(pkg_dir.join('manifest.json').read())
+    assert [f['filename'] for f in manifest['files']] == [
+        'abc-0.1.0.tar.gz', 'abc-0.2.0.tar.gz', 'abc-0.3.0.tar.gz'
+    ]
+    index = pkg_dir.join('index.html').read()
+    assert '<a href="abc-0.2.0.tar.gz">' in index
+    assert '<a href="abc-0.3.0.tar.gz">' in index
+
+    # Retries are bounded
+    monkeypatch.setattr(storage, 'put_contents_if_match',
+                        mock.Mock(side_effect=ps.PreconditionFailed('conflict')))
+    with pytest.raises(ps.PreconditionFailed):
+        pp.update_pkg_index(storage, 'abc', [dist])
+    assert storage.put_contents_if_match.call_count == pp.MAX_UPDATE_ATTEMPTS
+
+
+def test_update_indexes_concurrently(tmpdir, monkeypatch):
+    storage = ps.LocalFileSystemStorage(str(tmpdir))
+    monkeypatch.setattr(pp, 'UPDATE_RETRY_DELAY', 0.01)
+    dists = []
+    for pkg in ('abc', 'xyz'):
+        for i in range(8):
+            artifact = '{0}-0.{1}.0.tar.gz'.format(pkg, i)
+            tmpdir.ensure(pkg, artifact)
+            dists.append({'pkg': pkg, 'normalized_name': pkg,
+                          'artifact': artifact, 'path': ''})
+
+    # Every dist is published by a separate publisher
+    def publish(dist):
+        pp.update_pkg_index(storage, dist['pkg'], [dist])
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(publish, dists))
+    for pkg in ('abc', 'xyz'):
+        manifest = json.loads(tmpdir.join(pkg, 'manifest.json').read())
+        assert len(manifest['files']) == 8
+        index = tmpdir.join(pkg, 'index.html').read()
+        assert all('<a href="{0}-0.{1}.0.tar.gz">'.format(pkg, i) in index
+                   for i in range(8))
+    root_index = tmpdir.join('index.html').read()
+    assert '<a href="abc">' in root_index
+    assert '<a href="xyz">' in root_index
+
+
+def test_reindex_repository(tmpdir):
+    for pkg, artifacts in [('abc', ['abc-0.1.0.tar.gz', 'abc-0.2.0.tar.gz']),
+                           ('foobar', ['FooBar-3.2.0.tar.gz'])]:
+        pkg_dir = tmpdir.mkdir(pkg)
+        for a in artifacts:
+            pkg_dir.join(a).write('')
+    # A stale index that's missing some artifacts
+    tmpdir.join('abc', 'index.html').write('stale')
+    storage = ps.LocalFileSystemStorage(str(tmpdir))
+
+    pp.reindex_repository(storage, jobs=2)
+    assert 'abc-0.2.0.tar.gz' in tmpdir.join('abc', 'index.html').read()
+    assert 'FooBar-3.2.0.tar.gz' in tmpdir.join('foobar', 'index.html').read()
+    root_manifest = json.loads(tmpdir.join('manifest.json').read())
+    assert root_manifest == {'packages': ['abc', 'foobar']}
+
+    # Nothing is uploaded when the indexes are identical
+    with mock.patch.object(storage, 'put_contents') as put_contents, \
+            mock.patch.object(storage, 'put_stream') as put_stream:
+        pp.reindex_repository(storage, jobs=2, only_changed=True)
+        assert put_contents.call_count == 0
+        assert put_stream.call_count == 0
+
+    tmpdir.join('foobar', 'FooBar-3.3.0.tar.gz').write('')
+    with mock.patch.object(storage, 'put_contents') as put_contents:
+        pp.reindex_repository(storage, only_changed=True)
+        written = sorted(c[0][1] for c in put_contents.call_args_list)
+        assert written == [os.path.join('foobar', 'index.html'),
+                           os.path.join('foobar', 'index.json'),
+                           os.path.join('foobar', 'manifest.json')]
+
+    # Stray files at the root are not packages
+    tmpdir.join('robots.txt').write('User-agent: *')
+    tmpdir.join('README').write('')
+    tmpdir.join('stray').write('')
+    pp.reindex_repository(storage, jobs=2)
+    root_manifest = json.loads(tmpdir.join('manifest.json').read())
+    assert root_manifest == {'packages': ['abc', 'foobar']}
+    assert 'FooBar-3.3.0.tar.gz' in tmpdir.join('foobar', 'index.html').read()
+
+
+def test_read_requires_python(tmpdir, make_wheel, make_sdist):
+    whl = str(tmpdir.join('abc-0.1.0-py3-none-any.whl'))
+    make_wheel(whl, 'abc', '0.1.0', '>=3.6')
+    assert pp.read_requires_python(whl) == '>=3.6'
+    sdist = str(tmpdir.join('abc-0.1.0.tar.gz'))
+    make_sdist(sdist, 'abc', '0.1.0', '>=3.6, <4')
+    assert pp.read_requires_python(sdist) == '>=3.6, <4'
+    make_sdist(sdist, 'abc', '0.1.0')
+    assert pp.read_requires_python(sdist) is None
+    sdist = str(tmpdir.join('abc-0.1.0.tar.xz'))
+    make_sdist(sdist, 'abc', '0.1.0', '>=3.7')
+    assert pp.read_requires_python(sdist) == '>=3.7'
+    broken = tmpdir.join('abc-0.2.0.tar.gz')
+    broken.write('not a tarball')
+    assert pp.read_requires_python(str(broken)) is None
+
+
+def test_build_index_links():
+    items = [{'filename': 'abc-0.1.0-py3-none-any.whl',
+              'sha256': 'deadbeef',
+              'requires_python': '>=3.6'},
+             {'filename': 'abc-0.1.0.tar.gz'}]
+    index = pp.build_index('Links for abc', items, 'pkg')
+    assert ('<a href="abc-0.1.0-py3-none-any.whl#sha256=deadbeef" '
+            'data-requires-python="&gt;=3.6">') in index
+    assert '<a href="abc-0.1.0.tar.gz">abc-0.1.0.tar.gz</a>' in index
+
+
+def test_json_index(tmpdir):
+    pkg_dir = tmpdir.mkdir('abc')
+    pkg_dir.join('abc-0.1.0.tar.gz').write('')
+    storage = ps.LocalFileSystemStorage(str(tmpdir), compress_indexes='gzip')
+    dist = {'pkg': 'abc',
+            'normalized_name': 'abc',
+            'artifact': 'abc-0.1.0-py3-none-any.whl',
+            'path': '/tmp/abc/dist/abc-0.1.0-py3-none-any.whl',
+            'sha256': 'deadbeef',
+            'requires_python': '>=3.6'}
+    with mock.patch.object(storage, 'put_contents',
+                           wraps=storage.put_contents) as put_contents:
+        pp.update_pkg_index(storage, 'abc', [dist])
+        put_contents.assert_any_call(mock.ANY, 'abc/index.json',
+                                     content_type='application/vnd.pypi.simple.v1+json',
+                                     encoding='gzip')
+    index = json.loads(pkg_dir.join('index.json').read())
+    assert index == {
+        'meta': {'api-version': '1.0'},
+        'name': 'abc',
+        'files': [{'filename': 'abc-0.1.0-py3-none-any.whl',
+                   'url': 'abc-0.1.0-py3-none-any.whl',
+                   'hashes': {'sha256': 'deadbeef'},
+                   'requires-python': '>=3.6',
+                   'yanked': False},
+                  {'filename': 'abc-0.1.0.tar.gz',
+                   'url': 'abc-0.1.0.tar.gz',
+                   'hashes': {},
+                   'yanked': False}]
+    }
+    # Pre-compressed copy for gzip_static
+    with gzip.open(str(pkg_dir.join('index.json.gz'))) as f:
+        assert json.loads(f.read().decode('utf-8')) == index
+
+    pp.update_root_index(storage)
+    index = json.loads(tmpdir.join('index.json').read())
+    assert index == {'meta': {'api-version': '1.0'},
+                     'projects': [{'name': 'abc'}]}
+
+    # Generated files are never listed as artifacts or packages
+    pp.reindex_repository(storage)
+    manifest = json.loads(pkg_dir.join('manifest.json').read())
+    assert [f['filename'] for f in manifest['files']] == ['abc-0.1.0.tar.gz']
+    assert json.loads(tmpdir.join('manifest.json').read()) == {'packages': ['abc']}
+
+    # Once compression is turned off, the indexes are rewritten (even
+    # though their contents are unchanged) without the stale copies
+    storage = ps.LocalFileSystemStorage(str(tmpdir))
+    pp.reindex_repository(storage, only_changed=True)
+    assert not pkg_dir.join('index.json.gz').check()
+    assert not pkg_dir.join('index.html.gz').check()
+    assert not tmpdir.join('index.json.gz').check()
+    assert pkg_dir.join('index.json').check()
+
+
+def test_verify_published_dist(tmpdir):
+    src = tmpdir.mkdir('dist').join('abc-0.1.0.tar.gz')
+    src.write('abc')
+    dist = {'pkg': 'abc',
+            'normalized_name': 'abc',
+            'artifact': 'abc-0.1.0.tar.gz',
+            'path': str(src)}
+    storage = ps.LocalFileSystemStorage(str(tmpdir.join('simple')))
+
+    # Identical dist
+    storage.put_file(str(src), 'abc/abc-0.1.0.tar.gz')
+    pp.verify_published_dist(storage, dist)
+    assert dist['sha256'] == pp.file_sha256(str(src))
+
+    # Same filename but different contents
+    src.write('xyz')
+    with pytest.raises(pp.DistMismatch):
+        pp.verify_published_dist(storage, dist)
+
+    # Dists published without a digest can't be verified
+    tmpdir.join('simple', 'abc', 'abc-0.2.0.tar.gz').write('abc')
+    dist = dict(dist, artifact='abc-0.2.0.tar.gz')
+    pp.verify_published_dist(storage, dist)
+
+
+def test_publish_package_local(tmpdir, make_wheel):
+    dist_dir = tmpdir.mkdir('dist')
+    dist_dir.join('abc-0.1.0.tar.gz').write('sdist')
+    whl = str(dist_dir.join('abc-0.1.0-py2-none-any.whl'))
+    make_wheel(whl, 'abc', '0.1.0', '>=2.7')
+    storage = ps.LocalFileSystemStorage(str(tmpdir.join('simple')))
+
+    pp.publish_package('abc', '0.1.0', storage, str(tmpdir), 'dist', jobs=2)
+    assert storage.listdir('abc') != []
+    assert '<a href="abc">' in tmpdir.join('simple', 'index.html').read()
+    index = tmpdir.join('simple', 'abc', 'index.html').read()
+    assert ('<a href="abc-0.1.0-py2-none-any.whl#sha256={0}" '
+            'data-requires-python="&gt;=2.7">').format(pp.file_sha256(whl)) in index
+    assert '<a href="abc-0.1.0.tar.gz#sha256={0}">'.format(
+        pp.file_sha256(str(dist_dir.join('abc-0.1.0.tar.gz')))) in index
+
+    # Republishing identical dists is a no-op
+    with mock.patch.object(storage, 'put_file') as put_file:
+        pp.publish_package('abc', '0.1.0', storage, str(tmpdir), 'dist')
+        assert put_file.call_count == 0
+
+    dist_dir.join('abc-0.1.0.tar.gz').write('rebuilt sdist')
+    with pytest.raises(pp.DistMismatch):
+        pp.publish_package('abc', '0.1.0', storage, str(tmpdir), 'dist')
+
+
+def test_find_published_dists():
+    d1 = {'pkg': 'abc',
+          'normalized_name': 'abc',
+          'artifact': 'abc-0.1.0-py2-none-any.whl',
+          'path': '/tmp/abc/dist/abc-0.1.0-py2-none-any.whl'}
+    d2 = {'pkg': 'abc',
+          'normalized_name': 'abc',
+          'artifact': 'abc-0.1.0.tar.gz',
+          'path': '/tmp/abc/dist/abc-0.1.0.tar.gz'}
+    storage = mock.MagicMock(supports_batch_exists=True)
+    storage.join_path.side_effect = lambda *args: '/'.join(args)
+    storage.paths_exist.return_value = {'abc/abc-0.1.0-py2-none-any.whl': True,
+                                        'abc/abc-0.1.0.tar.gz': False}
+    assert pp.find_published_dists(storage, [d1, d2]) == [d1]
+    storage.paths_exist.assert_called_once_with(['abc/abc-0.1.0-py2-none-any.whl',
+                                                 'abc/abc-0.1.0.tar.gz'])
+    assert storage.path_exists.call_count == 0
+
+    # A single dist, or a storage without batch support, is checked
+    # with path_exists
+    storage.reset_mock()
+    storage.path_exists.return_value = False
+    assert pp.find_published_dists(storage, [d2]) == []
+    storage.path_exists.assert_called_once_with('abc/abc-0.1.0.tar.gz')
+    assert storage.paths_exist.call_count == 0
+
+    storage.reset_mock()
+    storage.supports_batch_exists = False
+    storage.path_exists.side_effect = lambda path: path.endswith('.whl')
+    assert pp.find_published_dists(storage, [d1, d2]) == [d1]
+    assert storage.path_exists.call_count == 2
+    assert storage.paths_exist.call_count == 0
+
+
+def test_publish_package(monkeypatch):
     storage = 'dummy-storage'
 
     d1 = {'pkg': 'abc',
@@ -99,15 +515,15 @@ def test_publish_package():
           'path': '/tmp/abc/dist/abc-0.1.0.tar.gz'}
     pkg_dists = [d1, d2]
 
-    pp.find_pkg_dists = mock.Mock()
+    monkeypatch.setattr(pp, 'verify_published_dist', mock.Mock())
+    monkeypatch.setattr(pp, 'find_pkg_dists', mock.Mock())
     pp.find_pkg_dists.return_value = pkg_dists
 
     # When no dists are already published
-    pp.is_dist_published = mock.Mock()
-    pp.is_dist_published.return_value = False
-    pp.upload_dist = mock.Mock()
-    pp.update_pkg_index = mock.Mock()
-    pp.update_root_index = mock.Mock()
+    monkeypatch.setattr(pp, 'find_published_dists', mock.Mock())
+    pp.find_published_dists.return_value = []
+    monkeypatch.setattr(pp, 'upload_dist', mock.Mock())
+    monkeypatch.setattr(pp, 'update_pkg_index', mock.Mock())
 
     pp.publish_package('abc', '0.1.0', storage, '.', 'dist')
 
@@ -115,51 +531,228 @@ def test_publish_package():
     assert pp.upload_dist.call_count == 2
     assert pp.upload_dist.call_args_list[0][0] == (storage, d1)
     assert pp.upload_dist.call_args_list[1][0] == (storage, d2)
-    pp.update_pkg_index.assert_called_once_with(storage, 'abc')
-    pp.update_root_index.assert_called_once_with(storage)
+    pp.update_pkg_index.assert_called_once_with(storage, 'abc', [d1, d2], [])
 
     # When some dists are already published
-    pp.find_pkg_dists = mock.Mock()
+    monkeypatch.setattr(pp, 'find_pkg_dists', mock.Mock())
     pp.find_pkg_dists.return_value = pkg_dists
 
-    def mock_is_dist_published(storage, dist):
-        if dist == d1:
-            return True
-        elif dist == d2:
-            return False
-
-    pp.is_dist_published = mock.Mock()
-    pp.is_dist_published.side_effect = mock_is_dist_published
-    pp.upload_dist = mock.Mock()
-    pp.update_pkg_index = mock.Mock()
-    pp.update_root_index = mock.Mock()
+    monkeypatch.setattr(pp, 'find_published_dists', mock.Mock())
+    pp.find_published_dists.return_value = [d1]
+    monkeypatch.setattr(pp, 'upload_dist', mock.Mock())
+    monkeypatch.setattr(pp, 'update_pkg_index', mock.Mock())
 
     pp.publish_package('abc', '0.1.0', storage, '.', 'dist')
 
     pp.find_pkg_dists.assert_called_once_with('.', 'dist', 'abc', Version('0.1.0'))
+    pp.verify_published_dist.assert_called_once_with(storage, d1)
     assert pp.upload_dist.call_count == 1
     assert pp.upload_dist.call_args_list[0][0] == (storage, d2)
-    pp.update_pkg_index.assert_called_once_with(storage, 'abc')
-    pp.update_root_index.assert_called_once_with(storage)
+    pp.update_pkg_index.assert_called_once_with(storage, 'abc', [d2], [d1])
 
     # When all dists are already published
-    pp.find_pkg_dists = mock.Mock()
+    monkeypatch.setattr(pp, 'find_pkg_dists', mock.Mock())
     pp.find_pkg_dists.return_value = pkg_dists
-    pp.is_dist_published = mock.Mock()
-    pp.is_dist_published.return_value = True
-    pp.upload_dist = mock.Mock()
-    pp.update_pkg_index = mock.Mock()
-    pp.update_root_index = mock.Mock()
+    monkeypatch.setattr(pp, 'find_published_dists', mock.Mock())
+    pp.find_published_dists.return_value = [d1, d2]
+    monkeypatch.setattr(pp, 'upload_dist', mock.Mock())
+    monkeypatch.setattr(pp, 'update_pkg_index', mock.Mock())
 
     pp.publish_package('abc', '0.1.0', storage, '.', 'dist')
 
     pp.find_pkg_dists.assert_called_once_with('.', 'dist', 'abc', Version('0.1.0'))
     assert pp.upload_dist.call_count == 0
-    assert pp.update_pkg_index.call_count == 0
-    assert pp.update_root_index.call_count == 0
+    # The index is still updated with any dists missing from it
+    pp.update_pkg_index.assert_called_once_with(storage, 'abc', [], [d1, d2])
 
     # When no dists are found
-    pp.find_pkg_dists = mock.Mock()
+    monkeypatch.setattr(pp, 'find_pkg_dists', mock.Mock())
     pp.find_pkg_dists.return_value = []
     with pytest.raises(pp.DistNotFound):
         pp.publish_package('abc', '0.1.0', storage, '.', 'dist')
+
+
+def test_publish_package_retry(tmpdir, make_wheel):
+    dist_dir = tmpdir.mkdir('dist')
+    make_wheel(str(dist_dir.join('abc-0.1.0-py3-none-any.whl')), 'abc', '0.1.0',
+               '>=3.8')
+    dist_dir.join('abc-0.1.0.tar.gz').write('abc')
+    storage = ps.LocalFileSystemStorage(str(tmpdir.join('simple')))
+    pp.write_pkg_index(storage, 'abc', {'files': []})
+
+    # The upload of the sdist fails after the wheel is uploaded
+    put_file = storage.put_file
+
+    def failing_put_file(src, dest, sync=False):
+        if dest.endswith('.tar.gz'):
+            raise IOError('network down')
+        return put_file(src, dest, sync=sync)
+
+    with mock.patch.object(storage, 'put_file', side_effect=failing_put_file):
+        with pytest.raises(IOError):
+            pp.publish_package('abc', '0.1.0', storage, str(tmpdir), 'dist')
+    manifest = json.loads(tmpdir.join('simple', 'abc', 'manifest.json').read())
+    assert manifest['files'] == []
+
+    # On retry, the wheel (already published) is added to the index
+    # along with the sdist
+    pp.publish_package('abc', '0.1.0', storage, str(tmpdir), 'dist')
+    manifest = json.loads(tmpdir.join('simple', 'abc', 'manifest.json').read())
+    wheel, sdist = manifest['files']
+    assert wheel['filename'] == 'abc-0.1.0-py3-none-any.whl'
+    assert wheel['sha256'] == pp.file_sha256(str(dist_dir.join(wheel['filename'])))
+    assert wheel['requires_python'] == '>=3.8'
+    assert sdist['filename'] == 'abc-0.1.0.tar.gz'
+    index = tmpdir.join('simple', 'abc', 'index.html').read()
+    assert 'abc-0.1.0-py3-none-any.whl' in index
+
+
+def test_publish_package_registers_package(tmpdir):
+    dist_dir = tmpdir.mkdir('dist')
+    dist_dir.join('abc-0.1.0.tar.gz').write('abc')
+    storage = ps.LocalFileSystemStorage(str(tmpdir.join('simple')))
+
+    # The publish fails while registering the package, so the package
+    # manifest isn't created
+    with mock.patch.object(pp, 'update_root_index',
+                           side_effect=IOError('network down')):
+        with pytest.raises(IOError):
+            pp.publish_package('abc', '0.1.0', storage, str(tmpdir), 'dist')
+    assert not tmpdir.join('simple', 'abc', 'manifest.json').check()
+    assert not tmpdir.join('simple', 'manifest.json').check()
+
+    # Retrying the publish registers the package
+    pp.publish_package('abc', '0.1.0', storage, str(tmpdir), 'dist')
+    manifest = json.loads(tmpdir.join('simple', 'manifest.json').read())
+    assert manifest == {'packages': ['abc']}
+    assert '<a href="abc">' in tmpdir.join('simple', 'index.html').read()
+    assert tmpdir.join('simple', 'abc', 'manifest.json').check()
+
+    # Publishing to a package with a manifest doesn't read the
+    # repository manifest
+    dist_dir.join('abc-0.2.0.tar.gz').write('abc')
+    with mock.patch.object(pp, 'update_root_index') as update_root_index:
+        pp.publish_package('abc', '0.2.0', storage, str(tmpdir), 'dist')
+        assert update_root_index.call_count == 0
+    manifest = json.loads(tmpdir.join('simple', 'abc', 'manifest.json').read())
+    assert len(manifest['files']) == 2
+
+    # Republishing doesn't rewrite any index
+    with mock.patch.object(storage, 'put_stream') as put_stream:
+        pp.publish_package('abc', '0.2.0', storage, str(tmpdir), 'dist')
+        assert put_stream.call_count == 0
+
+
+def test_publish_package_concurrently():
+    storage = 'dummy-storage'
+    dists = [{'pkg': 'abc',
+              'normalized_name': 'abc',
+              'artifact': 'abc-0.1.0-cp3{0}-none-any.whl'.format(i),
+              'path': '/tmp/abc/dist/abc-0.1.0-cp3{0}-none-any.whl'.format(i)}
+             for i in range(8)]
+    with mock.patch.object(pp, 'find_pkg_dists', return_value=dists), \
+            mock.patch.object(pp, 'find_published_dists', return_value=[]), \
+            mock.patch.object(pp, 'upload_dist') as upload_dist, \
+            mock.patch.object(pp, 'update_pkg_index') as update_pkg_index:
+        pp.publish_package('abc', '0.1.0', storage, '.', 'dist', jobs=4)
+        assert upload_dist.call_count == 8
+        uploaded = sorted(c[0][1]['artifact'] for c in upload_dist.call_args_list)
+        assert uploaded == sorted(d['artifact'] for d in dists)
+        update_pkg_index.assert_called_once_with(storage, 'abc', dists, [])
+
+
+def test_read_releases(tmpdir):
+    manifest = tmpdir.join('releases.txt')
+    manifest.write('\n'.join([
+        '# Release train',
+        'abc 0.1.0',
+        'def-ghi 1.0.0 packages/def  # with project path',
+        '',
+    ]))
+    assert pp.read_releases(str(manifest)) == [
+        ('abc', '0.1.0', str(tmpdir)),
+        ('def-ghi', '1.0.0', str(tmpdir.join('packages', 'def'))),
+    ]
+    manifest.write('abc\n')
+    with pytest.raises(ValueError):
+        pp.read_releases(str(manifest))
+
+
+def test_parse_dist_filename():
+    assert pp.parse_dist_filename('abc-0.1.0-py2-none-any.whl') == (
+        'abc', '0.1.0', (None, 'py2', 'none', 'any'))
+    assert pp.parse_dist_filename('def_ghi-1.0-1-py3-none-any.whl') == (
+        'def_ghi', '1.0', ('1', 'py3', 'none', 'any'))
+    assert pp.parse_dist_filename('def-ghi-1.0.tar.gz') == ('def-ghi', '1.0', None)
+    assert pp.parse_dist_filename('py-3to2-1.0.zip') == ('py-3to2', '1.0', None)
+    assert pp.parse_dist_filename('abc-1.0-1.tar.gz') is None
+    assert pp.parse_dist_filename('abc-1.0-SNAPSHOT.tar.gz') is None
+    assert pp.parse_dist_filename('abc-0.1.0.egg') is None
+    assert pp.parse_dist_filename('README.txt') is None
+
+
+def test_publish_packages(tmpdir, monkeypatch, make_wheel):
+    for name in ('abc', 'def-ghi'):
+        dist_dir = tmpdir.mkdir(name).mkdir('dist')
+        dist_dir.join('{0}-0.1.0.tar.gz'.format(name)).write(name)
+        make_wheel(str(dist_dir.join('{0}-0.1.0-py3-none-any.whl'.format(name.replace('-', '_')))),
+                   name, '0.1.0')
+    manifest = tmpdir.join('releases.txt')
+    manifest.write('abc 0.1.0 abc\ndef-ghi 0.1.0 def-ghi\n')
+    storage = ps.LocalFileSystemStorage(str(tmpdir.join('simple')))
+    render_root_index = mock.Mock(wraps=pp.render_root_index)
+    monkeypatch.setattr(pp, 'render_root_index', render_root_index)
+
+    releases = pp.read_releases(str(manifest))
+    pp.publish_packages(storage, releases=releases, jobs=4)
+    assert render_root_index.call_count == 1
+    root_index = tmpdir.join('simple', 'index.html').read()
+    assert '<a href="abc">' in root_index
+    assert '<a href="def-ghi">' in root_index
+    assert sorted(storage.listdir('def-ghi')) == ['def-ghi-0.1.0.tar.gz',
+                                                  'def_ghi-0.1.0-py3-none-any.whl',
+                                                  'index.html', 'index.json',
+                                                  'manifest.json']
+
+    # Scanning the dist dirs finds the same (already published) dists
+    with mock.patch.object(storage, 'put_file') as put_file:
+        pp.publish_packages(storage, dist_dirs=[str(tmpdir.join('abc', 'dist')),
+                                                str(tmpdir.join('def-ghi', 'dist'))])
+        assert put_file.call_count == 0
+    assert render_root_index.call_count == 1
+
+    with pytest.raises(pp.DistNotFound):
+        pp.publish_packages(storage, releases=[('abc', '0.2.0', str(tmpdir.join('abc')))])
+
+    # Dists found by both a release and a dist dir are uploaded once
+    dist_dir = tmpdir.join('abc', 'dist')
+    dist_dir.join('abc-0.2.0.tar.gz').write('abc')
+    with mock.patch.object(storage, 'put_file', wraps=storage.put_file) as put_file:
+        pp.publish_packages(storage,
+                            releases=[('abc', '0.2.0', str(tmpdir.join('abc')))],
+                            dist_dirs=[str(dist_dir)])
+        put_file.assert_called_once_with(str(dist_dir.join('abc-0.2.0.tar.gz')),
+                                         os.path.join('abc', 'abc-0.2.0.tar.gz'),
+                                         sync=True)
+
+    # The same artifact can't be published from different files
+    other_dir = tmpdir.mkdir('other')
+    other_dir.join('abc-0.3.0.tar.gz').write('other')
+    dist_dir.join('abc-0.3.0.tar.gz').write('abc')
+    with pytest.raises(pp.DistMismatch):
+        pp.publish_packages(storage, dist_dirs=[str(dist_dir), str(other_dir)])
+    assert not storage.path_exists(os.path.join('abc', 'abc-0.3.0.tar.gz'))
+
+
+def test_publish_packages_shared_dist_dir(tmpdir):
+    dist_dir = tmpdir.mkdir('dist')
+    names = ['pkg{0}'.format(i) for i in range(5)]
+    for name in names:
+        dist_dir.join('{0}-1.0.tar.gz'.format(name)).write(name)
+    storage = ps.LocalFileSystemStorage(str(tmpdir.join('simple')))
+    releases = [(name, '1.0', str(tmpdir)) for name in names]
+    with mock.patch('os.scandir', wraps=os.scandir) as scandir:
+        pp.publish_packages(storage, releases=releases, jobs=2)
+        scandir.assert_called_once_with(str(dist_dir))
+    assert sorted(storage.listdir('.')) == ['index.html', 'index.json',
+                                            'manifest.json'] + names
@@ -0,0 +1,331 @@
+import hashlib
+
+import pytest
+
+import pypiprivate.s3 as s3
+import pypiprivate.storage as ps
+
+
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
+def test_AWSS3Storage__from_config_1():
+    sc = {'bucket': 'mybucket',
+          'prefix': 'simple'}
+    env = {'PP_S3_ACCESS_KEY': 'access',
+           'PP_S3_SECRET_KEY': 'secret'}
+    config = mock.Mock(storage_config=sc, env=env)
+    with mock.patch('pypiprivate.s3.boto3.Session') as m:
+        s = s3.AWSS3Storage.from_config(config)
+        assert s.endpoint is None
+        assert s.region is None
+        assert s.acl == 'private'
+
+        # Assertions on calls made to Session object
+        assert len(m.mock_calls) == 2
+        c1, c2 = m.mock_calls
+        exp_c1 = mock.call(aws_access_key_id='access',
+                           aws_secret_access_key='secret',
+                           aws_session_token=None)
+        exp_c2 = mock.call().client('s3', config=s.client_config)
+        assert c1 == exp_c1
+        assert c2 == exp_c2
+        assert s.bucket == 'mybucket'
+
+
+def test_AWSS3Storage__from_config_2():
+    sc = {'bucket': 'mybucket',
+          'prefix': 'simple',
+          'acl': 'public'}
+    env = {'PP_S3_ACCESS_KEY': 'access',
+           'PP_S3_SECRET_KEY': 'secret',
+           'PP_S3_SESSION_TOKEN': 'session'}
+    config = mock.Mock(storage_config=sc, env=env)
+    with mock.patch('pypiprivate.s3.boto3.Session') as m:
+        s = s3.AWSS3Storage.from_config(config)
+        assert s.endpoint is None
+        assert s.region is None
+        assert s.acl == 'public'
+
+        # Assertions on calls made to Session object
+        assert len(m.mock_calls) == 2
+        c1, c2 = m.mock_calls
+        exp_c1 = mock.call(aws_access_key_id='access',
+                           aws_secret_access_key='secret',
+                           aws_session_token='session')
+        exp_c2 = mock.call().client('s3', config=s.client_config)
+        assert c1 == exp_c1
+        assert c2 == exp_c2
+        assert s.bucket == 'mybucket'
+
+
+def test_AWSS3Storage__from_config_3():
+    sc = {'bucket': 'mybucket',
+          'prefix': 'simple',
+          'endpoint': 'https://s3.us-west-2.amazonaws.com',
+          'region': 'us-west-2'}
+    env = {'PP_S3_ACCESS_KEY': 'access',
+           'PP_S3_SECRET_KEY': 'secret',
+           'PP_S3_SESSION_TOKEN': 'session'}
+    config = mock.Mock(storage_config=sc, env=env)
+    with mock.patch('pypiprivate.s3.boto3.Session') as m:
+        s = s3.AWSS3Storage.from_config(config)
+        assert s.endpoint == 'https://s3.us-west-2.amazonaws.com'
+        assert s.region == 'us-west-2'
+        assert s.acl == 'private'
+
+        # Assertions on calls made to Session object
+        assert len(m.mock_calls) == 2
+        c1, c2 = m.mock_calls
+        exp_c1 = mock.call(aws_access_key_id='access',
+                           aws_secret_access_key='secret',
+                           aws_session_token='session')
+        exp_c2 = mock.call().client('s3', config=s.client_config,
+                                    endpoint_url='https://s3.us-west-2.amazonaws.com',
+                                    region_name='us-west-2')
+        assert c1 == exp_c1
+        assert c2 == exp_c2
+        assert s.bucket == 'mybucket'
+
+
+def test_AWSS3Storage__from_config_4():
+    sc = {'bucket': 'mybucket',
+          'prefix': 'simple',
+          'endpoint': 'https://s3.us-west-2.amazonaws.com',
+          'region': 'us-west-2'}
+    env = {}
+    config = mock.Mock(storage_config=sc, env=env)
+    with mock.patch('pypiprivate.s3.boto3.Session') as m:
+        s = s3.AWSS3Storage.from_config(config)
+        assert s.endpoint == 'https://s3.us-west-2.amazonaws.com'
+        assert s.region == 'us-west-2'
+        assert s.acl == 'private'
+
+        # Assertions on calls made to Session object
+        assert len(m.mock_calls) == 2
+        c1, c2 = m.mock_calls
+        exp_c1 = mock.call()
+        exp_c2 = mock.call().client('s3', config=s.client_config,
+                                    endpoint_url='https://s3.us-west-2.amazonaws.com',
+                                    region_name='us-west-2')
+        assert c1 == exp_c1
+        assert c2 == exp_c2
+        assert s.bucket == 'mybucket'
+
+
+def test_AWSS3Storage__from_config_client_config():
+    sc = {'bucket': 'mybucket',
+          'max_pool_connections': '64',
+          'connect_timeout': '5',
+          'read_timeout': '30',
+          'retry_mode': 'adaptive',
+          'retry_max_attempts': '8',
+          'tcp_keepalive': 'no'}
+    config = mock.Mock(storage_config=sc, env={})
+    with mock.patch('pypiprivate.s3.boto3.Session') as m:
+        s = s3.AWSS3Storage.from_config(config)
+        m.return_value.client.assert_called_once_with('s3',
+                                                      config=s.client_config)
+        assert s.client is m.return_value.client.return_value
+        assert s.client_config.max_pool_connections == 64
+        assert s.client_config.connect_timeout == 5
+        assert s.client_config.read_timeout == 30
+        assert s.client_config.retries == {'mode': 'adaptive',
+                                           'max_attempts': 8}
+        assert s.client_config.tcp_keepalive is False
+
+    # Defaults
+    config = mock.Mock(storage_config={'bucket': 'mybucket'}, env={})
+    with mock.patch('pypiprivate.s3.boto3.Session'):
+        s = s3.AWSS3Storage.from_config(config)
+        assert s.client_config.max_pool_connections == ps.MAX_POOL_CONNECTIONS
+        assert s.client_config.retries == {'mode': 'standard',
+                                           'max_attempts': 5}
+        assert s.client_config.tcp_keepalive is True
+
+
+def test_AWSS3Storage__from_config_multipart(tmpdir):
+    sc = {'bucket': 'mybucket',
+          'multipart_threshold': '1KB',
+          'multipart_chunksize': '16MB',
+          'max_concurrency': '8'}
+    config = mock.Mock(storage_config=sc, env={})
+    src = tmpdir.join('abc-0.1.0.tar.gz')
+    src.write('x' * 2048)
+    with mock.patch('pypiprivate.s3.boto3.Session'):
+        s = s3.AWSS3Storage.from_config(config)
+        assert s.transfer_config.multipart_threshold == 1024
+        assert s.transfer_config.multipart_chunksize == 16 * 1024 * 1024
+        assert s.transfer_config.max_request_concurrency == 8
+
+        client = s.client
+        digest = s.put_file(str(src), 'abc/abc-0.1.0.tar.gz')
+        assert digest == hashlib.sha256(b'x' * 2048).hexdigest()
+        assert client.put_object.call_count == 0
+        assert client.upload_fileobj.call_count == 1
+        args, kwargs = client.upload_fileobj.call_args
+        assert args[1:] == (s.bucket, 'abc/abc-0.1.0.tar.gz')
+        # The digest is set as metadata by the upload itself
+        assert kwargs == {'ExtraArgs': {'ContentType': 'application/x-tar',
+                                        'ACL': 'private',
+                                        'CacheControl': ps.DIST_CACHE_CONTROL,
+                                        'Metadata': {'sha256': digest}},
+                          'Config': s.transfer_config}
+        assert client.copy_object.call_count == 0
+
+
+def test_AWSS3Storage_sync_strategies(tmpdir):
+    src = tmpdir.join('abc-0.1.0.tar.gz')
+    src.write('abc')
+    md5 = '900150983cd24fb0d6963f7d28e17f72'
+    with mock.patch('pypiprivate.s3.boto3.Session'):
+        # etag-verify makes no additional requests
+        s = s3.AWSS3Storage('mybucket', 'private')
+        client = s.client
+        client.put_object.return_value = {'ETag': '"{0}"'.format(md5)}
+        s.put_file(str(src), 'abc/abc-0.1.0.tar.gz', sync=True)
+        assert client.put_object.call_count == 1
+        assert client.get_waiter.call_count == 0
+
+        client.put_object.return_value = {'ETag': '"corrupted"'}
+        with pytest.raises(ps.SyncFailed):
+            s.put_file(str(src), 'abc/abc-0.1.0.tar.gz', sync=True)
+
+        # waiter polls using the configured delay and attempts
+        s = s3.AWSS3Storage('mybucket', 'private', sync_strategy='waiter',
+                            sync_delay=1, sync_max_attempts=3)
+        client = s.client
+        s.put_contents('<html></html>', 'abc/index.html', sync=True)
+        client.get_waiter.assert_called_once_with('object_exists')
+        client.get_waiter().wait.assert_called_once_with(
+            Bucket=s.bucket,
+            Key='abc/index.html',
+            WaiterConfig={'Delay': 1, 'MaxAttempts': 3}
+        )
+
+        with pytest.raises(ValueError):
+            s3.AWSS3Storage('mybucket', 'private', sync_strategy='poll')
+
+
+def test_AWSS3Storage_put_stream_compressed():
+    with mock.patch('pypiprivate.s3.boto3.Session'):
+        s = s3.AWSS3Storage('mybucket', 'private', compress_indexes='gzip')
+        client = s.client
+        uploaded = []
+        client.upload_fileobj.side_effect = lambda f, *args, **kwargs: uploaded.append(f.read())
+        s.put_stream(iter([b'<html>', b'</html>']), 'abc/index.html',
+                     encoding='gzip')
+        assert ps.decompress(uploaded[0], 'gzip') == b'<html></html>'
+        kwargs = client.upload_fileobj.call_args[1]
+        assert kwargs['ExtraArgs'] == {'ContentType': 'text/html',
+                                       'ACL': 'private',
+                                       'ContentEncoding': 'gzip',
+                                       'CacheControl': 'no-cache, no-transform'}
+
+
+def test_AWSS3Storage_cache_control(tmpdir):
+    src = tmpdir.join('abc-0.1.0.tar.gz')
+    src.write('abc')
+    sc = {'bucket': 'mybucket',
+          'dist_cache_control': 'public, max-age=86400',
+          'index_cache_control': 'max-age=60'}
+    config = mock.Mock(storage_config=sc, env={})
+    with mock.patch('pypiprivate.s3.boto3.Session'):
+        s = s3.AWSS3Storage.from_config(config)
+        client = s.client
+        s.put_file(str(src), 'abc/abc-0.1.0.tar.gz')
+        assert client.put_object.call_args[1]['CacheControl'] == 'public, max-age=86400'
+        s.put_contents('{}', 'abc/manifest.json')
+        assert client.put_object.call_args[1]['CacheControl'] == 'max-age=60'
+
+    # An empty policy means that the header is not set
+    sc = {'bucket': 'mybucket',
+          'index_cache_control': ''}
+    config = mock.Mock(storage_config=sc, env={})
+    with mock.patch('pypiprivate.s3.boto3.Session'):
+        s = s3.AWSS3Storage.from_config(config)
+        client = s.client
+        s.put_contents('{}', 'abc/manifest.json')
+        assert 'CacheControl' not in client.put_object.call_args[1]
+        assert s.cache_control(False) == ps.DIST_CACHE_CONTROL
+        assert s.cache_control(True, 'gzip') == 'no-transform'
+
+
+def test_AWSS3Storage_iter_dir():
+    pages = [
+        {'Contents': [{'Key': 'simple/abc/'},
+                      {'Key': 'simple/abc/abc-0.1.0.tar.gz'}],
+         'CommonPrefixes': [{'Prefix': 'simple/abc/old/'}]},
+        {'Contents': [{'Key': 'simple/abc/index.html'}]},
+    ]
+    fetched = []
+
+    def paginate(**kwargs):
+        for page in pages:
+            fetched.append(page)
+            yield page
+
+    with mock.patch('pypiprivate.s3.boto3.Session'):
+        s = s3.AWSS3Storage('mybucket', 'private', prefix='simple')
+        paginator = s.client.get_paginator.return_value
+        paginator.paginate.side_effect = paginate
+
+        # Pages are fetched only as the names are consumed
+        names = s.iter_dir('abc')
+        assert next(names) == 'abc-0.1.0.tar.gz'
+        assert len(fetched) == 1
+        assert list(names) == ['old', 'index.html']
+        assert len(fetched) == 2
+        s.client.get_paginator.assert_called_with('list_objects_v2')
+        paginator.paginate.assert_called_with(Bucket='mybucket',
+                                              Prefix='simple/abc/',
+                                              Delimiter='/')
+
+        assert s.listdir('abc') == ['abc-0.1.0.tar.gz', 'old', 'index.html']
+
+        pages = [{'KeyCount': 0}]
+        with pytest.raises(ps.PathNotFound):
+            s.listdir('xyz')
+
+
+def test_AWSS3Storage_put_contents_if_match():
+    from botocore.exceptions import ClientError
+    with mock.patch('pypiprivate.s3.boto3.Session'):
+        s = s3.AWSS3Storage('mybucket', 'private', prefix='simple')
+        client = s.client
+        operation = client.meta.service_model.operation_model.return_value
+        operation.input_shape.members = {'IfMatch': None, 'IfNoneMatch': None}
+        assert s.supports_conditional_put
+        client.meta.service_model.operation_model.assert_called_with('PutObject')
+        client.put_object.return_value = {'ETag': '"v2"'}
+        assert s.put_contents_if_match('{}', 'abc/manifest.json', '"v1"') == '"v2"'
+        kwargs = client.put_object.call_args[1]
+        assert kwargs['Key'] == 'simple/abc/manifest.json'
+        assert kwargs['IfMatch'] == '"v1"'
+        assert 'IfNoneMatch' not in kwargs
+
+        s.put_contents_if_match('{}', 'abc/manifest.json', None)
+        kwargs = client.put_object.call_args[1]
+        assert kwargs['IfNoneMatch'] == '*'
+        assert 'IfMatch' not in kwargs
+
+        for code in ('PreconditionFailed', 'ConditionalRequestConflict'):
+            client.put_object.side_effect = ClientError({'Error': {'Code': code}},
+                                                        'PutObject')
+            with pytest.raises(ps.PreconditionFailed):
+                s.put_contents_if_match('{}', 'abc/manifest.json', '"v1"')
+
+    config = mock.Mock(storage_config={'bucket': 'mybucket',
+                                       'conditional_writes': 'no'},
+                       env={})
+    with mock.patch('pypiprivate.s3.boto3.Session'):
+        assert not s3.AWSS3Storage.from_config(config).supports_conditional_put
+
+    # botocore that predates conditional writes
+    with mock.patch('pypiprivate.s3.boto3.Session'):
+        s = s3.AWSS3Storage('mybucket', 'private', prefix='simple')
+        operation = s.client.meta.service_model.operation_model.return_value
+        operation.input_shape.members = {'Key': None, 'IfNoneMatch': None}
+        assert not s.supports_conditional_put
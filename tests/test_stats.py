@@ -0,0 +1,214 @@
+import json
+import socket
+
+import pytest
+
+import pypiprivate.cli as cli
+import pypiprivate.publish as pp
+import pypiprivate.stats as pst
+import pypiprivate.storage as ps
+
+
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
+
+def test_OperationStats():
+    stats = pst.OperationStats()
+    assert stats.quantile(0.95) == 0.0
+    for duration in [0.001] * 18 + [0.2, 400]:
+        stats.record(duration, nbytes=10)
+    assert stats.count == 20
+    assert stats.bytes == 200
+    assert stats.max_time == 400
+    assert stats.quantile(0.5) == 0.005
+    assert stats.quantile(0.95) == 0.25
+    assert stats.quantile(1) == 400
+    assert stats.to_dict()['buckets']['+Inf'] == 1
+
+
+def test_InstrumentedStorage(tmpdir):
+    src = tmpdir.join('abc-0.1.0.tar.gz')
+    src.write('abc')
+    sink = mock.Mock()
+    collector = pst.StatsCollector([sink])
+    storage = pst.InstrumentedStorage(
+        ps.LocalFileSystemStorage(str(tmpdir.join('simple'))), collector)
+
+    storage.put_file(str(src), 'abc/abc-0.1.0.tar.gz')
+    storage.put_contents('{}', 'abc/manifest.json')
+    storage.put_stream(iter([b'<html>', b'</html>']), 'abc/index.html')
+    assert storage.get_contents('abc/index.html') == '<html></html>'
+    assert storage.listdir('abc')
+    with pytest.raises(ps.PathNotFound):
+        storage.listdir('xyz')
+    with pytest.raises(IOError):
+        storage.put_file(str(tmpdir.join('missing.tar.gz')), 'abc/missing.tar.gz')
+
+    # Everything else is delegated to the storage
+    assert storage.join_path('abc', 'index.html') == 'abc/index.html'
+    assert not storage.supports_batch_exists
+
+    snapshot = collector.snapshot()['operations']
+    assert snapshot['put_file']['bytes'] == 3
+    assert snapshot['put_contents']['bytes'] == 2
+    assert snapshot['put_stream']['bytes'] == 13
+    assert snapshot['get_contents']['bytes'] == 13
+    assert snapshot['listdir']['count'] == 2
+    assert snapshot['listdir']['errors'] == 0
+    assert snapshot['put_file']['errors'] == 1
+    assert sink.record.call_count == 7
+    operation, _start, duration, nbytes, error = sink.record.call_args[0]
+    assert (operation, error) == ('put_file', True)
+
+    report = collector.report()
+    assert report.splitlines()[0].split() == [
+        'operation', 'calls', 'errors', 'bytes', 'total', 's', 'mean', 'ms',
+        'p95', 'ms', 'max', 'ms'
+    ]
+    assert 'put_stream' in report
+
+    # The contents may be passed as kwargs
+    storage.put_contents(contents='{"a":1}', dest='abc/manifest.json')
+    storage.put_file(src=str(src), dest='abc/abc-0.1.0.tar.gz')
+    snapshot = collector.snapshot()['operations']
+    assert snapshot['put_contents']['bytes'] == 9
+    assert snapshot['put_file']['bytes'] == 6
+    assert sink.record.call_count == 9
+    assert pst.InstrumentedStorage.count_bytes('put_contents', (), {}, None) == 0
+
+    # A failing sink doesn't fail the call
+    sink.record.side_effect = IOError('statsd down')
+    assert storage.get_contents('abc/index.html') == '<html></html>'
+    with pytest.raises(ps.PathNotFound):
+        storage.listdir('xyz')
+    assert collector.snapshot()['operations']['listdir']['count'] == 3
+
+
+def test_InstrumentedStorage_publish(tmpdir):
+    dist_dir = tmpdir.mkdir('dist')
+    dist_dir.join('abc-0.1.0.tar.gz').write('abc')
+    collector = pst.StatsCollector()
+    storage = pst.InstrumentedStorage(
+        ps.LocalFileSystemStorage(str(tmpdir.join('simple'))), collector)
+    pp.publish_package('abc', '0.1.0', storage, str(tmpdir), 'dist')
+    operations = collector.snapshot()['operations']
+    assert operations['put_file']['count'] == 1
+    assert '<a href="abc">' in tmpdir.join('simple', 'index.html').read()
+
+
+def test_watch_client():
+    boto3 = pytest.importorskip('boto3')
+    from botocore.stub import Stubber
+    client = boto3.client('s3', region_name='us-east-1',
+                          aws_access_key_id='access',
+                          aws_secret_access_key='secret')
+    collector = pst.StatsCollector()
+    collector.watch_client(mock.Mock(client=client))
+    with Stubber(client) as stubber:
+        stubber.add_response('head_object',
+                             {'ResponseMetadata': {'RetryAttempts': 2}},
+                             {'Bucket': 'mybucket', 'Key': 'abc/index.html'})
+        client.head_object(Bucket='mybucket', Key='abc/index.html')
+    assert collector.snapshot()['api_calls'] == {
+        's3.HeadObject': {'count': 1, 'retries': 2}
+    }
+    assert 's3.HeadObject' in collector.report()
+
+
+def make_collector():
+    collector = pst.StatsCollector()
+    collector.record('listdir', 0, 0.02, error=True)
+    collector.record('put_file', 0, 1.5, nbytes=1024)
+    collector.record_api_call('s3.PutObject', retries=1)
+    return collector
+
+
+def test_JSONSink(tmpdir):
+    path = tmpdir.join('stats.json')
+    pst.JSONSink(str(path)).flush(make_collector())
+    stats = json.loads(path.read())
+    assert stats['operations']['put_file']['bytes'] == 1024
+    assert stats['api_calls']['s3.PutObject'] == {'count': 1, 'retries': 1}
+
+
+def test_PrometheusTextfileSink(tmpdir):
+    path = tmpdir.join('pypiprivate.prom')
+    pst.PrometheusTextfileSink(str(path)).flush(make_collector())
+    lines = path.read().splitlines()
+    assert 'pypiprivate_storage_operation_errors_total{operation="listdir"} 1' in lines
+    assert 'pypiprivate_storage_operation_bytes_total{operation="put_file"} 1024' in lines
+    assert ('pypiprivate_storage_operation_duration_seconds_bucket'
+            '{operation="put_file",le="1"} 0') in lines
+    assert ('pypiprivate_storage_operation_duration_seconds_bucket'
+            '{operation="put_file",le="+Inf"} 1') in lines
+    assert 'pypiprivate_storage_operation_duration_seconds_count{operation="put_file"} 1' in lines
+    assert 'pypiprivate_api_retries_total{call="s3.PutObject"} 1' in lines
+
+
+def test_StatsDSink():
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(('127.0.0.1', 0))
+    server.settimeout(5)
+    host, port = server.getsockname()
+    try:
+        sink = pst.StatsDSink(host, port, prefix='pp')
+        sink.record('put_file', 0, 0.25, 1024, False)
+        assert server.recv(4096).decode('utf-8').splitlines() == [
+            'pp.storage.put_file:250.000|ms',
+            'pp.storage.put_file.bytes:1024|c'
+        ]
+        sink.flush(make_collector())
+        assert server.recv(4096).decode('utf-8').splitlines() == [
+            'pp.api.s3.PutObject:1|c',
+            'pp.api.s3.PutObject.retries:1|c'
+        ]
+    finally:
+        server.close()
+
+
+def test_OpenTelemetrySink():
+    tracer = mock.Mock()
+    sink = pst.OpenTelemetrySink(tracer)
+    sink.record('put_file', 10, 0.5, 1024, False)
+    tracer.start_span.assert_called_once_with(
+        'storage.put_file', start_time=10 * 10 ** 9,
+        attributes={'pypiprivate.operation': 'put_file',
+                    'pypiprivate.bytes': 1024,
+                    'pypiprivate.error': False}
+    )
+    tracer.start_span.return_value.end.assert_called_once_with(
+        end_time=int(10.5 * 10 ** 9))
+
+
+def test_load_sinks(tmpdir):
+    config = mock.Mock(stats_config={
+        'json': str(tmpdir.join('stats.json')),
+        'prometheus_textfile': str(tmpdir.join('pypiprivate.prom')),
+        'statsd': 'localhost:9125',
+        'opentelemetry': 'no'
+    })
+    sinks = pst.load_sinks(config)
+    assert [type(s) for s in sinks] == [pst.JSONSink,
+                                        pst.PrometheusTextfileSink,
+                                        pst.StatsDSink]
+    assert sinks[2].address == ('localhost', 9125)
+
+
+def test_instrumented(tmpdir, capsys):
+    storage = ps.LocalFileSystemStorage(str(tmpdir))
+    config = mock.Mock(stats_config={})
+    with cli.instrumented(storage, config, mock.Mock(stats=False)) as s:
+        assert s is storage
+
+    path = tmpdir.join('stats.json')
+    config = mock.Mock(stats_config={'json': str(path)})
+    with pytest.raises(ps.PathNotFound):
+        with cli.instrumented(storage, config, mock.Mock(stats=True)) as s:
+            assert isinstance(s, pst.InstrumentedStorage)
+            s.get_contents('abc/index.html')
+    # The stats are reported even if the command fails
+    assert 'get_contents' in capsys.readouterr().out
+    assert json.loads(path.read())['operations']['get_contents']['count'] == 1
@@ -1,3 +1,9 @@
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
 import pypiprivate.storage as ps
 
 
@@ -7,109 +13,191 @@ except ImportError:
     from unittest import mock
 
 
-def test_AWSS3Storage__from_config_1():
-    sc = {'bucket': 'mybucket',
-          'prefix': 'simple'}
-    env = {'PP_S3_ACCESS_KEY': 'access',
-           'PP_S3_SECRET_KEY': 'secret'}
-    config = mock.Mock(storage_config=sc, env=env)
-    with mock.patch('pypiprivate.storage.boto3.Session') as m:
-        s = ps.AWSS3Storage.from_config(config)
-        assert s.endpoint is None
-        assert s.region is None
-        assert s.acl == 'private'
-
-        # Assertions on calls made to Session object
-        assert len(m.mock_calls) == 3
-        c1, c2, c3 = m.mock_calls
-        exp_c1 = mock.call(aws_access_key_id='access',
-                           aws_secret_access_key='secret',
-                           aws_session_token=None)
-        exp_c2 = mock.call().resource('s3')
-        exp_c3 = mock.call().resource().Bucket('mybucket')
-        assert c1 == exp_c1
-        assert c2 == exp_c2
-        assert c3 == exp_c3
-
-
-def test_AWSS3Storage__from_config_2():
-    sc = {'bucket': 'mybucket',
-          'prefix': 'simple',
-          'acl': 'public'}
-    env = {'PP_S3_ACCESS_KEY': 'access',
-           'PP_S3_SECRET_KEY': 'secret',
-           'PP_S3_SESSION_TOKEN': 'session'}
-    config = mock.Mock(storage_config=sc, env=env)
-    with mock.patch('pypiprivate.storage.boto3.Session') as m:
-        s = ps.AWSS3Storage.from_config(config)
-        assert s.endpoint is None
-        assert s.region is None
-        assert s.acl == 'public'
-
-        # Assertions on calls made to Session object
-        assert len(m.mock_calls) == 3
-        c1, c2, c3 = m.mock_calls
-        exp_c1 = mock.call(aws_access_key_id='access',
-                           aws_secret_access_key='secret',
-                           aws_session_token='session')
-        exp_c2 = mock.call().resource('s3')
-        exp_c3 = mock.call().resource().Bucket('mybucket')
-        assert c1 == exp_c1
-        assert c2 == exp_c2
-        assert c3 == exp_c3
-
-
-def test_AWSS3Storage__from_config_3():
-    sc = {'bucket': 'mybucket',
-          'prefix': 'simple',
-          'endpoint': 'https://s3.us-west-2.amazonaws.com',
-          'region': 'us-west-2'}
-    env = {'PP_S3_ACCESS_KEY': 'access',
-           'PP_S3_SECRET_KEY': 'secret',
-           'PP_S3_SESSION_TOKEN': 'session'}
-    config = mock.Mock(storage_config=sc, env=env)
-    with mock.patch('pypiprivate.storage.boto3.Session') as m:
-        s = ps.AWSS3Storage.from_config(config)
-        assert s.endpoint == 'https://s3.us-west-2.amazonaws.com'
-        assert s.region == 'us-west-2'
-        assert s.acl == 'private'
-
-        # Assertions on calls made to Session object
-        assert len(m.mock_calls) == 3
-        c1, c2, c3 = m.mock_calls
-        exp_c1 = mock.call(aws_access_key_id='access',
-                           aws_secret_access_key='secret',
-                           aws_session_token='session')
-        exp_c2 = mock.call().resource('s3',
-                                      endpoint_url='https://s3.us-west-2.amazonaws.com',
-                                      region_name='us-west-2')
-        exp_c3 = mock.call().resource().Bucket('mybucket')
-        assert c1 == exp_c1
-        assert c2 == exp_c2
-        assert c3 == exp_c3
-
-
-def test_AWSS3Storage__from_config_4():
-    sc = {'bucket': 'mybucket',
-          'prefix': 'simple',
-          'endpoint': 'https://s3.us-west-2.amazonaws.com',
-          'region': 'us-west-2'}
-    env = {}
-    config = mock.Mock(storage_config=sc, env=env)
-    with mock.patch('pypiprivate.storage.boto3.Session') as m:
-        s = ps.AWSS3Storage.from_config(config)
-        assert s.endpoint == 'https://s3.us-west-2.amazonaws.com'
-        assert s.region == 'us-west-2'
-        assert s.acl == 'private'
-
-        # Assertions on calls made to Session object
-        assert len(m.mock_calls) == 3
-        c1, c2, c3 = m.mock_calls
-        exp_c1 = mock.call()
-        exp_c2 = mock.call().resource('s3',
-                                      endpoint_url='https://s3.us-west-2.amazonaws.com',
-                                      region_name='us-west-2')
-        exp_c3 = mock.call().resource().Bucket('mybucket')
-        assert c1 == exp_c1
-        assert c2 == exp_c2
-        assert c3 == exp_c3
+
+def test_Storage_paths_exist():
+    storage = ps.Storage()
+    storage.supports_batch_exists = True
+    with mock.patch.object(storage, 'listdir') as listdir:
+        def _listdir(path):
+            if path == 'abc':
+                return ['abc-0.1.0.tar.gz', 'index.html']
+            raise ps.PathNotFound(path)
+        listdir.side_effect = _listdir
+        result = storage.paths_exist(['abc/abc-0.1.0.tar.gz',
+                                      'abc/abc-0.1.0-py2-none-any.whl',
+                                      'xyz/xyz-1.0.tar.gz'])
+        assert result == {'abc/abc-0.1.0.tar.gz': True,
+                          'abc/abc-0.1.0-py2-none-any.whl': False,
+                          'xyz/xyz-1.0.tar.gz': False}
+        assert listdir.call_args_list == [mock.call('abc'), mock.call('xyz')]
+
+    # Without batch support, every path is checked on its own
+    storage = ps.Storage()
+    with mock.patch.object(storage, 'listdir') as listdir, \
+         mock.patch.object(storage, 'path_exists') as path_exists:
+        path_exists.side_effect = lambda path: path == 'abc/abc-0.1.0.tar.gz'
+        result = storage.paths_exist(['abc/abc-0.1.0.tar.gz',
+                                      'xyz/xyz-1.0.tar.gz'])
+        assert result == {'abc/abc-0.1.0.tar.gz': True,
+                          'xyz/xyz-1.0.tar.gz': False}
+        assert listdir.call_count == 0
+
+
+def test_LocalFileSystemStorage_paths_exist(tmpdir):
+    tmpdir.mkdir('abc').join('abc-0.1.0.tar.gz').write('')
+    storage = ps.LocalFileSystemStorage(str(tmpdir))
+    result = storage.paths_exist(['abc/abc-0.1.0.tar.gz',
+                                  'abc/abc-0.1.0-py2-none-any.whl'])
+    assert result == {'abc/abc-0.1.0.tar.gz': True,
+                      'abc/abc-0.1.0-py2-none-any.whl': False}
+
+
+def test_ChunkedReader():
+    reader = ps.ChunkedReader([b'abc', b'', b'defgh', b'i'])
+    assert reader.read(2) == b'ab'
+    assert reader.read(4) == b'cdef'
+    assert reader.read() == b'ghi'
+    assert reader.read() == b''
+
+
+def test_LocalFileSystemStorage_put_stream(tmpdir):
+    storage = ps.LocalFileSystemStorage(str(tmpdir))
+    storage.put_stream(iter([b'<html>', b'</html>']), 'abc/index.html')
+    assert tmpdir.join('abc', 'index.html').read() == '<html></html>'
+
+
+def test_parse_size():
+    assert ps.parse_size(4096) == 4096
+    assert ps.parse_size('4096') == 4096
+    assert ps.parse_size('64KB') == 64 * 1024
+    assert ps.parse_size('8 MB') == 8 * 1024 * 1024
+    assert ps.parse_size('1gb') == 1024 * 1024 * 1024
+
+
+def test_LocalFileSystemStorage_put_file(tmpdir):
+    src = tmpdir.join('abc-0.1.0.tar.gz')
+    src.write('abc')
+    storage = ps.LocalFileSystemStorage(str(tmpdir.join('simple')))
+    digest = storage.put_file(str(src), 'abc/abc-0.1.0.tar.gz')
+    assert digest == hashlib.sha256(b'abc').hexdigest()
+    assert tmpdir.join('simple', 'abc', 'abc-0.1.0.tar.gz').read() == 'abc'
+    assert storage.get_metadata('abc/abc-0.1.0.tar.gz') == {'sha256': digest}
+    # Sidecar files are not listed
+    assert storage.listdir('abc') == ['abc-0.1.0.tar.gz']
+    with pytest.raises(ps.PathNotFound):
+        storage.get_metadata('abc/abc-0.2.0.tar.gz')
+
+
+def test_LocalFileSystemStorage_put_file_concurrently(tmpdir):
+    storage = ps.LocalFileSystemStorage(str(tmpdir.join('simple')))
+    srcs = []
+    for i in range(16):
+        src = tmpdir.join('abc-0.{0}.0.tar.gz'.format(i))
+        src.write(str(i))
+        srcs.append(src)
+    # All the uploads create the (same) package dir at the same time
+    barrier = threading.Barrier(len(srcs))
+
+    def upload(src):
+        barrier.wait()
+        storage.put_file(str(src), 'abc/{0}'.format(src.basename))
+
+    with ThreadPoolExecutor(max_workers=len(srcs)) as executor:
+        list(executor.map(upload, srcs))
+    assert sorted(storage.listdir('abc')) == sorted(s.basename for s in srcs)
+
+
+@pytest.mark.parametrize('encoding', ['gzip', 'br'])
+def test_compress(encoding):
+    if encoding == 'br':
+        pytest.importorskip('brotli')
+    data = b'<a href="abc">abc</a><br>' * 1000
+    compressed = ps.compress(data, encoding)
+    assert len(compressed) < len(data)
+    assert ps.decompress(compressed, encoding) == data
+    chunks = [data[i:i + 100] for i in range(0, len(data), 100)]
+    streamed = b''.join(ps.compress_chunks(chunks, encoding))
+    assert ps.decompress(streamed, encoding) == data
+    with pytest.raises(ValueError):
+        ps.validate_encoding('deflate')
+
+
+def test_LocalFileSystemStorage_put_stream_compressed(tmpdir):
+    storage = ps.LocalFileSystemStorage(str(tmpdir), compress_indexes='gzip')
+    storage.put_stream(iter([b'<html>', b'</html>']), 'abc/index.html',
+                       encoding='gzip')
+    assert tmpdir.join('abc', 'index.html').read() == '<html></html>'
+    compressed = tmpdir.join('abc', 'index.html.gz').read_binary()
+    assert ps.decompress(compressed, 'gzip') == b'<html></html>'
+    assert storage.has_encoding('abc/index.html', 'gzip')
+    assert not storage.has_encoding('abc/index.html', None)
+
+    # Writing without the encoding removes the stale compressed copy
+    storage.put_stream(iter([b'<html>v2</html>']), 'abc/index.html')
+    assert not tmpdir.join('abc', 'index.html.gz').check()
+    assert storage.has_encoding('abc/index.html', None)
+    storage.put_contents('{}', 'abc/index.json', encoding='gzip')
+    storage.put_contents('{}', 'abc/index.json')
+    assert not tmpdir.join('abc', 'index.json.gz').check()
+
+
+def test_load_storage(tmpdir):
+    config = mock.Mock(storage='local-filesystem',
+                       storage_config={'base_path': str(tmpdir)},
+                       env={})
+    storage = ps.load_storage(config)
+    assert isinstance(storage, ps.LocalFileSystemStorage)
+    config = mock.Mock(storage='ftp')
+    with pytest.raises(ValueError):
+        ps.load_storage(config)
+
+
+def test_get_storage_class():
+    import pypiprivate.s3 as s3
+    assert ps.get_storage_class('aws-s3') is s3.AWSS3Storage
+    # Backward compatible import path
+    assert ps.AWSS3Storage is s3.AWSS3Storage
+    with pytest.raises(AttributeError):
+        ps.GCSStorage
+
+
+def test_get_storage_class_entry_points():
+    class GCSStorage(ps.Storage):
+        pass
+
+    ep = mock.Mock()
+    ep.name = 'gcs'
+    ep.load.return_value = GCSStorage
+    with mock.patch('pypiprivate.storage.iter_entry_points') as m:
+        m.return_value = [ep]
+        assert ps.get_storage_class('gcs') is GCSStorage
+        m.assert_called_once_with('pypiprivate.storage_backends')
+        with pytest.raises(ValueError):
+            ps.get_storage_class('ftp')
+        # Built-in backends are resolved without scanning entry points
+        m.reset_mock()
+        assert ps.get_storage_class('local-filesystem') is ps.LocalFileSystemStorage
+        assert m.call_count == 0
+
+
+def test_LocalFileSystemStorage_put_contents_if_match(tmpdir):
+    storage = ps.LocalFileSystemStorage(str(tmpdir))
+    assert storage.supports_conditional_put
+
+    # Creating requires the file to not exist
+    token = storage.put_contents_if_match('{}', 'abc/manifest.json', None)
+    assert storage.get_versioned_contents('abc/manifest.json') == ('{}', token)
+    with pytest.raises(ps.PreconditionFailed):
+        storage.put_contents_if_match('{"a":1}', 'abc/manifest.json', None)
+
+    # Replacing requires the version that was read
+    new_token = storage.put_contents_if_match('{"b":2}', 'abc/manifest.json', token)
+    assert new_token != token
+    with pytest.raises(ps.PreconditionFailed):
+        storage.put_contents_if_match('{"c":3}', 'abc/manifest.json', token)
+    assert storage.get_contents('abc/manifest.json') == '{"b":2}'
+
+    # No lock (or temp) files are left in the served tree
+    assert tmpdir.join('abc').listdir() == [tmpdir.join('abc', 'manifest.json')]
+    with pytest.raises(ps.PathNotFound):
+        storage.get_versioned_contents('xyz/manifest.json')